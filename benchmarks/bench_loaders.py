@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+# Time loading ETC outputs of the size of a PFS simulation with the original
+# pandas loaders and with the loaders in pfs_etc_utils.
+#
+#   python benchmarks/bench_loaders.py
+
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from pfs_etc_web.pfs_etc_utils import (
+    load_simspec,
+    load_sncont,
+    load_snline,
+    simspec_columns,
+    sncont_columns,
+    snline_columns,
+)
+
+# 4 arms of 4096 pixels
+n_pixels = 4 * 4096
+n_lines = 2000
+
+
+def load_table_pandas(infile, columns):
+    # implementation before load_ascii_table
+    return pd.read_table(
+        infile,
+        sep=r"\s+",
+        comment="#",
+        header=None,
+        names=list(columns.keys()),
+        dtype=columns,
+    )
+
+
+def write_table(outfile, columns, n, rng):
+    fmt = " ".join("%d" if v is int else "%.6e" for v in columns.values())
+    data = [
+        rng.integers(0, 4, n) if v is int else rng.random(n) * 1e3
+        for v in columns.values()
+    ]
+    with open(outfile, "w") as f:
+        f.write("# " + " ".join(columns.keys()) + "\n")
+        np.savetxt(f, np.column_stack(data), fmt=fmt)
+
+
+def timeit(fn, *args, n=10, setup=None):
+    t = []
+    for _ in range(n):
+        if setup is not None:
+            setup()
+        t0 = time.perf_counter()
+        fn(*args)
+        t.append(time.perf_counter() - t0)
+    return min(t)
+
+
+def main():
+    rng = np.random.default_rng(0)
+
+    outputs = {
+        "simspec": (load_simspec, simspec_columns, n_pixels),
+        "sncont": (load_sncont, sncont_columns, n_pixels),
+        "snline": (load_snline, snline_columns, n_lines),
+    }
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, (loader, columns, n) in outputs.items():
+            infile = os.path.join(tmpdir, f"{name}.dat")
+            write_table(infile, columns, n, rng)
+
+            t_pandas = timeit(load_table_pandas, infile, columns)
+            t_numpy = timeit(loader, infile)
+
+            identical = loader(infile).equals(load_table_pandas(infile, columns))
+
+            print(f"{name} ({n} rows):")
+            print(f"  pandas read_table: {t_pandas * 1e3:6.2f} ms")
+            print(
+                f"  numpy loadtxt:     {t_numpy * 1e3:6.2f} ms ({t_pandas / t_numpy:.1f}x)"
+            )
+            print(f"  identical output:  {identical}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+# Time writing the magnitude file of the largest template with the original
+# per-line loop and with write_mag_file.
+#
+#   python benchmarks/bench_mag_file.py
+
+import filecmp
+import os
+import tempfile
+import time
+import warnings
+
+from astropy import units as u
+
+from pfs_etc_web.pfs_etc_spectemplates import (
+    get_template,
+    prepare_spectrum_arrays,
+    template_path,
+    templatefiles,
+    write_mag_file,
+)
+
+
+def write_mag_file_loop(outfile, wout, fout):
+    # implementation before write_mag_file
+    with open(outfile, "w") as f:
+        for i in range(len(wout)):
+            f.write(f"{wout[i]}  {fout[i]}\n")
+
+
+def timeit(fn, *args, n=20):
+    t = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        fn(*args)
+        t.append(time.perf_counter() - t0)
+    return min(t)
+
+
+def main():
+    warnings.simplefilter("ignore")
+
+    sizes = {
+        k: get_template(template_path(k)).wave.size
+        for k in templatefiles.keys()
+        if template_path(k) is not None
+    }
+    template = max(sizes, key=sizes.get)
+
+    wout, fout = prepare_spectrum_arrays(
+        template_path(template),
+        norm_wavelength=800.0 * u.nm,
+        norm_mag=20.0 * u.ABmag,
+        wmin=0.0,
+        wmax=1.0e5,
+    )
+    print(f"{template}: {wout.size} pixels")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        file_loop = os.path.join(tmpdir, "loop.txt")
+        file_bulk = os.path.join(tmpdir, "bulk.txt")
+
+        t_loop = timeit(write_mag_file_loop, file_loop, wout, fout)
+        t_bulk = timeit(write_mag_file, file_bulk, wout, fout)
+
+        print(f"per-line loop:  {t_loop * 1e3:.1f} ms")
+        print(f"write_mag_file: {t_bulk * 1e3:.1f} ms ({t_loop / t_bulk:.1f}x)")
+        print(f"identical output: {filecmp.cmp(file_loop, file_bulk, shallow=False)}")
+
+
+if __name__ == "__main__":
+    main()
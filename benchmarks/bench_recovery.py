@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+# Time reading a session opened by a shared link: parameters from the ECSV
+# headers and the ETC outputs from the text files as in older versions, and
+# both from the manifest of the session.
+#
+#   python benchmarks/bench_recovery.py
+
+import os
+import tempfile
+import time
+
+import numpy as np
+from astropy.table import QTable
+
+from pfs_etc_web.pfs_etc_utils import (
+    load_ascii_table,
+    manifest_tables,
+    read_manifest,
+    write_manifest,
+)
+
+# 4 arms of 4096 pixels
+n_rows = {"simspec": 4 * 4096, "snline": 2000, "sncont": 4 * 4096}
+
+# header keywords read by recover_simulation
+meta = {
+    k: [0.0]
+    for k in [
+        "TMPL_MAG",
+        "TMPL_WAV",
+        "TMPL_Z",
+        "GAL_EXT",
+        "R_EFF",
+        "EL_FLUX",
+        "EL_SIG",
+        "SEEING",
+        "DEGRADE",
+        "MOON-ZA",
+        "MOON-SEP",
+        "MOON-PH",
+        "EXPTIME1",
+        "EXPNUM",
+        "FLDANG",
+        "MED_RES",
+        "ZANG",
+    ]
+}
+meta["TMPLSPEC"] = ["Galaxy"]
+
+
+def write_table(outfile, columns, n, rng):
+    fmt = " ".join("%d" if v is int else "%.6e" for v in columns.values())
+    data = [
+        rng.integers(0, 4, n) if v is int else rng.random(n) * 1e3
+        for v in columns.values()
+    ]
+    np.savetxt(outfile, np.column_stack(data), fmt=fmt)
+
+
+def timeit(fn, n=10, setup=None):
+    t = []
+    for _ in range(n):
+        if setup is not None:
+            setup()
+        t0 = time.perf_counter()
+        fn()
+        t.append(time.perf_counter() - t0)
+    return min(t)
+
+
+def main():
+    rng = np.random.default_rng(0)
+
+    with tempfile.TemporaryDirectory() as outdir:
+        infiles = {}
+        for name, columns in manifest_tables.items():
+            infiles[name] = os.path.join(outdir, f"{name}.dat")
+            write_table(infiles[name], columns, n_rows[name], rng)
+
+        data = tuple(
+            load_ascii_table(infiles[k], v) for k, v in manifest_tables.items()
+        )
+
+        ecsv = {}
+        for name in ["simspec", "snline"]:
+            ecsv[name] = os.path.join(outdir, f"{name}.ecsv")
+            tb = QTable.from_pandas(data[list(manifest_tables.keys()).index(name)])
+            tb.meta.update(meta)
+            tb.write(ecsv[name], overwrite=True)
+
+        manifest = os.path.join(outdir, "manifest.npz")
+        write_manifest(manifest, {"target": {}}, data)
+
+        def read_legacy():
+            for infile in ecsv.values():
+                QTable.read(infile)
+            for name, columns in manifest_tables.items():
+                load_ascii_table(infiles[name], columns)
+
+        t_legacy = timeit(read_legacy)
+        t_manifest = timeit(lambda: read_manifest(manifest))
+
+        identical = all(a.equals(b) for a, b in zip(data, read_manifest(manifest)[1]))
+
+    print("read a session:")
+    print(f"  ECSV headers and text files: {t_legacy * 1e3:7.2f} ms")
+    print(
+        f"  manifest:                    {t_manifest * 1e3:7.2f} ms "
+        f"({t_legacy / t_manifest:.1f}x)"
+    )
+    print(f"  identical output:            {identical}")
+
+
+if __name__ == "__main__":
+    main()
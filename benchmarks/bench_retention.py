@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+# Time the output retention on a directory with many sessions: the first scan
+# measures every session, later scans reuse the sizes of unmodified sessions
+# from the retention index.
+#
+#   python benchmarks/bench_retention.py [--sessions 100000]
+
+import argparse
+import os
+import tempfile
+import time
+
+from loguru import logger
+
+from pfs_etc_web.pfs_etc_retention import clean_outputs
+
+# files in a session directory of a typical simulation
+n_files = 6
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the output retention")
+    parser.add_argument(
+        "--sessions",
+        type=int,
+        default=20000,
+        help="Number of session directories (default: 20000).",
+    )
+
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+    args = get_arguments()
+
+    logger.remove()
+
+    with tempfile.TemporaryDirectory() as basedir:
+        now = time.time()
+        for i in range(args.sessions):
+            outdir = os.path.join(basedir, f"session{i:07d}")
+            os.makedirs(os.path.join(outdir, "tmp"))
+            for j in range(n_files):
+                with open(os.path.join(outdir, f"file{j}.dat"), "wb") as f:
+                    f.write(b"0" * 4096)
+            t = now - 86400 + i
+            os.utime(outdir, (t, t))
+
+        # large enough not to remove anything
+        quota = 1 << 50
+
+        t0 = time.perf_counter()
+        stats = clean_outputs(basedir, quota)
+        t_first = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        clean_outputs(basedir, quota)
+        t_index = time.perf_counter() - t0
+
+        # remove the older half
+        t0 = time.perf_counter()
+        removed = clean_outputs(basedir, stats["size"] // 2)
+        t_remove = time.perf_counter() - t0
+
+    print(f"{args.sessions} sessions ({stats['size'] / 1024**2:.1f} MiB):")
+    print(f"  first scan:        {t_first:6.2f} s")
+    print(f"  scan with index:   {t_index:6.2f} s ({t_first / t_index:.1f}x)")
+    print(f"  remove the older {removed['removed']}: {t_remove:6.2f} s")
+
+
+if __name__ == "__main__":
+    main()
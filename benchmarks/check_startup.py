@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+# Start the app with `panel serve` as in the Dockerfile and fail if the cold
+# start of the server or the first session render exceed the budget, or if
+# modules deferred to the first simulation are imported. The output of
+# -X importtime is written to the log file.
+#
+#   python benchmarks/check_startup.py [--log startup_importtime.log]
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+rootdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# imported when a simulation is run rather than when a session starts
+deferred_modules = ["synphot", "pfsspecsim", "astropy.table"]
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="Check startup time of the app")
+    parser.add_argument(
+        "--startup-budget",
+        dest="startup_budget",
+        type=float,
+        default=5.0,
+        help="Max. time until the server accepts requests in seconds (default: 5).",
+    )
+    parser.add_argument(
+        "--render-budget",
+        dest="render_budget",
+        type=float,
+        default=3.0,
+        help="Max. time to render the first session in seconds (default: 3).",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=60.0,
+        help="Time to wait for the server in seconds (default: 60).",
+    )
+    parser.add_argument(
+        "--log",
+        type=str,
+        default="startup_importtime.log",
+        help="Output of -X importtime (default: startup_importtime.log).",
+    )
+
+    args = parser.parse_args()
+
+    return args
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def wait_for(url: str, proc, timeout: float):
+    t0 = time.perf_counter()
+    while time.perf_counter() - t0 < timeout:
+        if proc.poll() is not None:
+            raise RuntimeError(f"The server exited with {proc.returncode}")
+        try:
+            with urllib.request.urlopen(url, timeout=1.0):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"No response from {url} in {timeout} s")
+
+
+def imported_modules(logfile: str) -> dict:
+    # cumulative import time in seconds by module
+    modules = {}
+    with open(logfile) as f:
+        for line in f:
+            if not line.startswith("import time:") or "cumulative" in line:
+                continue
+            _, cumulative, name = line[len("import time:") :].split("|")
+            modules[name.strip()] = int(cumulative) * 1e-6
+    return modules
+
+
+def main():
+    args = get_arguments()
+
+    port = free_port()
+
+    env = dict(os.environ)
+    env["PYTHONPROFILEIMPORTTIME"] = "1"
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.join(rootdir, "src")]
+        + ([env["PYTHONPATH"]] if "PYTHONPATH" in env else [])
+    )
+
+    with open(args.log, "w") as log:
+        t0 = time.perf_counter()
+        proc = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "panel",
+                "serve",
+                "app.py",
+                "--port",
+                str(port),
+                "--liveness",
+            ],
+            cwd=rootdir,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=log,
+        )
+        try:
+            wait_for(f"http://localhost:{port}/liveness", proc, args.timeout)
+            t_startup = time.perf_counter() - t0
+
+            # the app script is executed for the first session
+            t0 = time.perf_counter()
+            with urllib.request.urlopen(
+                f"http://localhost:{port}/app", timeout=args.timeout
+            ) as r:
+                r.read()
+            t_render = time.perf_counter() - t0
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    modules = imported_modules(args.log)
+    imported = [m for m in deferred_modules if m in modules]
+
+    print(f"server cold start:    {t_startup:.2f} s (budget {args.startup_budget} s)")
+    print(f"first session render: {t_render:.2f} s (budget {args.render_budget} s)")
+    print("slowest top-level imports:")
+    top = {k: v for k, v in modules.items() if "." not in k}
+    for k in sorted(top, key=top.get, reverse=True)[:10]:
+        print(f"  {top[k]:6.3f} s  {k}")
+    if len(imported) > 0:
+        print(f"deferred modules imported at startup: {imported}")
+    print(f"import times written in {args.log}")
+
+    failed = (
+        t_startup > args.startup_budget
+        or t_render > args.render_budget
+        or len(imported) > 0
+    )
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+import argparse
+
+from ..pfs_etc_utils import backfill_manifests
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        description="Write the manifest of sessions of older versions from their tables"
+    )
+    parser.add_argument(
+        "dir", type=str, help="directory of the outputs (OUTPUT_DIR of the app)"
+    )
+    parser.add_argument(
+        "--max-workers",
+        dest="max_workers",
+        type=int,
+        default=8,
+        help="Number of threads to read the tables (default: 8).",
+    )
+    parser.add_argument(
+        "--dry-run",
+        dest="dry_run",
+        action="store_true",
+        help="Only report manifests to be written.",
+    )
+
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+    args = get_arguments()
+
+    backfill_manifests(args.dir, dry_run=args.dry_run, max_workers=args.max_workers)
+
+
+if __name__ == "__main__":
+    main()
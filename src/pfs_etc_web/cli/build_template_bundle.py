@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+
+import argparse
+
+from ..pfs_etc_spectemplates import build_template_bundle
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        description="Pack the template spectra of the app into a single file"
+    )
+
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+    get_arguments()
+
+    build_template_bundle()
+
+
+if __name__ == "__main__":
+    main()
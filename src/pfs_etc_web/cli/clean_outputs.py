@@ -1,12 +1,49 @@
 #!/usr/bin/env python3
 
 import argparse
-import os
+
+from ..pfs_etc_retention import clean_outputs, parse_size, retention_loop
 
 
 def get_arguments():
-    parser = argparse.ArgumentParser(description="Clean output files in a folder")
-    parser.add_argment("dir", type=str, help="directory to be cleaned")
+    parser = argparse.ArgumentParser(
+        description="Remove the least recently used simulation outputs beyond a quota"
+    )
+    parser.add_argument(
+        "dir", type=str, help="directory to be cleaned (OUTPUT_DIR of the app)"
+    )
+    parser.add_argument(
+        "--quota",
+        type=str,
+        required=True,
+        help="Max. total size of the outputs, e.g., 500M or 20G.",
+    )
+    parser.add_argument(
+        "--min-age",
+        dest="min_age",
+        type=float,
+        default=3600.0,
+        help="Keep outputs used within this time in seconds (default: 3600).",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=None,
+        help="Repeat the cleaning at this interval in seconds (default: run once).",
+    )
+    parser.add_argument(
+        "--max-workers",
+        dest="max_workers",
+        type=int,
+        default=8,
+        help="Number of threads to measure the size of outputs (default: 8).",
+    )
+    parser.add_argument(
+        "--dry-run",
+        dest="dry_run",
+        action="store_true",
+        help="Only report outputs to be removed.",
+    )
 
     args = parser.parse_args()
 
@@ -16,7 +53,14 @@ def get_arguments():
 def main():
     args = get_arguments()
 
-    pass
+    kwargs = dict(
+        min_age=args.min_age, dry_run=args.dry_run, max_workers=args.max_workers
+    )
+
+    if args.interval is None:
+        clean_outputs(args.dir, parse_size(args.quota), **kwargs)
+    else:
+        retention_loop(args.dir, parse_size(args.quota), args.interval, **kwargs)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+
+import argparse
+
+from ..pfs_etc_dataset import compact_results
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        description="Merge the files of the result dataset into one per day and table"
+    )
+    parser.add_argument("root", type=str, help="result dataset (RESULT_DATASET)")
+    parser.add_argument(
+        "--before",
+        type=str,
+        default=None,
+        help="Compact days before this date, YYYYmmdd (default: today).",
+    )
+
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+    args = get_arguments()
+
+    compact_results(args.root, before=args.before)
+
+
+if __name__ == "__main__":
+    main()
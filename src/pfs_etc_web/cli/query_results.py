@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import re
+
+from loguru import logger
+
+from ..pfs_etc_dataset import query_results
+
+where_pattern = re.compile(r"^\s*([\w.]+)\s*(==|!=|<=|>=|<|>)\s*(.+?)\s*$")
+
+
+def parse_where(where: str) -> tuple:
+    # e.g., "environment.seeing==0.8" or "target.template==Galaxy"
+    m = where_pattern.match(where)
+    if m is None:
+        raise argparse.ArgumentTypeError(f"Invalid condition: {where}")
+    column, op, value = m.groups()
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    return column, op, value
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        description="Export results of simulations from the result dataset"
+    )
+    parser.add_argument("root", type=str, help="result dataset (RESULT_DATASET)")
+    parser.add_argument("outfile", type=str, help="output table (.parquet or .csv)")
+    parser.add_argument(
+        "--table",
+        type=str,
+        choices=["simspec", "snline", "sncont"],
+        default="sncont",
+        help="Table to be exported (default: sncont).",
+    )
+    parser.add_argument(
+        "--where",
+        type=parse_where,
+        action="append",
+        default=None,
+        help='Condition, e.g., "environment.seeing==0.8" (can be repeated).',
+    )
+    parser.add_argument(
+        "--columns",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Columns to be exported (default: all).",
+    )
+
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+    args = get_arguments()
+
+    df = query_results(
+        args.root, table=args.table, filters=args.where, columns=args.columns
+    )
+
+    if args.outfile.endswith(".parquet"):
+        df.to_parquet(args.outfile, index=False)
+    else:
+        df.to_csv(args.outfile, index=False)
+
+    logger.info(f"{len(df)} rows written in {args.outfile}")
+
+
+if __name__ == "__main__":
+    main()
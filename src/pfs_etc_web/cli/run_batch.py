@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import argparse
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from loguru import logger
+
+from ..pfs_etc_batch import read_catalog, run_batch, write_results
+from ..pfs_etc_executor import default_max_workers
+from ..pfs_etc_spectemplates import load_templates
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        description="Compute S/N for targets in a CSV catalog"
+    )
+    parser.add_argument("infile", type=str, help="input catalog (CSV)")
+    parser.add_argument("outfile", type=str, help="output table (CSV)")
+    parser.add_argument(
+        "--basedir",
+        type=str,
+        default="tmp",
+        help="Directory to store intermediate ETC outputs (default: tmp).",
+    )
+    parser.add_argument(
+        "--max-workers",
+        dest="max_workers",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: CPU count / OMP_NUM_THREADS).",
+    )
+    parser.add_argument(
+        "--noise-cache-size",
+        dest="noise_cache_size",
+        type=int,
+        default=None,
+        help="Max. number of noise spectra reused between groups (default: disabled).",
+    )
+    parser.add_argument(
+        "--template-engine",
+        dest="template_engine",
+        type=str,
+        choices=["synphot", "numpy"],
+        default="synphot",
+        help="Implementation used to redshift and normalize templates (default: synphot).",
+    )
+    parser.add_argument(
+        "--with-input",
+        dest="with_input",
+        action="store_true",
+        help="Include the input columns in the output table.",
+    )
+
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+    args = get_arguments()
+
+    t_start = time.time()
+
+    df = read_catalog(args.infile)
+
+    max_workers = (
+        default_max_workers() if args.max_workers is None else args.max_workers
+    )
+
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=load_templates,
+    ) as executor:
+        n = write_results(
+            run_batch(
+                executor,
+                df,
+                basedir=args.basedir,
+                noise_cache_size=args.noise_cache_size,
+                template_engine=args.template_engine,
+            ),
+            args.outfile,
+            df_catalog=df if args.with_input else None,
+        )
+
+    logger.info(
+        f"S/N of {n} targets written in {args.outfile} ({time.time() - t_start:.1f} s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+import time
+import warnings
+
+import numpy as np
+from astropy import units as u
+
+from ..pfs_etc_spectemplates import (
+    load_templates,
+    prepare_spectrum_arrays,
+    prepare_spectrum_arrays_numpy,
+    template_path,
+    templatefiles,
+)
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        description="Compare the numpy template engine with the synphot one"
+    )
+    parser.add_argument(
+        "--zmax", type=float, default=4.0, help="Max. redshift (default: 4.0)."
+    )
+    parser.add_argument(
+        "--dz", type=float, default=0.1, help="Redshift step (default: 0.1)."
+    )
+    parser.add_argument(
+        "--wavelength",
+        type=float,
+        nargs="+",
+        default=[400.0, 600.0, 800.0, 1000.0, 1200.0],
+        help="Normalization wavelengths in nm (default: 400 600 800 1000 1200).",
+    )
+    parser.add_argument(
+        "--mag", type=float, default=20.0, help="Normalization AB mag (default: 20)."
+    )
+    parser.add_argument(
+        "--tol",
+        type=float,
+        default=1e-6,
+        help="Max. allowed difference in AB mag (default: 1e-6).",
+    )
+
+    args = parser.parse_args()
+
+    return args
+
+
+def compare(infile: str, **kwargs) -> tuple:
+    # returns (status, max. difference in mag, time of synphot, time of numpy)
+    t0 = time.perf_counter()
+    try:
+        spec_synphot = prepare_spectrum_arrays(infile, **kwargs)
+    except Exception:
+        # synphot raises for a band outside the spectrum, numpy returns None
+        spec_synphot = None
+    t1 = time.perf_counter()
+    spec_numpy = prepare_spectrum_arrays_numpy(infile, **kwargs)
+    t2 = time.perf_counter()
+
+    if spec_synphot is None or spec_numpy is None:
+        status = "ok" if spec_synphot is None and spec_numpy is None else "mismatch"
+        return status, 0.0, t1 - t0, t2 - t1
+
+    if not np.array_equal(spec_synphot[0], spec_numpy[0]):
+        return "mismatch", np.inf, t1 - t0, t2 - t1
+
+    # 99.9 is set for no flux; values close to zero flux are not comparable
+    good = (spec_synphot[1] < 50.0) | (spec_numpy[1] < 50.0)
+    dmag = np.abs(spec_synphot[1][good] - spec_numpy[1][good])
+
+    return "ok", dmag.max() if dmag.size > 0 else 0.0, t1 - t0, t2 - t1
+
+
+def main():
+    args = get_arguments()
+
+    warnings.simplefilter("ignore")
+
+    load_templates()
+
+    redshifts = np.arange(0.0, args.zmax + args.dz / 2, args.dz)
+
+    n, n_fail = 0, 0
+    dmag_max = 0.0
+    t_synphot, t_numpy = 0.0, 0.0
+
+    for template in templatefiles.keys():
+        infile = template_path(template)
+        if infile is None:
+            continue
+        for z in redshifts:
+            for w in args.wavelength:
+                status, dmag, dt_synphot, dt_numpy = compare(
+                    infile,
+                    redshift=z,
+                    norm_wavelength=w * u.nm,
+                    norm_mag=args.mag * u.ABmag,
+                )
+                n += 1
+                t_synphot += dt_synphot
+                t_numpy += dt_numpy
+                dmag_max = max(dmag_max, dmag)
+                if status != "ok" or dmag > args.tol:
+                    n_fail += 1
+                    print(
+                        f"FAILED: {template}, z={z:.3f}, {w} nm: {status}, dmag={dmag:.3g}"
+                    )
+
+    print(f"{n} cases, {n_fail} failed, max. difference {dmag_max:.3g} mag")
+    print(
+        f"mean time per template: synphot {t_synphot / n * 1e3:.2f} ms, "
+        f"numpy {t_numpy / n * 1e3:.2f} ms"
+    )
+
+    sys.exit(1 if n_fail > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+
+import os
+import secrets
+from concurrent.futures import as_completed
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from astropy import units as u
+from loguru import logger
+
+from .pfs_etc_cache import get_noise_cache
+from .pfs_etc_noisemodel import NoiseModel, arm_ids, rescale_snline
+from .pfs_etc_params import (
+    EnvironmentConf,
+    InstrumentConf,
+    OutputConf,
+    TargetConf,
+    TelescopeConf,
+    conf_values,
+    default_parameters,
+)
+from .pfs_etc_retention import running_session
+from .pfs_etc_spectemplates import template_engines, template_path
+from .pfs_etc_utils import load_sncont, load_snline
+
+# columns of an input catalog and their default values
+target_columns = {
+    "template": default_parameters.template,
+    "mag": default_parameters.mag,
+    "wavelength": default_parameters.wavelength,
+    "redshift": default_parameters.redshift,
+    "line_flux": default_parameters.line_flux,
+    "line_width": default_parameters.line_width,
+    "line_wavelength": np.nan,
+}
+# rows sharing these values are simulated with a single ETC run
+group_columns = {
+    "r_eff": default_parameters.r_eff,
+    "galactic_extinction": default_parameters.galactic_extinction,
+    "seeing": default_parameters.seeing,
+    "degrade": default_parameters.degrade,
+    "moon_zenith_angle": default_parameters.moon_zenith_angle,
+    "moon_target_angle": default_parameters.moon_target_angle,
+    "moon_phase": default_parameters.moon_phase,
+    "exp_time": default_parameters.exp_time,
+    "exp_num": default_parameters.exp_num,
+    "field_angle": default_parameters.field_angle,
+    "mr_mode": default_parameters.mr_mode,
+    "zenith_angle": default_parameters.zenith_angle,
+}
+# per-target values simulated at the nearest multiple of these widths, so that
+# continuous values in a catalog do not make a run per target
+bin_widths = {
+    "r_eff": 0.05,  # [arcsec]
+    "galactic_extinction": 0.01,  # E(B-V) [mag]
+}
+
+# magnitude of the flat reference spectrum simulated for each group
+mag_ref = 22.0
+
+# number of catalog rows evaluated at once to bound the memory usage
+chunk_size = 256
+
+
+def read_catalog(infile) -> pd.DataFrame:
+    df = pd.read_csv(infile, comment="#")
+
+    unknown = set(df.columns) - set(target_columns) - set(group_columns)
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown columns in the catalog: {sorted(unknown)}")
+
+    if len(df) == 0:
+        raise ValueError("No targets in the catalog")
+
+    for k, v in {**target_columns, **group_columns}.items():
+        if k not in df.columns:
+            df[k] = v
+
+    # rows with a blank value would be dropped from the groups; the line
+    # wavelength is optional
+    blank = df[[k for k in df.columns if k != "line_wavelength"]].isna()
+    if blank.to_numpy().any():
+        rows = np.flatnonzero(blank.any(axis=1))
+        raise ValueError(
+            f"Blank values of {sorted(blank.columns[blank.any()])} in the catalog "
+            f"(rows {', '.join(str(i + 1) for i in rows[:10])}"
+            f"{', ...' if len(rows) > 10 else ''})"
+        )
+
+    for t in df["template"].unique():
+        if t != "Flat in frequency" and template_path(t) is None:
+            raise ValueError(f"Unknown template in the catalog: {t}")
+
+    df["row"] = np.arange(len(df))
+
+    return df
+
+
+def group_catalog(df: pd.DataFrame) -> list:
+    keys = [
+        (
+            np.round(np.round(df[k] / bin_widths[k]) * bin_widths[k], 6).rename(k)
+            if k in bin_widths
+            else df[k]
+        )
+        for k in group_columns.keys()
+    ]
+    return [
+        (dict(zip(group_columns.keys(), k)), g)
+        for k, g in df.groupby(keys, sort=False, dropna=False)
+    ]
+
+
+# a spectrum is about 0.4 MB on the template grid
+@lru_cache(maxsize=32)
+def template_mag_offset(
+    template: str, redshift: float, wavelength: float, engine: str = "synphot"
+):
+    # AB mag of the template normalized to 0 mag, which is shifted by the catalog magnitude
+    if template == "Flat in frequency":
+        return None
+    spec = template_engines[engine](
+        template_path(template),
+        redshift=redshift,
+        norm_wavelength=wavelength * u.nm,
+        norm_mag=0.0 * u.ABmag,
+    )
+    if spec is None:
+        raise ValueError(
+            f"Failed at normalizing the template {template} at z={redshift} and {wavelength} nm."
+        )
+    return spec
+
+
+def evaluate_group(
+    df: pd.DataFrame,
+    df_sncont: pd.DataFrame,
+    df_snline: pd.DataFrame,
+    conditions: dict,
+    template_engine: str = "synphot",
+) -> pd.DataFrame:
+    model = NoiseModel.from_sncont(
+        df_sncont, conditions["exp_time"], conditions["exp_num"]
+    )
+    var_bg = model.var_sky + model.var_const
+    arm_masks = {k: model.arm == v for k, v in arm_ids.items()}
+
+    res = {f"sn_{k}": np.full(len(df), np.nan) for k in arm_ids.keys()}
+
+    rows = list(zip(df["template"], df["redshift"], df["wavelength"], df["mag"]))
+
+    for i0 in range(0, len(df), chunk_size):
+        # pixel-wise magnitude offsets from the flat reference spectrum
+        dmag = np.empty((len(rows[i0 : i0 + chunk_size]), model.wavelength.size))
+        for i, (template, redshift, wavelength, mag) in enumerate(
+            rows[i0 : i0 + chunk_size]
+        ):
+            spec = template_mag_offset(
+                template, float(redshift), float(wavelength), engine=template_engine
+            )
+            if spec is None:
+                dmag[i, :] = mag - mag_ref
+            else:
+                dmag[i, :] = (
+                    np.interp(model.wavelength, spec[0], spec[1], left=99.9, right=99.9)
+                    + mag
+                    - mag_ref
+                )
+
+        f = 10 ** (-0.4 * dmag)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            sn = (
+                np.sqrt(model.exp_num)
+                * model.signal
+                * f
+                / np.sqrt(model.var_obj * f + var_bg)
+            )
+        sn = np.where(np.isfinite(sn), sn, 0.0)
+        for k, mask in arm_masks.items():
+            if np.any(mask):
+                res[f"sn_{k}"][i0 : i0 + chunk_size] = np.median(sn[:, mask], axis=1)
+
+    # emission line S/N at the observed wavelength of the line, evaluated only
+    # at the nearest pixel of each row
+    line_wavelength = df["line_wavelength"].to_numpy(dtype=float)
+    has_line = np.isfinite(line_wavelength)
+    wavelength = df_snline["wavelength"].to_numpy()
+    x = np.where(has_line, line_wavelength, wavelength[0])
+    idx = np.searchsorted(wavelength, x).clip(1, len(wavelength) - 1)
+    idx = np.where(x - wavelength[idx - 1] < wavelength[idx] - x, idx - 1, idx)
+
+    res["snline"] = np.full(len(df), np.nan)
+    resolving_power = InstrumentConf(
+        mr_mode=bool(conditions["mr_mode"])
+    ).resolving_power()
+    line_fluxes = df["line_flux"].to_numpy()
+    line_widths = df["line_width"].to_numpy()
+    for i in np.unique(idx[has_line]):
+        rows_i = np.flatnonzero(has_line & (idx == i))
+        snline = rescale_snline(
+            df_snline.iloc[[i]],
+            default_parameters.line_flux,
+            default_parameters.line_width,
+            line_fluxes[rows_i],
+            line_widths[rows_i],
+            exp_time=conditions["exp_time"],
+            exp_num=conditions["exp_num"],
+            resolving_power=resolving_power,
+        )
+        res["snline"][rows_i] = snline["snline_tot"][:, 0]
+
+    return pd.DataFrame({"row": df["row"].to_numpy(), **res})
+
+
+def run_batch_group(
+    conditions: dict,
+    df: pd.DataFrame,
+    output: dict,
+    noise_cache_size: int = None,
+    template_engine: str = "synphot",
+) -> pd.DataFrame:
+    # executed in a worker process: a single ETC run with a flat spectrum per group
+    from .pfs_etc_specsim import PfsSpecSim
+
+    conf_output = OutputConf(**output)
+
+    if noise_cache_size is None:
+        noise_cache = None
+    else:
+        noise_cache = get_noise_cache(
+            basedir=conf_output.basedir, maxsize=noise_cache_size
+        )
+
+    conf_target = TargetConf(
+        template="Flat in frequency",
+        mag=mag_ref,
+        r_eff=float(conditions["r_eff"]),
+        galactic_extinction=float(conditions["galactic_extinction"]),
+    )
+    conf_environment = EnvironmentConf(
+        seeing=float(conditions["seeing"]),
+        degrade=float(conditions["degrade"]),
+        moon_zenith_angle=int(conditions["moon_zenith_angle"]),
+        moon_target_angle=int(conditions["moon_target_angle"]),
+        moon_phase=float(conditions["moon_phase"]),
+    )
+    conf_instrument = InstrumentConf(
+        exp_time=int(conditions["exp_time"]),
+        exp_num=int(conditions["exp_num"]),
+        field_angle=float(conditions["field_angle"]),
+        mr_mode=bool(conditions["mr_mode"]),
+    )
+    conf_telescope = TelescopeConf(zenith_angle=int(conditions["zenith_angle"]))
+
+    specsim = PfsSpecSim(
+        target=conf_target,
+        environment=conf_environment,
+        instrument=conf_instrument,
+        telescope=conf_telescope,
+        output=conf_output,
+        noise_cache=noise_cache,
+    )
+
+    outdir = os.path.join(conf_output.basedir, conf_output.sessiondir)
+    with running_session(conf_output.basedir, conf_output.sessiondir):
+        specsim.run_etc()
+        df_sncont = load_sncont(os.path.join(outdir, conf_output.sn_cont))
+        df_snline = load_snline(os.path.join(outdir, conf_output.sn_line))
+
+    return evaluate_group(
+        df, df_sncont, df_snline, conditions, template_engine=template_engine
+    )
+
+
+def batch_jobs(
+    df: pd.DataFrame,
+    basedir: str = "tmp",
+    batch_id: str = None,
+    noise_cache_size: int = None,
+    template_engine: str = "synphot",
+) -> list:
+    # (fn, args, kwargs) of a job per group of observing conditions
+    if batch_id is None:
+        batch_id = f"batch-{secrets.token_hex(8)}"
+
+    groups = group_catalog(df)
+    logger.info(f"{len(df)} targets in {len(groups)} groups for {batch_id}")
+
+    jobs = []
+    for i, (conditions, df_group) in enumerate(groups):
+        output = OutputConf(
+            basedir=basedir, sessiondir=os.path.join(batch_id, f"group{i:05d}")
+        )
+        jobs.append(
+            (
+                run_batch_group,
+                (conditions, df_group, conf_values(output)),
+                dict(
+                    noise_cache_size=noise_cache_size,
+                    template_engine=template_engine,
+                ),
+            )
+        )
+    return jobs
+
+
+def submit_batch(
+    submit,
+    df: pd.DataFrame,
+    basedir: str = "tmp",
+    batch_id: str = None,
+    noise_cache_size: int = None,
+    template_engine: str = "synphot",
+) -> list:
+    # submit is a callable taking (fn, *args, **kwargs) and returning a future
+    jobs = batch_jobs(
+        df,
+        basedir=basedir,
+        batch_id=batch_id,
+        noise_cache_size=noise_cache_size,
+        template_engine=template_engine,
+    )
+    return [submit(fn, *args, **kwargs) for fn, args, kwargs in jobs]
+
+
+def run_batch(
+    executor,
+    df: pd.DataFrame,
+    basedir: str = "tmp",
+    batch_id: str = None,
+    noise_cache_size: int = None,
+    template_engine: str = "synphot",
+):
+    # yield result tables of groups as they are finished
+    futures = submit_batch(
+        executor.submit,
+        df,
+        basedir=basedir,
+        batch_id=batch_id,
+        noise_cache_size=noise_cache_size,
+        template_engine=template_engine,
+    )
+    for future in as_completed(futures):
+        yield future.result()
+
+
+def write_results(results, outfile: str, df_catalog: pd.DataFrame = None) -> int:
+    # stream result tables into a single CSV file, optionally joined with the input
+    n = 0
+    with open(outfile, "w") as f:
+        for df in results:
+            if df_catalog is not None:
+                df = df_catalog.merge(df, on="row", how="right")
+            df.to_csv(f, header=(n == 0), index=False)
+            n += len(df)
+    return n
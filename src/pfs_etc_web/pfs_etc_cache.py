@@ -0,0 +1,593 @@
+#!/usr/bin/env python3
+
+import atexit
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
+
+import numpy as np
+from loguru import logger
+
+from . import __version__
+from .pfs_etc_sessions import simulation_id_of
+from .pfs_etc_spectemplates import (
+    file_checksum,
+    read_custom_spectrum,
+    template_path,
+    write_mag_file,
+)
+
+# parameters defining a simulation (name of a param.Parameterized attribute)
+target_keys = [
+    "template",
+    "mag",
+    "wavelength",
+    "redshift",
+    "line_flux",
+    "line_width",
+    "line_sn",
+    "galactic_extinction",
+    "r_eff",
+]
+environment_keys = [
+    "seeing",
+    "degrade",
+    "moon_zenith_angle",
+    "moon_target_angle",
+    "moon_phase",
+]
+instrument_keys = ["exp_time", "exp_num", "field_angle", "mr_mode"]
+telescope_keys = ["zenith_angle"]
+
+
+def _canonical_value(v):
+    if isinstance(v, bool) or v is None or isinstance(v, str):
+        return v
+    return float(v)
+
+
+def simulation_key(target, environment, instrument, telescope) -> str:
+    params = {
+        "version": __version__,
+        "target": {k: _canonical_value(getattr(target, k)) for k in target_keys},
+        "environment": {
+            k: _canonical_value(getattr(environment, k)) for k in environment_keys
+        },
+        "instrument": {
+            k: _canonical_value(getattr(instrument, k)) for k in instrument_keys
+        },
+        "telescope": {
+            k: _canonical_value(getattr(telescope, k)) for k in telescope_keys
+        },
+    }
+
+    if target.custom_input is not None:
+        params["custom_input"] = hashlib.sha256(target.custom_input).hexdigest()
+    else:
+        infile = template_path(target.template)
+        params["template_checksum"] = None if infile is None else file_checksum(infile)
+
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf8")).hexdigest()
+
+
+def session_artifacts(basedir: str, sessiondir: str, output) -> list:
+    outdir = os.path.join(basedir, sessiondir)
+    # tables for download are written on request and not required
+    return [
+        os.path.join(outdir, f"{output.simspec}.dat"),
+        os.path.join(outdir, output.sn_line),
+        os.path.join(outdir, output.sn_cont),
+        os.path.join(outdir, output.params),
+        os.path.join(outdir, f"pfsObject-{simulation_id_of(sessiondir)}.fits"),
+    ]
+
+
+class ResultCache:
+    def __init__(
+        self, basedir: str = "tmp", maxsize: int = 1000, flush_interval: float = 60.0
+    ):
+        self.basedir = basedir
+        self.maxsize = maxsize
+        self.index_file = os.path.join(basedir, ".cache", "result_cache.json")
+        # access times of hits are written at most once in this interval
+        self.flush_interval = flush_interval
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._saved = 0.0
+        self._dirty = False
+
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.index_file):
+            return
+        try:
+            with open(self.index_file, "r") as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to read result cache index {self.index_file}: {e}")
+            return
+        # entries are stored from the least to the most recently used
+        for k, v in entries:
+            self._entries[k] = v
+        self._evict()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+        # write to a temporary file first so that a crash never leaves a broken index
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(self.index_file))
+        with os.fdopen(fd, "w") as f:
+            json.dump(list(self._entries.items()), f)
+        os.replace(tmpfile, self.index_file)
+        self._saved = time.time()
+        self._dirty = False
+
+    def _evict(self):
+        while len(self._entries) > self.maxsize:
+            k, v = self._entries.popitem(last=False)
+            logger.info(f"Evict {v['sessiondir']} from the result cache")
+
+    def get(self, key: str, output) -> str or None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not all(
+                os.path.exists(f)
+                for f in session_artifacts(self.basedir, entry["sessiondir"], output)
+            ):
+                logger.warning(
+                    f"Result cache entry for {entry['sessiondir']} is incomplete, removed"
+                )
+                del self._entries[key]
+                self._save()
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                sessiondir = None
+            else:
+                self.hits += 1
+                entry["accessed"] = time.time()
+                self._entries.move_to_end(key)
+                self._dirty = True
+                if entry["accessed"] - self._saved >= self.flush_interval:
+                    self._save()
+                sessiondir = entry["sessiondir"]
+
+            logger.info(f"Result cache: {self.stats()}")
+
+            return sessiondir
+
+    def put(self, key: str, sessiondir: str):
+        with self._lock:
+            now = time.time()
+            self._entries[key] = {
+                "sessiondir": sessiondir,
+                "created": now,
+                "accessed": now,
+            }
+            self._entries.move_to_end(key)
+            self._evict()
+            self._save()
+
+    def flush(self):
+        with self._lock:
+            if self._dirty:
+                self._save()
+
+    def sessions(self) -> set:
+        with self._lock:
+            return {v["sessiondir"] for v in self._entries.values()}
+
+    def stats(self) -> dict:
+        n = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / n if n > 0 else 0.0,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+        }
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def get_result_cache(basedir: str = "tmp", maxsize: int = 1000) -> ResultCache:
+    # shared by all sessions served by the process
+    global _result_cache
+    with _result_cache_lock:
+        if _result_cache is None or _result_cache.basedir != basedir:
+            _result_cache = ResultCache(basedir=basedir, maxsize=maxsize)
+            atexit.register(_result_cache.flush)
+    return _result_cache
+
+
+def noise_key(environment, instrument, telescope) -> str:
+    # the noise vector does not depend on the target properties
+    params = {
+        "version": __version__,
+        "environment": {
+            k: _canonical_value(getattr(environment, k)) for k in environment_keys
+        },
+        "instrument": {
+            k: _canonical_value(getattr(instrument, k)) for k in instrument_keys
+        },
+        "telescope": {
+            k: _canonical_value(getattr(telescope, k)) for k in telescope_keys
+        },
+    }
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf8")).hexdigest()
+
+
+class DownloadCounter:
+    # number of downloads by the kind of output, kept across restarts
+    def __init__(self, basedir: str = "tmp"):
+        self.basedir = basedir
+        self.counts_file = os.path.join(basedir, ".cache", "download_counts.json")
+
+        self._lock = threading.Lock()
+        self._counts = {}
+
+        if os.path.exists(self.counts_file):
+            try:
+                with open(self.counts_file, "r") as f:
+                    self._counts = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.error(f"Failed to read download counts {self.counts_file}: {e}")
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.counts_file), exist_ok=True)
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(self.counts_file))
+        with os.fdopen(fd, "w") as f:
+            json.dump(self._counts, f, indent=2, sort_keys=True)
+        os.replace(tmpfile, self.counts_file)
+
+    def count(self, kind: str, generated: bool):
+        # generated: the file was written for this download
+        with self._lock:
+            counts = self._counts.setdefault(kind, {"downloads": 0, "generated": 0})
+            counts["downloads"] += 1
+            if generated:
+                counts["generated"] += 1
+            try:
+                self._save()
+            except OSError as e:
+                logger.error(f"Failed to write download counts {self.counts_file}: {e}")
+        logger.info(f"Download counts: {self.stats()}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {k: dict(v) for k, v in self._counts.items()}
+
+
+_download_counter = None
+
+
+def get_download_counter(basedir: str = "tmp") -> DownloadCounter:
+    global _download_counter
+    with _result_cache_lock:
+        if _download_counter is None or _download_counter.basedir != basedir:
+            _download_counter = DownloadCounter(basedir=basedir)
+    return _download_counter
+
+
+class NoiseCache:
+    def __init__(self, basedir: str = "tmp", maxsize: int = 1000):
+        self.basedir = basedir
+        self.maxsize = maxsize
+        self.cachedir = os.path.join(basedir, ".cache", "noise")
+
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self.cachedir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cachedir, f"{key}.dat")
+
+    def _evict(self):
+        entries = [e for e in os.scandir(self.cachedir) if e.name.endswith(".dat")]
+        if len(entries) <= self.maxsize:
+            return
+        # access time is refreshed by get(), so the oldest mtime is the least recently used
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        for e in entries[: len(entries) - self.maxsize]:
+            try:
+                os.remove(e.path)
+            except FileNotFoundError:
+                pass
+
+    def get(self, key: str) -> str or None:
+        noisefile = self._path(key)
+        if os.path.exists(noisefile):
+            self.hits += 1
+            os.utime(noisefile)
+        else:
+            self.misses += 1
+            noisefile = None
+
+        logger.info(f"Noise cache: {self.stats()}")
+
+        return noisefile
+
+    def put(self, key: str, noisefile: str):
+        # copy via a temporary file as other processes may read the cache at the same time
+        fd, tmpfile = tempfile.mkstemp(dir=self.cachedir)
+        with os.fdopen(fd, "wb") as fout, open(noisefile, "rb") as fin:
+            shutil.copyfileobj(fin, fout)
+        os.replace(tmpfile, self._path(key))
+        self._evict()
+
+    def stats(self) -> dict:
+        n = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / n if n > 0 else 0.0,
+        }
+
+
+_noise_cache = None
+
+
+def get_noise_cache(basedir: str = "tmp", maxsize: int = 1000) -> NoiseCache:
+    global _noise_cache
+    with _result_cache_lock:
+        if _noise_cache is None or _noise_cache.basedir != basedir:
+            _noise_cache = NoiseCache(basedir=basedir, maxsize=maxsize)
+    return _noise_cache
+
+
+def spectrum_key(infile: str, **kwargs) -> str:
+    # kwargs are the redshift and normalization passed to prepare_spectrum_arrays
+    params = {
+        "version": __version__,
+        "template_checksum": file_checksum(infile),
+        **{
+            k: _canonical_value(getattr(v, "value", v))
+            for k, v in sorted(kwargs.items())
+        },
+    }
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf8")).hexdigest()
+
+
+class SpectrumCache:
+    # Prepared (wavelength, ABmag) arrays of template spectra with a memory tier
+    # in front of a directory shared by worker processes. A failed normalization
+    # is cached as False so that it is not recomputed either.
+    def __init__(
+        self, basedir: str = "tmp", maxsize: int = 256, disk_maxsize: int = 10000
+    ):
+        self.basedir = basedir
+        self.maxsize = maxsize
+        self.disk_maxsize = disk_maxsize
+        self.cachedir = os.path.join(basedir, ".cache", "spectrum")
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+        os.makedirs(self.cachedir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cachedir, f"{key}.npz")
+
+    def key(self, infile: str, **kwargs) -> str:
+        return spectrum_key(infile, **kwargs)
+
+    def _put_memory(self, key: str, spec):
+        with self._lock:
+            self._entries[key] = spec
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _evict(self):
+        entries = [e for e in os.scandir(self.cachedir) if e.name.endswith(".npz")]
+        if len(entries) <= self.disk_maxsize:
+            return
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        for e in entries[: len(entries) - self.disk_maxsize]:
+            try:
+                os.remove(e.path)
+            except FileNotFoundError:
+                pass
+
+    def get(self, key: str):
+        # None for a miss, False for a failed normalization, otherwise (wave, mag)
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        cachefile = self._path(key)
+        try:
+            with np.load(cachefile) as data:
+                if data["wave"].size == 0:
+                    spec = False
+                else:
+                    wave, mag = data["wave"], data["mag"]
+                    wave.setflags(write=False)
+                    mag.setflags(write=False)
+                    spec = (wave, mag)
+            os.utime(cachefile)
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.disk_hits += 1
+        self._put_memory(key, spec)
+
+        return spec
+
+    def put(self, key: str, spec):
+        if spec is None or spec is False:
+            spec = False
+            wave, mag = np.empty(0), np.empty(0)
+        else:
+            wave = np.array(spec[0], dtype=float)
+            mag = np.array(spec[1], dtype=float)
+            wave.setflags(write=False)
+            mag.setflags(write=False)
+            spec = (wave, mag)
+
+        self._put_memory(key, spec)
+
+        # other processes may read the cache at the same time
+        fd, tmpfile = tempfile.mkstemp(dir=self.cachedir)
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, wave=wave, mag=mag)
+        os.replace(tmpfile, self._path(key))
+        self._evict()
+
+    def stats(self) -> dict:
+        n = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / n if n > 0 else 0.0,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "disk_maxsize": self.disk_maxsize,
+        }
+
+
+_spectrum_cache = None
+
+
+def get_spectrum_cache(
+    basedir: str = "tmp", maxsize: int = 256, disk_maxsize: int = 10000
+) -> SpectrumCache:
+    global _spectrum_cache
+    with _result_cache_lock:
+        if _spectrum_cache is None or _spectrum_cache.basedir != basedir:
+            _spectrum_cache = SpectrumCache(
+                basedir=basedir, maxsize=maxsize, disk_maxsize=disk_maxsize
+            )
+    return _spectrum_cache
+
+
+class CustomInputStore:
+    # Custom input spectra stored once by the hash of their content together with
+    # the prepared magnitude file, so that the same upload is parsed only once.
+    def __init__(self, basedir: str = "tmp", maxsize: int = 100):
+        self.basedir = basedir
+        self.maxsize = maxsize
+        self.storedir = os.path.join(basedir, ".cache", "custom_input")
+
+        os.makedirs(self.storedir, exist_ok=True)
+
+    def key(self, data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def raw_file(self, key: str) -> str:
+        return os.path.join(self.storedir, f"{key}.csv")
+
+    def _mag_file(self, key: str) -> str:
+        return os.path.join(self.storedir, f"{key}.txt")
+
+    def _evict(self):
+        entries = [e for e in os.scandir(self.storedir) if e.name.endswith(".txt")]
+        if len(entries) <= self.maxsize:
+            return
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        for e in entries[: len(entries) - self.maxsize]:
+            for f in [e.path, self.raw_file(e.name[:-4])]:
+                try:
+                    os.remove(f)
+                except FileNotFoundError:
+                    pass
+
+    def put(self, data: bytes) -> str:
+        key = self.key(data)
+        magfile = self._mag_file(key)
+
+        # an entry is complete with both files, either of which may have been
+        # removed by another process
+        if os.path.exists(self.raw_file(key)):
+            try:
+                os.utime(magfile)
+                logger.info(f"Reuse custom input spectrum {key}")
+                return key
+            except FileNotFoundError:
+                pass
+
+        # raises ValueError for an invalid input before anything is stored
+        wave, mag = read_custom_spectrum(BytesIO(data))
+
+        # write to temporary files first as other processes may read the store;
+        # the magnitude file comes last as its presence marks a complete entry
+        fd_raw, tmpfile_raw = tempfile.mkstemp(dir=self.storedir)
+        fd_mag, tmpfile_mag = tempfile.mkstemp(dir=self.storedir)
+        os.close(fd_mag)
+        try:
+            with os.fdopen(fd_raw, "wb") as f:
+                f.write(data)
+            write_mag_file(tmpfile_mag, wave, mag)
+            os.replace(tmpfile_raw, self.raw_file(key))
+            os.replace(tmpfile_mag, magfile)
+        finally:
+            # left over when the entry could not be written
+            for f in [tmpfile_raw, tmpfile_mag]:
+                try:
+                    os.remove(f)
+                except FileNotFoundError:
+                    pass
+
+        self._evict()
+
+        return key
+
+    def mag_file(self, data: bytes) -> str:
+        return self._mag_file(self.put(data))
+
+    def link_raw_file(self, data: bytes, outfile: str):
+        # a hard link shares the stored copy; fall back to a copy across file systems
+        key = self.put(data)
+        if os.path.exists(outfile):
+            os.remove(outfile)
+        try:
+            os.link(self.raw_file(key), outfile)
+            return
+        except FileNotFoundError:
+            pass
+        except OSError:
+            try:
+                shutil.copyfile(self.raw_file(key), outfile)
+                return
+            except FileNotFoundError:
+                pass
+        # evicted by another process after put()
+        with open(outfile, "wb") as f:
+            f.write(data)
+
+
+_custom_input_store = None
+
+
+def get_custom_input_store(
+    basedir: str = "tmp", maxsize: int = 100
+) -> CustomInputStore:
+    global _custom_input_store
+    with _result_cache_lock:
+        if _custom_input_store is None or _custom_input_store.basedir != basedir:
+            _custom_input_store = CustomInputStore(basedir=basedir, maxsize=maxsize)
+    return _custom_input_store
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+import datetime
+import importlib.util
+import os
+import re
+import secrets
+import tempfile
+
+import pandas as pd
+import param
+from loguru import logger
+
+from .pfs_etc_cache import (
+    environment_keys,
+    instrument_keys,
+    target_keys,
+    telescope_keys,
+)
+from .pfs_etc_params import EnvironmentConf, InstrumentConf, TargetConf, TelescopeConf
+from .pfs_etc_utils import manifest_tables
+
+# Results of all simulations in Parquet files, one per simulation and table,
+#   <root>/<table>/date=<YYYYmmdd>/<simulation ID>.parquet
+# where the tables are the ones in the manifest of a session. Each row is a
+# pixel (or a wavelength of the line S/N) along with the simulation ID and the
+# parameters as "<group>.<name>" columns, e.g., "environment.seeing". Files of
+# a day are merged into one by compact_results() so that scans do not open a
+# file per simulation. pyarrow is an optional dependency.
+
+param_groups = {
+    "target": (TargetConf, target_keys),
+    "environment": (EnvironmentConf, environment_keys),
+    "instrument": (InstrumentConf, instrument_keys),
+    "telescope": (TelescopeConf, telescope_keys),
+}
+
+# date of a simulation from its ID, also for IDs of older versions
+date_pattern = re.compile(r"^(\d{8})-\d{6}[-_]")
+
+
+def has_pyarrow() -> bool:
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+def _require_pyarrow():
+    if not has_pyarrow():
+        raise ImportError(
+            "pyarrow is required for the result dataset: pip install pyarrow"
+        )
+
+
+def _cast(p, v):
+    # the same type in all files, e.g., a magnitude given as an integer
+    if isinstance(p, param.Boolean):
+        return bool(v)
+    if isinstance(p, param.Integer):
+        return int(v)
+    if isinstance(p, param.Number):
+        return float(v)
+    return str(v)
+
+
+def param_columns(params: dict) -> dict:
+    # params: as written by PfsSpecSim.simulation_params()
+    columns = {}
+    for group, (conf, keys) in param_groups.items():
+        for k in keys:
+            columns[f"{group}.{k}"] = _cast(conf.param[k], params[group][k])
+    columns["custom_input"] = bool(params["custom_input"])
+    return columns
+
+
+def _partition(simulation_id: str) -> str:
+    m = date_pattern.match(simulation_id)
+    if m is None:
+        return datetime.date.today().strftime("%Y%m%d")
+    return m.group(1)
+
+
+def append_result(root: str, simulation_id: str, params: dict, data: tuple):
+    # data: (df_simspec, df_snline, df_sncont)
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    columns = {"simulation_id": simulation_id, **param_columns(params)}
+    partition = f"date={_partition(simulation_id)}"
+
+    for table, df in zip(manifest_tables.keys(), data):
+        outdir = os.path.join(root, table, partition)
+        os.makedirs(outdir, exist_ok=True)
+        tb = pa.Table.from_pandas(df.assign(**columns), preserve_index=False)
+        # files starting with "." are not read until they are complete
+        fd, tmpfile = tempfile.mkstemp(prefix=".", dir=outdir)
+        with os.fdopen(fd, "wb") as f:
+            pq.write_table(tb, f)
+        os.chmod(tmpfile, 0o644)
+        os.replace(tmpfile, os.path.join(outdir, f"{simulation_id}.parquet"))
+
+    logger.info(f"Results of {simulation_id} added to the dataset in {root}")
+
+
+def compact_partition(partition_dir: str) -> int:
+    # merge the files of a partition into one, a file at a time; files added
+    # in the meantime are left for the next compaction
+    import pyarrow.parquet as pq
+
+    infiles = sorted(
+        os.path.join(partition_dir, f)
+        for f in os.listdir(partition_dir)
+        if f.endswith(".parquet") and not f.startswith(".")
+    )
+    if len(infiles) < 2:
+        return 0
+
+    fd, tmpfile = tempfile.mkstemp(prefix=".", dir=partition_dir)
+    os.close(fd)
+    try:
+        writer = None
+        for infile in infiles:
+            tb = pq.ParquetFile(infile).read()
+            if writer is None:
+                writer = pq.ParquetWriter(tmpfile, tb.schema)
+            writer.write_table(tb.cast(writer.schema))
+        writer.close()
+    except Exception:
+        os.remove(tmpfile)
+        raise
+    os.chmod(tmpfile, 0o644)
+
+    # a scan at this moment may read the rows twice
+    os.replace(
+        tmpfile, os.path.join(partition_dir, f"part-{secrets.token_hex(8)}.parquet")
+    )
+    for infile in infiles:
+        os.remove(infile)
+
+    return len(infiles)
+
+
+def compact_results(root: str, before: str = None) -> dict:
+    # before: partitions of days before this date (YYYYmmdd) are compacted,
+    # today by default as files of the day are still being added
+    _require_pyarrow()
+
+    if before is None:
+        before = datetime.date.today().strftime("%Y%m%d")
+
+    stats = {"partitions": 0, "files": 0}
+    for table in manifest_tables.keys():
+        tabledir = os.path.join(root, table)
+        if not os.path.isdir(tabledir):
+            continue
+        for partition in sorted(os.listdir(tabledir)):
+            if not partition.startswith("date=") or partition[5:] >= before:
+                continue
+            try:
+                n = compact_partition(os.path.join(tabledir, partition))
+            except (OSError, ValueError, TypeError) as e:
+                logger.error(f"Failed to compact {table}/{partition}: {e}")
+                continue
+            if n > 0:
+                logger.info(f"{n} files merged in {table}/{partition}")
+                stats["partitions"] += 1
+                stats["files"] += n
+
+    logger.info(f"Result dataset compaction: {stats}")
+
+    return stats
+
+
+def open_results(root: str, table: str = "sncont"):
+    # a pyarrow dataset of a table, e.g., to scan it in batches
+    _require_pyarrow()
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    if table not in manifest_tables.keys():
+        raise ValueError(f"Unknown table: {table}")
+
+    return ds.dataset(
+        os.path.join(root, table),
+        format="parquet",
+        partitioning=ds.partitioning(pa.schema([("date", pa.string())]), flavor="hive"),
+    )
+
+
+def query_results(
+    root: str,
+    table: str = "sncont",
+    filters=None,
+    columns: list = None,
+) -> pd.DataFrame:
+    # filters: a pyarrow expression or a list of (column, op, value) tuples as
+    # in pandas.read_parquet, e.g., [("environment.seeing", "==", 0.8),
+    # ("arm", "==", 1)]; they are applied while the files are scanned, and
+    # files of other dates are skipped by a filter on "date"
+    _require_pyarrow()
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    if filters is not None and not isinstance(filters, ds.Expression):
+        filters = pq.filters_to_expression(filters)
+
+    return (
+        open_results(root, table).to_table(columns=columns, filter=filters).to_pandas()
+    )
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+
+import math
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+from loguru import logger
+
+from .pfs_etc_cache import (
+    get_custom_input_store,
+    get_noise_cache,
+    get_spectrum_cache,
+)
+from .pfs_etc_dataset import append_result
+from .pfs_etc_params import (
+    EnvironmentConf,
+    InstrumentConf,
+    OutputConf,
+    TargetConf,
+    TelescopeConf,
+    conf_values,
+)
+from .pfs_etc_retention import running_session
+from .pfs_etc_sessions import get_simulation_index, session_size, simulation_id_of
+from .pfs_etc_spectemplates import load_templates
+
+
+def omp_num_threads() -> int:
+    if os.environ.get("OMP_NUM_THREADS") is not None:
+        return int(os.environ.get("OMP_NUM_THREADS"))
+    else:
+        return 4
+
+
+def default_max_workers() -> int:
+    # each ETC run already uses OMP_NUM_THREADS cores
+    return max(1, (os.cpu_count() or 1) // omp_num_threads())
+
+
+def run_simulation(
+    target: dict,
+    environment: dict,
+    instrument: dict,
+    telescope: dict,
+    output: dict,
+    noise_cache_size: int = None,
+    spectrum_cache_size: int = None,
+    spectrum_disk_cache_size: int = 10000,
+    template_engine: str = "synphot",
+    custom_input_cache_size: int = None,
+    result_dataset: str = None,
+) -> dict:
+    # executed in a worker process, so configurations are passed as plain values
+    from .pfs_etc_specsim import PfsSpecSim
+
+    conf_output = OutputConf(**output)
+
+    if noise_cache_size is None:
+        noise_cache = None
+    else:
+        noise_cache = get_noise_cache(
+            basedir=conf_output.basedir, maxsize=noise_cache_size
+        )
+
+    if spectrum_cache_size is None:
+        spectrum_cache = None
+    else:
+        spectrum_cache = get_spectrum_cache(
+            basedir=conf_output.basedir,
+            maxsize=spectrum_cache_size,
+            disk_maxsize=spectrum_disk_cache_size,
+        )
+
+    if custom_input_cache_size is None:
+        custom_store = None
+    else:
+        custom_store = get_custom_input_store(
+            basedir=conf_output.basedir, maxsize=custom_input_cache_size
+        )
+
+    specsim = PfsSpecSim(
+        target=TargetConf(**target),
+        environment=EnvironmentConf(**environment),
+        instrument=InstrumentConf(**instrument),
+        telescope=TelescopeConf(**telescope),
+        output=conf_output,
+        noise_cache=noise_cache,
+        spectrum_cache=spectrum_cache,
+        template_engine=template_engine,
+        custom_store=custom_store,
+    )
+
+    logger.info(f"Running PFS Spectrum Simulator for {conf_output.sessiondir}")
+    # outputs of running simulations are never removed by the retention
+    with running_session(conf_output.basedir, conf_output.sessiondir):
+        specsim.exec(skip=False)
+        params = specsim.write_params()
+        specsim.rename_pfsobject()
+        data = specsim.load()
+        specsim.write_manifest(data)
+
+        if result_dataset is not None:
+            # a failure only affects the analytics, not the session
+            try:
+                append_result(
+                    result_dataset,
+                    simulation_id_of(conf_output.sessiondir),
+                    params,
+                    data,
+                )
+            except (ImportError, OSError, TypeError, ValueError) as e:
+                logger.error(f"Failed to add results to {result_dataset}: {e}")
+
+        # the simulation can be found by its ID without listing the directories
+        get_simulation_index(conf_output.basedir).add(
+            simulation_id_of(conf_output.sessiondir),
+            conf_output.sessiondir,
+            params=params,
+            size=session_size(
+                os.path.join(conf_output.basedir, conf_output.sessiondir)
+            ),
+        )
+
+    # results are handed to the session as arrays; tables for download are
+    # written only when requested
+    return {
+        "sessiondir": conf_output.sessiondir,
+        "noise_reused": specsim.noise_reused,
+        "data": data,
+    }
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor(max_workers: int = None) -> ProcessPoolExecutor:
+    # a single pool is shared by all sessions served by the process
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            if max_workers is None:
+                max_workers = default_max_workers()
+            logger.info(f"Start a process pool with {max_workers} workers")
+            # forking a process running the Bokeh server is not safe
+            _executor = ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=load_templates,
+            )
+    return _executor
+
+
+_writer_pool = None
+
+
+def get_writer_pool(max_workers: int = 4) -> ThreadPoolExecutor:
+    # threads writing files for download outside the event loop of the server
+    global _writer_pool
+    with _executor_lock:
+        if _writer_pool is None:
+            _writer_pool = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="writer"
+            )
+    return _writer_pool
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, session: str, fn, args, kwargs):
+        self.session = session
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+
+        # resolved with the result of the pool future once the job is dispatched
+        self.future = Future()
+        self.submitted = time.time()
+        self.started = None
+
+    def cancel(self) -> bool:
+        return self.future.cancel()
+
+
+class JobQueue:
+    def __init__(self, executor, max_running: int = None, max_queued: int = 20):
+        self.executor = executor
+        self.max_running = default_max_workers() if max_running is None else max_running
+        self.max_queued = max_queued
+
+        # initial guess of a single run, updated with the measured duration
+        self.mean_duration = 30.0
+
+        # reentrant as a done callback is called immediately for a finished future
+        self._lock = threading.RLock()
+        # waiting jobs per session
+        self._waiting = OrderedDict()
+        self._running = set()
+        # sessions in the order they were last served
+        self._served = OrderedDict()
+
+    def _n_waiting(self) -> int:
+        return sum(len(q) for q in self._waiting.values())
+
+    def _order(self) -> list:
+        # dispatch order of waiting jobs; the session with the fewest jobs
+        # in progress goes first and ties are served in a round-robin manner,
+        # i.e., the session served least recently goes first
+        n_jobs = {}
+        for job in self._running:
+            n_jobs[job.session] = n_jobs.get(job.session, 0) + 1
+        served = {k: i for i, k in enumerate(self._served)}
+        turn = len(served)
+        queues = OrderedDict((k, deque(q)) for k, q in self._waiting.items())
+        order = []
+        while len(queues) > 0:
+            session = min(
+                queues.keys(), key=lambda k: (n_jobs.get(k, 0), served.get(k, -1))
+            )
+            order.append(queues[session].popleft())
+            n_jobs[session] = n_jobs.get(session, 0) + 1
+            served[session] = turn
+            turn += 1
+            q = queues.pop(session)
+            if len(q) > 0:
+                queues[session] = q
+        return order
+
+    def submit(self, session: str, fn, *args, **kwargs) -> Job:
+        with self._lock:
+            if self._n_waiting() >= self.max_queued:
+                raise QueueFullError(
+                    "The simulator is busy with other requests. Please try again later."
+                )
+            job = Job(session, fn, args, kwargs)
+            self._waiting.setdefault(session, deque()).append(job)
+            self._dispatch()
+        return job
+
+    def _dispatch(self):
+        while len(self._running) < self.max_running and len(self._waiting) > 0:
+            job = self._order()[0]
+            q = self._waiting.pop(job.session)
+            q.remove(job)
+            # move the session to the end to give other sessions a turn
+            if len(q) > 0:
+                self._waiting[job.session] = q
+
+            if not job.future.set_running_or_notify_cancel():
+                continue
+
+            job.started = time.time()
+            self._running.add(job)
+            self._served[job.session] = True
+            self._served.move_to_end(job.session)
+            try:
+                pool_future = self.executor.submit(job.fn, *job.args, **job.kwargs)
+            except RuntimeError as e:
+                # e.g., BrokenProcessPool or the pool has been shut down
+                self._running.discard(job)
+                job.future.set_exception(e)
+                continue
+            pool_future.add_done_callback(lambda f, job=job: self._on_done(job, f))
+
+    def _on_done(self, job: Job, pool_future):
+        with self._lock:
+            self._running.discard(job)
+            self._forget(job.session)
+            self.mean_duration = 0.8 * self.mean_duration + 0.2 * (
+                time.time() - job.started
+            )
+            self._dispatch()
+
+        if pool_future.cancelled():
+            job.future.cancel()
+        elif pool_future.exception() is not None:
+            job.future.set_exception(pool_future.exception())
+        else:
+            job.future.set_result(pool_future.result())
+
+    def _forget(self, session: str):
+        # nothing left of the session to be ordered
+        if session not in self._waiting and not any(
+            job.session == session for job in self._running
+        ):
+            self._served.pop(session, None)
+
+    def cancel_session(self, session: str):
+        with self._lock:
+            for job in self._waiting.pop(session, []):
+                job.cancel()
+            self._forget(session)
+
+    def status(self, job: Job) -> dict:
+        with self._lock:
+            if job.started is not None:
+                return {
+                    "position": 0,
+                    "eta": max(self.mean_duration - (time.time() - job.started), 0.0),
+                }
+            order = [j for j in self._order() if not j.future.cancelled()]
+            if job not in order:
+                return {"position": None, "eta": None}
+            position = order.index(job) + 1
+            return {
+                "position": position,
+                # time to wait for a free worker plus the run itself
+                "eta": (math.ceil(position / self.max_running) + 1)
+                * self.mean_duration,
+            }
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "running": len(self._running),
+                "waiting": self._n_waiting(),
+                "max_running": self.max_running,
+                "max_queued": self.max_queued,
+                "mean_duration": self.mean_duration,
+            }
+
+
+_job_queue = None
+
+
+def get_job_queue(max_workers: int = None, max_queued: int = 20) -> JobQueue:
+    global _job_queue
+    executor = get_executor(max_workers=max_workers)
+    with _executor_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue(
+                executor, max_running=max_workers, max_queued=max_queued
+            )
+    return _job_queue
+
+
+def cancel_session_jobs(session: str):
+    if _job_queue is not None:
+        _job_queue.cancel_session(session)
+
+
+def submit_simulation(
+    session: str,
+    conf_target,
+    conf_environment,
+    conf_instrument,
+    conf_telescope,
+    conf_output,
+    noise_cache_size: int = None,
+    spectrum_cache_size: int = None,
+    spectrum_disk_cache_size: int = 10000,
+    template_engine: str = "synphot",
+    custom_input_cache_size: int = None,
+    max_workers: int = None,
+    max_queued: int = 20,
+    result_dataset: str = None,
+) -> Job:
+    return get_job_queue(max_workers=max_workers, max_queued=max_queued).submit(
+        session,
+        run_simulation,
+        conf_values(conf_target),
+        conf_values(conf_environment),
+        conf_values(conf_instrument),
+        conf_values(conf_telescope),
+        conf_values(conf_output),
+        noise_cache_size=noise_cache_size,
+        spectrum_cache_size=spectrum_cache_size,
+        spectrum_disk_cache_size=spectrum_disk_cache_size,
+        template_engine=template_engine,
+        custom_input_cache_size=custom_input_cache_size,
+        result_dataset=result_dataset,
+    )
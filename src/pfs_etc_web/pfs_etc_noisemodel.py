@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+
+import os
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from .pfs_etc_params import InstrumentConf
+from .pfs_etc_utils import load_sncont
+
+arm_ids = {"b": 0, "r": 1, "n": 2, "m": 3}
+
+
+@dataclass(frozen=True)
+class NoiseModel:
+    # Per-pixel terms of a finished ETC run scaled to a single exposure of exp_time.
+    # The noise variance is decomposed into the object shot noise and the sky
+    # (both proportional to the exposure time) and the remaining constant part
+    # (read noise), which is all we need to predict S/N for other exposures.
+    arm: np.ndarray
+    pixel: np.ndarray
+    wavelength: np.ndarray
+    signal: np.ndarray
+    var_obj: np.ndarray
+    var_sky: np.ndarray
+    var_const: np.ndarray
+    exp_time: float
+    exp_num: int
+
+    @classmethod
+    def from_sncont(cls, df_sncont: pd.DataFrame, exp_time: float, exp_num: int):
+        signal = df_sncont["signal_per_exp"].to_numpy()
+        var_wo_obj = df_sncont["noise_wo_obj_per_exp"].to_numpy() ** 2
+        var_w_obj = df_sncont["noise_w_obj_per_exp"].to_numpy() ** 2
+        var_sky = np.clip(df_sncont["sky"].to_numpy(), 0.0, var_wo_obj)
+
+        return cls(
+            arm=df_sncont["arm"].to_numpy(),
+            pixel=df_sncont["pixel"].to_numpy(),
+            wavelength=df_sncont["wavelength"].to_numpy(),
+            signal=signal,
+            var_obj=np.clip(var_w_obj - var_wo_obj, 0.0, None),
+            var_sky=var_sky,
+            var_const=var_wo_obj - var_sky,
+            exp_time=float(exp_time),
+            exp_num=int(exp_num),
+        )
+
+    @classmethod
+    def from_file(cls, infile: str, exp_time: float, exp_num: int):
+        return cls.from_sncont(load_sncont(infile), exp_time, exp_num)
+
+    @classmethod
+    def from_specsim(cls, specsim):
+        # a finished session of PfsSpecSim
+        outdir = os.path.join(specsim.output.basedir, specsim.output.sessiondir)
+        return cls.from_file(
+            os.path.join(outdir, specsim.output.sn_cont),
+            specsim.instrument.exp_time,
+            specsim.instrument.exp_num,
+        )
+
+    def select(self, arm: str = None, wavelength: float = None):
+        # boolean mask of pixels in an arm or the single pixel closest to a wavelength
+        mask = np.ones(self.wavelength.size, dtype=bool)
+        if arm is not None:
+            mask &= self.arm == arm_ids[arm]
+        if wavelength is not None:
+            dist = np.where(mask, np.abs(self.wavelength - wavelength), np.inf)
+            mask = np.zeros_like(mask)
+            mask[np.argmin(dist)] = True
+        return mask
+
+
+def sn_curve(model: NoiseModel, exp_time, exp_num=1, mask=None) -> np.ndarray:
+    # exp_time and exp_num are broadcast against each other and the returned S/N
+    # has the broadcast shape plus a trailing axis for pixels
+    exp_time = np.asarray(exp_time, dtype=float)[..., np.newaxis]
+    exp_num = np.asarray(exp_num, dtype=float)[..., np.newaxis]
+
+    if mask is None:
+        mask = slice(None)
+
+    f = exp_time / model.exp_time
+    signal = model.signal[mask] * f
+    var = (model.var_obj[mask] + model.var_sky[mask]) * f + model.var_const[mask]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sn = np.sqrt(exp_num) * signal / np.sqrt(var)
+
+    return np.where(var > 0, sn, 0.0)
+
+
+def solve_exptime(
+    model: NoiseModel,
+    sn: float,
+    wavelength: float = None,
+    arm: str = None,
+    exp_num: int = 1,
+    statistic=np.nanmedian,
+    tmax: float = 1e6,
+    rtol: float = 1e-4,
+) -> float:
+    # single exposure time to reach the S/N at a wavelength or for a statistic
+    # over an arm; np.inf is returned if it cannot be reached within tmax seconds
+    mask = model.select(arm=arm, wavelength=wavelength)
+
+    if wavelength is not None:
+        # closed-form solution of sqrt(n) a t / sqrt(b t + c) = sn for a single pixel
+        a = model.signal[mask][0] / model.exp_time
+        b = (model.var_obj[mask][0] + model.var_sky[mask][0]) / model.exp_time
+        c = model.var_const[mask][0]
+        if a <= 0:
+            return np.inf
+        k = sn**2 / exp_num
+        t = (k * b + np.sqrt((k * b) ** 2 + 4 * a**2 * k * c)) / (2 * a**2)
+        return t if t <= tmax else np.inf
+
+    def f(t):
+        return statistic(sn_curve(model, t, exp_num, mask=mask)) - sn
+
+    if f(tmax) < 0:
+        return np.inf
+
+    # S/N increases monotonically with the exposure time, so bisect in log space
+    tlo, thi = 1e-3, tmax
+    while thi / tlo - 1 > rtol:
+        tmid = np.sqrt(tlo * thi)
+        if f(tmid) < 0:
+            tlo = tmid
+        else:
+            thi = tmid
+
+    return thi
+
+
+def rescale_magnitude(
+    df_simspec: pd.DataFrame, df_sncont: pd.DataFrame, mag0: float, mags
+) -> dict:
+    # Continuum S/N and simulated spectrum for other normalization magnitudes.
+    # Only the object signal (and its shot noise) scales with the magnitude,
+    # so the arrays have shape (len(mags), number of pixels).
+    mags = np.atleast_1d(np.asarray(mags, dtype=float))
+    f = 10 ** (-0.4 * (mags - mag0))[:, np.newaxis]
+
+    var_wo_obj = df_sncont["noise_wo_obj_per_exp"].to_numpy() ** 2
+    var_w_obj = df_sncont["noise_w_obj_per_exp"].to_numpy() ** 2
+    var_obj = np.clip(var_w_obj - var_wo_obj, 0.0, None)
+    sncont = df_sncont["sncont"].to_numpy()
+    input_spec = df_sncont["input_spec"].to_numpy()
+
+    flux = df_simspec["flux"].to_numpy()
+    error = df_simspec["error"].to_numpy()
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        noise_ratio = np.sqrt((var_obj * f + var_wo_obj) / var_w_obj)
+        sncont_new = sncont * f / noise_ratio
+    noise_ratio = np.where(var_w_obj > 0, noise_ratio, 1.0)
+    sncont_new = np.where(var_w_obj > 0, sncont_new, 0.0)
+
+    # expected flux is S/N x error; the random part is scaled with the error
+    flux_model = sncont * error
+    error_new = error * noise_ratio
+    flux_new = flux_model * f + (flux - flux_model) * noise_ratio
+
+    # zero means no input spectrum at the pixel
+    input_spec_new = np.where(
+        input_spec == 0.0, 0.0, input_spec + (mags - mag0)[:, np.newaxis]
+    )
+
+    return {
+        "mag": mags,
+        "sncont": sncont_new,
+        "flux": flux_new,
+        "error": error_new,
+        "input_spec": input_spec_new,
+    }
+
+
+def rescaled_dataframes(
+    df_simspec: pd.DataFrame, df_sncont: pd.DataFrame, mag0: float, mag: float
+):
+    # copies of the loaded tables for a single magnitude, e.g., for plotting
+    res = rescale_magnitude(df_simspec, df_sncont, mag0, [mag])
+
+    df_simspec_new = df_simspec.copy()
+    df_simspec_new["flux"] = res["flux"][0]
+    df_simspec_new["error"] = res["error"][0]
+
+    df_sncont_new = df_sncont.copy()
+    df_sncont_new["sncont"] = res["sncont"][0]
+    df_sncont_new["input_spec"] = res["input_spec"][0]
+
+    return df_simspec_new, df_sncont_new
+
+
+# h * c in erg nm
+hc = 1.98644586e-9
+# speed of light in km/s
+c_kms = 2.99792458e5
+
+
+def rescale_snline(
+    df_snline: pd.DataFrame,
+    line_flux0: float,
+    line_width0: float,
+    line_fluxes,
+    line_widths=None,
+    exp_time: float = 900.0,
+    exp_num: int = 1,
+    resolving_power: dict = None,
+) -> dict:
+    # Emission line S/N for other line fluxes (and widths) from a finished run.
+    # The line signal scales with the flux and the background noise with the
+    # square root of the line width in pixels (intrinsic and instrumental widths
+    # added in quadrature, the latter from the resolving power of each arm as
+    # given by InstrumentConf.resolving_power()).
+    #
+    # This is an approximation: the ETC does not output the variance of the
+    # line photons, so the fraction q of the variance coming from them is
+    # derived from the total S/N and the expected number of line photons
+    # (S/N^2 = N^2 / (N + B), so q = N / (N + B) = (S/N)^2 / N) and the same
+    # fraction is applied to every arm.
+    if resolving_power is None:
+        resolving_power = InstrumentConf().resolving_power()
+
+    line_fluxes = np.atleast_1d(np.asarray(line_fluxes, dtype=float))
+    if line_widths is None:
+        line_widths = np.full_like(line_fluxes, line_width0)
+    line_fluxes, line_widths = np.broadcast_arrays(
+        line_fluxes, np.atleast_1d(np.asarray(line_widths, dtype=float))
+    )
+    r = (line_fluxes / line_flux0)[:, np.newaxis]
+
+    wavelength = df_snline["wavelength"].to_numpy()
+    snline_tot = df_snline["snline_tot"].to_numpy()
+
+    # expected number of line photons for the original line flux
+    n_photon = (
+        line_flux0
+        * df_snline["effective_collecting_area"].to_numpy()
+        * 1e4
+        * df_snline["fiber_aperture_factor"].to_numpy()
+        * exp_time
+        * exp_num
+        / (hc / wavelength)
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        q = np.where(n_photon > 0, snline_tot**2 / n_photon, 0.0)
+    q = np.clip(q, 0.0, 1.0)
+
+    res = {"line_flux": line_fluxes, "line_width": line_widths}
+    sn2_tot0, sn2_tot = 0.0, 0.0
+    for arm in ["b", "r", "n"]:
+        sigma_inst = c_kms / (2.3548 * resolving_power[arm])
+        # of the observed line widths, i.e., of the number of pixels summed
+        width_ratio = np.sqrt(
+            (line_widths[:, np.newaxis] ** 2 + sigma_inst**2)
+            / (line_width0**2 + sigma_inst**2)
+        )
+        sn = (
+            df_snline[f"snline_{arm}"].to_numpy()
+            * r
+            / np.sqrt(width_ratio * (1.0 - q) + r * q)
+        )
+        res[f"snline_{arm}"] = sn
+        sn2_tot0 = sn2_tot0 + df_snline[f"snline_{arm}"].to_numpy() ** 2
+        sn2_tot = sn2_tot + sn**2
+    # total S/N is scaled as the quadrature sum of the arms
+    with np.errstate(divide="ignore", invalid="ignore"):
+        res["snline_tot"] = np.where(
+            sn2_tot0 > 0, snline_tot * np.sqrt(sn2_tot / sn2_tot0), 0.0
+        )
+
+    return res
+
+
+def rescaled_snline_dataframe(
+    df_snline: pd.DataFrame,
+    line_flux0: float,
+    line_width0: float,
+    line_flux: float,
+    line_width: float,
+    exp_time: float = 900.0,
+    exp_num: int = 1,
+    resolving_power: dict = None,
+) -> pd.DataFrame:
+    res = rescale_snline(
+        df_snline,
+        line_flux0,
+        line_width0,
+        [line_flux],
+        [line_width],
+        exp_time=exp_time,
+        exp_num=exp_num,
+        resolving_power=resolving_power,
+    )
+
+    df_snline_new = df_snline.copy()
+    for c in ["snline_b", "snline_r", "snline_n", "snline_tot"]:
+        df_snline_new[c] = res[c][0]
+
+    return df_snline_new
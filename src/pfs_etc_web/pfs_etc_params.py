@@ -37,6 +37,11 @@ class PfsSpecParameter:
     exp_num: int = 1
     field_angle: float = 0.45  # degree (area-weighted average)
     mr_mode: bool = False
+    # approximate resolving power of each arm
+    resolving_power_b: float = 2300.0
+    resolving_power_r: float = 3000.0
+    resolving_power_m: float = 5000.0
+    resolving_power_n: float = 4300.0
 
     # telescope
     zenith_angle: int = 35
@@ -53,6 +58,8 @@ class PfsSpecParameter:
     outfile_sn_line: str = "sn_line.dat"
     # outfile_sn_oii: str = "sn_oii.dat"
     outfile_sn_oii: str = "-"
+    outfile_params: str = "simulation_params.json"
+    outfile_manifest: str = "manifest.npz"
 
     # For Simulator
     outfile_simspec: str = "simulated_spectrum"  # ".dat" will be added by the simulator
@@ -74,6 +81,10 @@ class PfsSpecParameter:
 default_parameters = PfsSpecParameter()
 
 
+def conf_values(conf) -> dict:
+    return {k: v for k, v in conf.param.values().items() if k != "name"}
+
+
 class TargetConf(param.Parameterized):
     # Templates
     template = param.String(
@@ -210,6 +221,18 @@ class InstrumentConf(param.Parameterized):
         self.field_angle = default_parameters.field_angle
         self.mr_mode = default_parameters.mr_mode
 
+    def resolving_power(self) -> dict:
+        # of the b, r (m in the medium resolution mode) and n arms
+        return {
+            "b": default_parameters.resolving_power_b,
+            "r": (
+                default_parameters.resolving_power_m
+                if self.mr_mode
+                else default_parameters.resolving_power_r
+            ),
+            "n": default_parameters.resolving_power_n,
+        }
+
 
 class TelescopeConf(param.Parameterized):
     zenith_angle = param.Integer(
@@ -252,6 +275,15 @@ class OutputConf(param.Parameterized):
         default=default_parameters.outfile_sn_oii,
     )
 
+    params = param.String(
+        label="Simulation parameters",
+        default=default_parameters.outfile_params,
+    )
+    manifest = param.String(
+        label="Parameters and results",
+        default=default_parameters.outfile_manifest,
+    )
+
     simspec = param.String(
         label="Simulation output",
         default=default_parameters.outfile_simspec,
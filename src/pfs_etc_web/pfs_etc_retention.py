@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import secrets
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from loguru import logger
+
+from .pfs_etc_sessions import (
+    get_simulation_index,
+    session_name,
+    session_size,
+    shard_pattern,
+)
+
+size_units = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def parse_size(size: str) -> int:
+    # e.g., "500M", "20G" or a number of bytes
+    size = str(size).strip().upper().removesuffix("B")
+    if size[-1:] in size_units:
+        return int(float(size[:-1]) * size_units[size[-1]])
+    return int(size)
+
+
+def _running_dir(basedir: str) -> str:
+    return os.path.join(basedir, ".cache", "running")
+
+
+@contextmanager
+def running_session(basedir: str, sessiondir: str):
+    # a marker per job, named after the session (batch groups are stored
+    # under the directory of the batch)
+    dirname = _running_dir(basedir)
+    os.makedirs(dirname, exist_ok=True)
+    prefix = f"{session_name(sessiondir)}."
+    fd, marker = tempfile.mkstemp(prefix=prefix, dir=dirname)
+    os.close(fd)
+    try:
+        yield
+    finally:
+        try:
+            os.remove(marker)
+        except FileNotFoundError:
+            pass
+
+
+def running_sessions(basedir: str, max_runtime: float = 86400.0) -> set:
+    # markers older than max_runtime are left by processes that were killed
+    dirname = _running_dir(basedir)
+    if not os.path.exists(dirname):
+        return set()
+    now = time.time()
+    sessions = set()
+    with os.scandir(dirname) as it:
+        for e in it:
+            try:
+                if now - e.stat().st_mtime < max_runtime:
+                    sessions.add(e.name.rsplit(".", 1)[0])
+            except FileNotFoundError:
+                pass
+    return sessions
+
+
+def cached_sessions(basedir: str) -> set or None:
+    # sessions referred to by the result cache must be kept; the index is read
+    # from the file as the cache may belong to other processes
+    index_file = os.path.join(basedir, ".cache", "result_cache.json")
+    if not os.path.exists(index_file):
+        return set()
+    try:
+        with open(index_file, "r") as f:
+            entries = json.load(f)
+        return {session_name(v["sessiondir"]) for _, v in entries}
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Failed to read result cache {index_file}: {e}")
+        return None
+
+
+def _accessed_dir(basedir: str) -> str:
+    return os.path.join(basedir, ".cache", "accessed")
+
+
+def touch_session(basedir: str, sessiondir: str):
+    # a marker per session whose mtime is the last time the outputs were
+    # served again, e.g., from the result cache or by a shared link
+    dirname = _accessed_dir(basedir)
+    marker = os.path.join(dirname, session_name(sessiondir))
+    try:
+        os.makedirs(dirname, exist_ok=True)
+        with open(marker, "a"):
+            pass
+        os.utime(marker)
+    except OSError as e:
+        logger.warning(f"Failed to record the access to {sessiondir}: {e}")
+
+
+def accessed_sessions(basedir: str) -> dict:
+    # name: last access time
+    dirname = _accessed_dir(basedir)
+    if not os.path.exists(dirname):
+        return {}
+    sessions = {}
+    with os.scandir(dirname) as it:
+        for e in it:
+            try:
+                sessions[e.name] = e.stat().st_mtime
+            except FileNotFoundError:
+                pass
+    return sessions
+
+
+class SessionIndex:
+    def __init__(self, basedir: str = "tmp", max_workers: int = 8):
+        self.basedir = basedir
+        self.max_workers = max_workers
+        self.index_file = os.path.join(basedir, ".cache", "retention_index.json")
+
+        # name: [mtime_ns, mtime, size, path relative to basedir]
+        self._entries = {}
+
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.index_file):
+            return
+        try:
+            with open(self.index_file, "r") as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to read retention index {self.index_file}: {e}")
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(self.index_file))
+        with os.fdopen(fd, "w") as f:
+            json.dump(self._entries, f)
+        os.replace(tmpfile, self.index_file)
+
+    def _sessions(self):
+        # sessions are directories in basedir or in the shards of a day
+        with os.scandir(self.basedir) as it:
+            for e in it:
+                if e.name.startswith(".") or not e.is_dir(follow_symlinks=False):
+                    continue
+                if shard_pattern.match(e.name) is None:
+                    yield e.name, e
+                    continue
+                try:
+                    with os.scandir(e.path) as it_shard:
+                        for e_shard in it_shard:
+                            if e_shard.is_dir(follow_symlinks=False):
+                                yield os.path.join(e.name, e_shard.name), e_shard
+                except FileNotFoundError:
+                    pass
+
+    def scan(self) -> dict:
+        # only directories modified since the last scan are measured again;
+        # outputs are written once and downloads add files to the top level
+        entries = {}
+        stale = []
+        for path, e in self._sessions():
+            try:
+                st = e.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            entry = self._entries.get(e.name)
+            if entry is not None and entry[0] == st.st_mtime_ns:
+                entries[e.name] = [st.st_mtime_ns, st.st_mtime, entry[2], path]
+            else:
+                entries[e.name] = [st.st_mtime_ns, st.st_mtime, None, path]
+                stale.append(e.name)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            sizes = executor.map(
+                session_size,
+                [os.path.join(self.basedir, entries[k][3]) for k in stale],
+            )
+            for k, size in zip(stale, sizes):
+                entries[k][2] = size
+
+        logger.info(
+            f"{len(entries)} sessions found in {self.basedir} ({len(stale)} measured)"
+        )
+
+        self._entries = entries
+        self._save()
+
+        return entries
+
+    def remove(self, name: str):
+        # move the directory out of the way first so that a half-removed
+        # session is never seen by the app or by the next scan
+        trashdir = os.path.join(self.basedir, ".cache", "trash")
+        os.makedirs(trashdir, exist_ok=True)
+        trash = os.path.join(trashdir, f"{name}.{secrets.token_hex(4)}")
+        path = self._entries[name][3]
+        os.rename(os.path.join(self.basedir, path), trash)
+        shutil.rmtree(trash, ignore_errors=True)
+        self._entries.pop(name)
+
+        try:
+            os.remove(os.path.join(_accessed_dir(self.basedir), name))
+        except FileNotFoundError:
+            pass
+
+        shard = os.path.dirname(path)
+        if shard != "":
+            try:
+                # removed only when the last session of the day is gone
+                os.rmdir(os.path.join(self.basedir, shard))
+            except OSError:
+                pass
+
+    def forget(self, names: list):
+        get_simulation_index(self.basedir).remove(names)
+
+    def save(self):
+        self._save()
+
+
+def clean_outputs(
+    basedir: str,
+    quota: int,
+    min_age: float = 3600.0,
+    dry_run: bool = False,
+    max_workers: int = 8,
+) -> dict:
+    # remove the least recently used sessions until the total size is within
+    # the quota; a session is used when it is written or served again, and
+    # running and cached sessions and those used in the last min_age seconds
+    # are kept
+    index = SessionIndex(basedir=basedir, max_workers=max_workers)
+    entries = index.scan()
+
+    total = sum(v[2] for v in entries.values())
+    stats = {"sessions": len(entries), "size": total, "removed": 0, "freed": 0}
+
+    if total <= quota:
+        logger.info(f"Output size {total} bytes is within the quota of {quota} bytes")
+        return stats
+
+    cached = cached_sessions(basedir)
+    if cached is None:
+        # sessions in use cannot be told apart
+        logger.warning("Output retention skipped")
+        return stats
+
+    protected = running_sessions(basedir) | cached
+    accessed = accessed_sessions(basedir)
+    last_used = {k: max(v[1], accessed.get(k, 0.0)) for k, v in entries.items()}
+    now = time.time()
+    candidates = sorted(
+        (t, k)
+        for k, t in last_used.items()
+        if k not in protected and now - t >= min_age
+    )
+
+    removed = []
+    for _, k in candidates:
+        if total <= quota:
+            break
+        size = entries[k][2]
+        if dry_run:
+            logger.info(f"Would remove {k} ({size} bytes)")
+        else:
+            # the session may have been started again since the scan
+            if k in running_sessions(basedir):
+                continue
+            try:
+                index.remove(k)
+            except OSError as e:
+                logger.error(f"Failed to remove {k}: {e}")
+                continue
+        total -= size
+        removed.append(k)
+        stats["removed"] += 1
+        stats["freed"] += size
+
+    if not dry_run:
+        index.save()
+        index.forget(removed)
+
+    if total > quota:
+        logger.warning(
+            f"Output size {total} bytes still exceeds the quota of {quota} bytes"
+        )
+
+    logger.info(f"Output retention: {stats}")
+
+    return stats
+
+
+def retention_loop(basedir: str, quota: int, interval: float, stop=None, **kwargs):
+    # errors are logged and the cleaning is retried at the next interval
+    if stop is None:
+        stop = threading.Event()
+    while True:
+        try:
+            clean_outputs(basedir, quota, **kwargs)
+        except Exception as e:
+            logger.exception(f"Output retention failed: {e}")
+        if stop.wait(interval):
+            break
+
+
+_retention_thread = None
+_retention_lock = threading.Lock()
+
+
+def start_retention(
+    basedir: str = "tmp", quota: int = None, interval: float = 3600.0, **kwargs
+) -> threading.Thread:
+    # a single background thread shared by all sessions served by the process
+    global _retention_thread
+    with _retention_lock:
+        if _retention_thread is None:
+            _retention_thread = threading.Thread(
+                target=retention_loop,
+                args=(basedir, quota, interval),
+                kwargs=kwargs,
+                name="retention",
+                daemon=True,
+            )
+            _retention_thread.start()
+            logger.info(
+                f"Output retention started for {basedir} "
+                f"(quota: {quota} bytes, interval: {interval} s)"
+            )
+    return _retention_thread
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+import datetime
+import json
+import os
+import re
+import secrets
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+from loguru import logger
+
+# simulation IDs are <YYYYmmdd-HHMMSS-hex> and stored in a directory per day,
+# <basedir>/<YYYYmmdd>/<simulation ID>; older outputs are directly in basedir
+simulation_id_pattern = re.compile(r"^(\d{8})-\d{6}-[0-9a-f]+$")
+shard_pattern = re.compile(r"^\d{8}$")
+valid_id_pattern = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_-]*$")
+
+
+def new_simulation_id() -> str:
+    return (
+        datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + "-" + secrets.token_hex(8)
+    )
+
+
+def session_path(simulation_id: str) -> str:
+    # directory of the simulation relative to basedir
+    m = simulation_id_pattern.match(simulation_id)
+    if m is None:
+        return simulation_id
+    return os.path.join(m.group(1), simulation_id)
+
+
+def simulation_id_of(sessiondir: str) -> str:
+    return os.path.basename(os.path.normpath(sessiondir))
+
+
+def session_name(sessiondir: str) -> str:
+    # top-level directory of a session apart from the shard, e.g., the
+    # simulation ID or the batch ID of batch groups
+    parts = os.path.normpath(sessiondir).split(os.sep)
+    if len(parts) > 1 and shard_pattern.match(parts[0]):
+        return parts[1]
+    return parts[0]
+
+
+def session_size(path: str) -> int:
+    # disk usage in bytes of a session directory
+    size = 0
+    stack = [path]
+    while len(stack) > 0:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for e in it:
+                    try:
+                        if e.is_dir(follow_symlinks=False):
+                            stack.append(e.path)
+                        size += e.stat(follow_symlinks=False).st_blocks * 512
+                    except FileNotFoundError:
+                        pass
+        except FileNotFoundError:
+            pass
+    return size
+
+
+class SimulationIndex:
+    def __init__(self, basedir: str = "tmp"):
+        self.basedir = basedir
+        self.index_file = os.path.join(basedir, ".cache", "simulations.sqlite")
+
+        os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            # shared by the server and worker processes
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS simulations ("
+                "id TEXT PRIMARY KEY, path TEXT NOT NULL, created REAL, "
+                "size INTEGER, params TEXT)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.index_file, timeout=30.0)
+
+    def add(
+        self,
+        simulation_id: str,
+        sessiondir: str,
+        params: dict = None,
+        size: int = None,
+        created: float = None,
+    ):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO simulations VALUES (?, ?, ?, ?, ?)",
+                (
+                    simulation_id,
+                    sessiondir,
+                    time.time() if created is None else created,
+                    size,
+                    (
+                        None
+                        if params is None
+                        else json.dumps(params, default=lambda v: v.item())
+                    ),
+                ),
+            )
+
+    def get(self, simulation_id: str) -> dict or None:
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT path, created, size, params FROM simulations WHERE id = ?",
+                (simulation_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "path": row[0],
+            "created": row[1],
+            "size": row[2],
+            "params": None if row[3] is None else json.loads(row[3]),
+        }
+
+    def remove(self, simulation_ids: list):
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "DELETE FROM simulations WHERE id = ?", [(k,) for k in simulation_ids]
+            )
+
+    def resolve(self, simulation_id: str) -> str or None:
+        # directory of a simulation relative to basedir; IDs are given by users
+        # and must not point to the directory of a day
+        if (
+            valid_id_pattern.match(simulation_id) is None
+            or shard_pattern.match(simulation_id) is not None
+        ):
+            logger.error(f"Invalid Simulation ID {simulation_id}")
+            return None
+
+        entry = self.get(simulation_id)
+        if entry is not None and os.path.isdir(
+            os.path.join(self.basedir, entry["path"])
+        ):
+            return entry["path"]
+
+        # simulations not in the index, e.g., in the flat layout of older versions
+        for sessiondir in [session_path(simulation_id), simulation_id]:
+            outdir = os.path.join(self.basedir, sessiondir)
+            if os.path.isdir(outdir):
+                logger.info(f"Add Simulation ID {simulation_id} to the index")
+                self.add(
+                    simulation_id,
+                    sessiondir,
+                    size=session_size(outdir),
+                    created=os.stat(outdir).st_mtime,
+                )
+                return sessiondir
+
+        if entry is not None:
+            self.remove([simulation_id])
+
+        return None
+
+
+_simulation_index = None
+_simulation_index_lock = threading.Lock()
+
+
+def get_simulation_index(basedir: str = "tmp") -> SimulationIndex:
+    global _simulation_index
+    with _simulation_index_lock:
+        if _simulation_index is None or _simulation_index.basedir != basedir:
+            _simulation_index = SimulationIndex(basedir=basedir)
+    return _simulation_index
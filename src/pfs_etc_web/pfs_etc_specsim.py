@@ -1,22 +1,46 @@
 #!/usr/bin/env python3
 
 import glob
+import json
 import os
 import pprint
 import shutil
 import sys
+import tempfile
+import threading
 
 from loguru import logger
 from pfsspecsim import pfsetc, pfsspec
 
-from .pfs_etc_params import OutputConf, SimulationConf
+from .pfs_etc_cache import (
+    environment_keys,
+    instrument_keys,
+    noise_key,
+    target_keys,
+    telescope_keys,
+)
+from .pfs_etc_params import (
+    EnvironmentConf,
+    InstrumentConf,
+    OutputConf,
+    SimulationConf,
+    TargetConf,
+    TelescopeConf,
+    conf_values,
+    default_parameters,
+)
+from .pfs_etc_sessions import simulation_id_of
 from .pfs_etc_spectemplates import create_template_spectrum
 from .pfs_etc_utils import (
-    create_simspec_files,
     create_simspec_plot,
+    create_simspec_table,
+    create_snline_table,
+    create_tj_text,
     load_simspec,
     load_sncont,
     load_snline,
+    read_manifest,
+    write_manifest,
 )
 
 
@@ -29,14 +53,25 @@ class PfsSpecSim:
         telescope=None,
         output=OutputConf(),
         simconf=SimulationConf(),
+        noise_cache=None,
+        spectrum_cache=None,
+        template_engine: str = "synphot",
+        custom_store=None,
     ):
         self.target = target
         self.environment = environment
         self.instrument = instrument
         self.telescope = telescope
 
-        self.output = output
+        # a copy, as the conf of the session is changed by the next run while
+        # files of this one may still be written in the background
+        self.output = OutputConf(**conf_values(output))
         self.simconf = simconf
+        self.noise_cache = noise_cache
+        self.spectrum_cache = spectrum_cache
+        self.template_engine = template_engine
+        self.custom_store = custom_store
+        self.noise_reused = default_parameters.noise_reused
 
         if os.environ.get("OMP_NUM_THREADS") is not None:
             omp_num_threads = int(os.environ.get("OMP_NUM_THREADS"))
@@ -49,6 +84,11 @@ class PfsSpecSim:
         self.outfile_simspec_prefix = None
         self.outfile_snline_prefix = None
 
+        # tables and text for download built from the arrays of show()
+        self._products = {}
+        # files may be written from several threads
+        self._lock = threading.Lock()
+
     def run_etc(self):
         self.etc.set_param(
             "OUTDIR", os.path.join(self.output.basedir, self.output.sessiondir)
@@ -86,7 +126,11 @@ class PfsSpecSim:
         self.etc.set_param("GALACTIC_EXT", self.target.galactic_extinction)
 
         self.target, flag_good_lamnorm = create_template_spectrum(
-            self.target, tmpdir=self.etc.params["TMPDIR"]
+            self.target,
+            tmpdir=self.etc.params["TMPDIR"],
+            cache=self.spectrum_cache,
+            engine=self.template_engine,
+            custom_store=self.custom_store,
         )
 
         if flag_good_lamnorm is False:
@@ -100,13 +144,16 @@ class PfsSpecSim:
         # self.etc.set_param("MAG_FILE", self.target.mag_file)
 
         if self.target.custom_input is not None:
-            with open(
-                os.path.join(
-                    self.output.basedir, self.output.sessiondir, "custom_input.csv"
-                ),
-                "wb",
-            ) as f:
-                f.write(self.target.custom_input)
+            custom_input_file = os.path.join(
+                self.output.basedir, self.output.sessiondir, "custom_input.csv"
+            )
+            if self.custom_store is not None:
+                self.custom_store.link_raw_file(
+                    self.target.custom_input, custom_input_file
+                )
+            else:
+                with open(custom_input_file, "wb") as f:
+                    f.write(self.target.custom_input)
 
         self.etc.set_param("REFF", self.target.r_eff)
         self.etc.set_param("LINE_FLUX", self.target.line_flux)
@@ -153,6 +200,23 @@ class PfsSpecSim:
         else:
             self.etc.set_param("OUTFILE_OII", self.output.sn_oii)
 
+        # reuse the noise vector computed for the same observing condition
+        noise_cache_key = None
+        self.noise_reused = default_parameters.noise_reused
+        if self.noise_cache is not None and self.output.noise != "-":
+            noise_cache_key = noise_key(
+                self.environment, self.instrument, self.telescope
+            )
+            cached_noise = self.noise_cache.get(noise_cache_key)
+            if cached_noise is not None:
+                try:
+                    shutil.copyfile(cached_noise, self.etc.params["OUTFILE_NOISE"])
+                    self.noise_reused = True
+                except FileNotFoundError:
+                    # evicted by another process after the lookup
+                    logger.info(f"Cached noise {cached_noise} is gone, recompute")
+        self.etc.set_param("NOISE_REUSED", "Y" if self.noise_reused else "N")
+
         logger.info(
             f"""Input parameters for gsetc\n{pprint.pformat(self.etc.params)}"""
         )
@@ -160,6 +224,13 @@ class PfsSpecSim:
         # execute PFS ETC
         self.etc.run()
 
+        if (
+            noise_cache_key is not None
+            and not self.noise_reused
+            and os.path.exists(self.etc.params["OUTFILE_NOISE"])
+        ):
+            self.noise_cache.put(noise_cache_key, self.etc.params["OUTFILE_NOISE"])
+
     def run_sim(self):
         # if self.target.mag_file is None:
         self.sim.set_param("MAG_FILE", f"{self.target.mag_file}")
@@ -193,78 +264,208 @@ class PfsSpecSim:
             self.run_etc()
             self.run_sim()
 
-    def show(self, infile: str = None, write: bool = True):
+    def set_outfiles(self):
         outdir = os.path.join(self.output.basedir, self.output.sessiondir)
+        simulation_id = simulation_id_of(self.output.sessiondir)
 
-        if infile is None:
-            infile_simspec = os.path.join(outdir, f"{self.output.simspec}.dat")
-            infile_snline = os.path.join(outdir, f"{self.output.sn_line}")
-            infile_sncont = os.path.join(outdir, f"{self.output.sn_cont}")
-
-        df_simspec = load_simspec(infile_simspec)
-        df_snline = load_snline(infile_snline)
-        df_sncont = load_sncont(infile_sncont)
-
-        self.outfile_pfsobject = os.path.join(
-            outdir, f"pfsObject-{self.output.sessiondir}.fits"
-        )
+        self.outfile_pfsobject = os.path.join(outdir, f"pfsObject-{simulation_id}.fits")
 
         self.outfile_simspec_prefix = os.path.join(
-            outdir, f"pfs_etc_simspec-{self.output.sessiondir}"
+            outdir, f"pfs_etc_simspec-{simulation_id}"
         )
         self.outfile_snline_prefix = os.path.join(
-            outdir, f"pfs_etc_snline-{self.output.sessiondir}"
+            outdir, f"pfs_etc_snline-{simulation_id}"
         )
         self.outfile_tjtext = os.path.join(
-            outdir, f"pfs_etc_tjtext-{self.output.sessiondir}.txt"
+            outdir, f"pfs_etc_tjtext-{simulation_id}.txt"
         )
 
-        if write:
-            tb_simspec, tb_snline, text_tj = create_simspec_files(
-                self.target,
-                self.environment,
-                self.instrument,
-                self.telescope,
-                df_simspec,
-                df_snline,
-                df_sncont,
-            )
-            tb_simspec.write(
-                f"{self.outfile_simspec_prefix}.fits", format="fits", overwrite=True
-            )
-            tb_simspec.write(
-                f"{self.outfile_simspec_prefix}.ecsv",
-                format="ascii.ecsv",
-                delimiter=",",
-                overwrite=True,
-            )
-            tb_snline.write(
-                f"{self.outfile_snline_prefix}.fits", format="fits", overwrite=True
-            )
-            tb_snline.write(
-                f"{self.outfile_snline_prefix}.ecsv",
-                format="ascii.ecsv",
-                delimiter=",",
-                overwrite=True,
-            )
+    def output_files(self) -> dict:
+        # files offered for download
+        self.set_outfiles()
+        return {
+            "pfsobject": self.outfile_pfsobject,
+            "simspec_fits": f"{self.outfile_simspec_prefix}.fits",
+            "simspec_ecsv": f"{self.outfile_simspec_prefix}.ecsv",
+            "snline_fits": f"{self.outfile_snline_prefix}.fits",
+            "snline_ecsv": f"{self.outfile_snline_prefix}.ecsv",
+            "tjtext": self.outfile_tjtext,
+        }
+
+    def load(self):
+        outdir = os.path.join(self.output.basedir, self.output.sessiondir)
 
-            list_pfsobject_files = glob.glob(os.path.join(outdir, "pfsObject*.fits"))
+        # a single binary file instead of parsing the ETC outputs
+        manifest = read_manifest(os.path.join(outdir, self.output.manifest))
+        if manifest is not None:
+            return manifest[1]
+
+        df_simspec = load_simspec(os.path.join(outdir, f"{self.output.simspec}.dat"))
+        df_snline = load_snline(os.path.join(outdir, f"{self.output.sn_line}"))
+        df_sncont = load_sncont(os.path.join(outdir, f"{self.output.sn_cont}"))
+
+        return df_simspec, df_snline, df_sncont
+
+    def simulation_params(self) -> dict:
+        # parameters of the run, used to recover the session
+        target, environment, instrument, telescope = self._confs()
+        return {
+            "target": {k: getattr(target, k) for k in target_keys},
+            "environment": {k: getattr(environment, k) for k in environment_keys},
+            "instrument": {k: getattr(instrument, k) for k in instrument_keys},
+            "telescope": {k: getattr(telescope, k) for k in telescope_keys},
+            # the custom input itself is kept in custom_input.csv
+            "custom_input": target.custom_input is not None,
+        }
+
+    def write_params(self):
+        outdir = os.path.join(self.output.basedir, self.output.sessiondir)
+        params = self.simulation_params()
+        with open(os.path.join(outdir, self.output.params), "w") as f:
+            json.dump(params, f, indent=2, default=lambda v: v.item())
+        return params
+
+    def write_manifest(self, data: tuple = None) -> str:
+        # data: (df_simspec, df_snline, df_sncont), the ones of show() by default
+        if data is None:
+            data = (self.df_simspec, self.df_snline, self.df_sncont)
+        outdir = os.path.join(self.output.basedir, self.output.sessiondir)
+        outfile = os.path.join(outdir, self.output.manifest)
+        write_manifest(outfile, self.simulation_params(), data)
+
+        # .npy copies of the tables written by earlier versions
+        for infile in [
+            f"{self.output.simspec}.dat",
+            self.output.sn_line,
+            self.output.sn_cont,
+        ]:
+            try:
+                os.remove(os.path.join(outdir, f"{infile}.npy"))
+            except FileNotFoundError:
+                pass
+
+        return outfile
+
+    def rename_pfsobject(self):
+        outdir = os.path.join(self.output.basedir, self.output.sessiondir)
 
-            if len(list_pfsobject_files) != 1:
-                logger.error(
-                    f"something wrong for pfsObject generation: {list_pfsobject_files}"
-                )
-            self.output.pfsobject = list_pfsobject_files[0]
-            os.rename(
-                self.output.pfsobject,
-                self.outfile_pfsobject,
+        self.set_outfiles()
+
+        list_pfsobject_files = glob.glob(os.path.join(outdir, "pfsObject*.fits"))
+
+        if len(list_pfsobject_files) != 1:
+            logger.error(
+                f"something wrong for pfsObject generation: {list_pfsobject_files}"
             )
+        self.output.pfsobject = list_pfsobject_files[0]
+        os.rename(
+            self.output.pfsobject,
+            self.outfile_pfsobject,
+        )
 
-            text_tj += f"[16] Simulation ID: {self.output.sessiondir}\n"
-            # text_tj = text_tj.replace("_", "\\_")
+    def _confs(self) -> tuple:
+        if hasattr(self, "params"):
+            # parameters at the time of show(), as the ones of the session may have changed
+            return (
+                TargetConf(**self.params["target"]),
+                EnvironmentConf(**self.params["environment"]),
+                InstrumentConf(**self.params["instrument"]),
+                TelescopeConf(**self.params["telescope"]),
+            )
+        return (self.target, self.environment, self.instrument, self.telescope)
+
+    def _product(self, name: str):
+        # a table is built once and shared by the FITS and ECSV files
+        with self._lock:
+            if name not in self._products:
+                if name == "simspec":
+                    self._products[name] = create_simspec_table(
+                        *self._confs(), self.df_simspec, self.df_sncont
+                    )
+                elif name == "snline":
+                    self._products[name] = create_snline_table(
+                        *self._confs(), self.df_snline
+                    )
+                elif name == "tjtext":
+                    simulation_id = simulation_id_of(self.output.sessiondir)
+                    text_tj = create_tj_text(*self._confs())
+                    text_tj += f"[16] Simulation ID: {simulation_id}\n"
+                    # text_tj = text_tj.replace("_", "\\_")
+                    self._products[name] = text_tj
+            return self._products[name]
+
+    def _write_file(self, kind: str) -> str:
+        outfile = self.output_files()[kind]
+
+        # written via a temporary file as the same file may be requested twice
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(outfile))
+        os.close(fd)
+        if kind == "tjtext":
+            with open(tmpfile, "w") as f:
+                f.write(self._product("tjtext"))
+        else:
+            name, fmt = kind.split("_")
+            if fmt == "fits":
+                self._product(name).write(tmpfile, format="fits", overwrite=True)
+            else:
+                self._product(name).write(
+                    tmpfile, format="ascii.ecsv", delimiter=",", overwrite=True
+                )
+        os.chmod(tmpfile, 0o644)
+        os.replace(tmpfile, outfile)
+
+        return outfile
+
+    def write_output(self, kind: str) -> str:
+        # write a file for download from the arrays of show() unless it exists
+        outfile = self.output_files()[kind]
+        if os.path.exists(outfile):
+            return outfile
+
+        if kind == "pfsobject":
+            self.rename_pfsobject()
+            return outfile
+
+        logger.info(f"Write {outfile}")
+        return self._write_file(kind)
+
+    def write_outputs(self, df_simspec=None, df_snline=None, df_sncont=None):
+        if df_simspec is None or df_snline is None or df_sncont is None:
+            df_simspec, df_snline, df_sncont = self.load()
+        self.df_simspec = df_simspec
+        self.df_snline = df_snline
+        self.df_sncont = df_sncont
+        self._products = {}
+
+        for kind in self.output_files().keys():
+            if kind == "pfsobject":
+                self.rename_pfsobject()
+            else:
+                self._write_file(kind)
+
+    def show(self, infile: str = None, write: bool = True, data: tuple = None):
+        # data: (df_simspec, df_snline, df_sncont) already in memory
+        if data is None:
+            df_simspec, df_snline, df_sncont = self.load()
+        else:
+            df_simspec, df_snline, df_sncont = data
+
+        # kept for re-evaluation of the plot without running the ETC again
+        self.df_simspec = df_simspec.copy()
+        self.df_snline = df_snline.copy()
+        self.df_sncont = df_sncont.copy()
+        self._products = {}
+        self.params = {
+            "target": conf_values(self.target),
+            "environment": conf_values(self.environment),
+            "instrument": conf_values(self.instrument),
+            "telescope": conf_values(self.telescope),
+        }
+
+        self.set_outfiles()
 
-            with open(self.outfile_tjtext, "w") as f:
-                f.write(text_tj)
+        if write:
+            self.write_outputs(df_simspec, df_snline, df_sncont)
 
         self.p_simspec = create_simspec_plot(df_simspec, df_snline, df_sncont)
 
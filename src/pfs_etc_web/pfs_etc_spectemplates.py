@@ -1,25 +1,259 @@
 #!/usr/bin/env python3
 
+import hashlib
+import json
 import os
+import tempfile
+import threading
+from dataclasses import dataclass
 from io import BytesIO
+from types import MappingProxyType
+from typing import TYPE_CHECKING
 
 import numpy as np
 import pandas as pd
-import synphot
 from astropy import units as u
-from astropy.io.fits import getval
+from loguru import logger
 
+if TYPE_CHECKING:
+    import synphot
 
-def prepare_spectrum(
+pkgdir = os.path.dirname(os.path.abspath(__file__))
+datadir = os.path.join("spectemplates", "output")
+
+templatefiles = {
+    # "Star-forming galaxy": "galaxy_starforming.fits",
+    # "Quiescent galaxy": "galaxy_quiescent.fits",
+    "SSP (100 Myr, [M/H]=0, Chabrier IMF)": "galaxy_starforming.fits",
+    "SSP (1 Gyr, [M/H]=0, Chabrier IMF)": "galaxy_quiescent.fits",
+    "Elliptical 2 Gyr": "galaxy_swire_elliptical_2gyr.fits",
+    "Elliptical 5 Gyr": "galaxy_swire_elliptical_5gyr.fits",
+    "Elliptical 13 Gyr": "galaxy_swire_elliptical_13gyr.fits",
+    "S0": "galaxy_swire_spiral_s0.fits",
+    "Sa": "galaxy_swire_spiral_sa.fits",
+    "Sb": "galaxy_swire_spiral_sb.fits",
+    "Sc": "galaxy_swire_spiral_sc.fits",
+    "Sd": "galaxy_swire_spiral_sd.fits",
+    "Sdm": "galaxy_swire_spiral_sdm.fits",
+    "Quasar": "quasar.fits",
+    "B0V": "star_b0v.fits",
+    "A0V": "star_a0v.fits",
+    "F0V": "star_f0v.fits",
+    "G2V": "star_g2v.fits",
+    "K0V": "star_k0v.fits",
+    "M0V": "star_m0v.fits",
+    "K0III": "star_k0iii.fits",
+    "M0III": "star_m0iii.fits",
+    "Flat in frequency": None,
+}
+
+
+def template_path(template: str) -> str or None:
+    if templatefiles.get(template) is None:
+        return None
+    return os.path.join(pkgdir, datadir, templatefiles[template])
+
+
+# all templates packed in a single array, see write_template_bundle()
+bundlefile = os.path.join(pkgdir, datadir, "templates.npy")
+bundleindex = os.path.join(pkgdir, datadir, "templates.json")
+
+_file_checksums = {}
+
+
+def file_checksum(filename: str) -> str:
+    # memoize by modification time as template files are read on every request
+    mtime = os.path.getmtime(filename)
+    if filename in _file_checksums and _file_checksums[filename][0] == mtime:
+        return _file_checksums[filename][1]
+
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    _file_checksums[filename] = (mtime, h.hexdigest())
+
+    return _file_checksums[filename][1]
+
+
+@dataclass(frozen=True)
+class TemplateSpectrum:
+    # rest-frame template as read from the FITS file; arrays are read-only
+    wave: np.ndarray  # [angstrom]
+    flux: np.ndarray  # [erg/s/cm^2/angstrom]
+    wave_min: float  # [angstrom]
+    wave_max: float  # [angstrom]
+
+    @classmethod
+    def from_file(cls, infile: str):
+        # synphot and astropy.io.fits take long to import and are not needed
+        # when templates are read from the bundle
+        import synphot
+        from astropy.io.fits import getval
+
+        _, wave, flux = synphot.specio.read_fits_spec(
+            infile,
+            wave_unit=u.AA,
+            flux_unit=u.erg / u.s / u.cm**2 / u.AA,
+        )
+        wave = np.array(wave.to_value(u.AA), dtype=float)
+        flux = np.array(flux.value, dtype=float)
+        wave.setflags(write=False)
+        flux.setflags(write=False)
+        return cls(
+            wave=wave,
+            flux=flux,
+            # min/max wavelenghth supported in the original template
+            wave_min=float(getval(infile, "WAVE_MIN", 1)),
+            wave_max=float(getval(infile, "WAVE_MAX", 1)),
+        )
+
+    def source_spectrum(self) -> "synphot.SourceSpectrum":
+        # same as synphot.SourceSpectrum.from_file(infile)
+        import synphot
+
+        return synphot.SourceSpectrum(
+            synphot.models.Empirical1D,
+            points=self.wave * u.AA,
+            lookup_table=self.flux * (u.erg / u.s / u.cm**2 / u.AA),
+            keep_neg=False,
+        )
+
+
+def write_template_bundle(
+    infiles: list, outfile: str = bundlefile, indexfile: str = bundleindex
+):
+    # Pack template FITS files sharing a wavelength grid into a 2-D array with the
+    # wavelength in the first row and fluxes in the following rows. The index maps
+    # file names to rows with WAVE_MIN/WAVE_MAX and the size, modification time
+    # and checksum of the FITS file.
+    templates = [TemplateSpectrum.from_file(f) for f in infiles]
+    for f, t in zip(infiles, templates):
+        if not np.array_equal(t.wave, templates[0].wave):
+            raise ValueError(f"Wavelength grid of {f} differs from {infiles[0]}")
+
+    index = {}
+    for i, (f, t) in enumerate(zip(infiles, templates)):
+        st = os.stat(f)
+        index[os.path.basename(f)] = {
+            "row": i + 1,
+            "WAVE_MIN": t.wave_min,
+            "WAVE_MAX": t.wave_max,
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "sha256": file_checksum(f),
+        }
+
+    # written via temporary files as running servers may read the bundle
+    outdir = os.path.dirname(os.path.abspath(outfile))
+    fd, tmpfile = tempfile.mkstemp(dir=outdir)
+    with os.fdopen(fd, "wb") as f:
+        np.save(f, np.vstack([templates[0].wave] + [t.flux for t in templates]))
+    os.chmod(tmpfile, 0o644)
+    os.replace(tmpfile, outfile)
+
+    fd, tmpfile = tempfile.mkstemp(dir=outdir)
+    with os.fdopen(fd, "w") as f:
+        json.dump(index, f, indent=2)
+    os.chmod(tmpfile, 0o644)
+    os.replace(tmpfile, indexfile)
+
+
+def _is_indexed(fitsfile: str, entry: dict) -> bool:
+    st = os.stat(fitsfile)
+    if (st.st_size, st.st_mtime_ns) == (entry.get("size"), entry.get("mtime_ns")):
+        return True
+    # e.g., touched by a checkout without changes
+    return file_checksum(fitsfile) == entry["sha256"]
+
+
+def read_template_bundle(
+    infile: str = bundlefile, indexfile: str = bundleindex
+) -> dict:
+    # The bundle is memory-mapped read-only, so processes share the same pages and
+    # each template is a view of a row. Entries whose FITS file has been changed
+    # after the bundle was written are skipped; the FITS file is only read to
+    # compare its checksum when its size or modification time differs from the
+    # index, so that the app does not read every template at startup.
+    if not (os.path.exists(infile) and os.path.exists(indexfile)):
+        return {}
+
+    data = np.load(infile, mmap_mode="r")
+    with open(indexfile, "r") as f:
+        index = json.load(f)
+
+    templates = {}
+    for filename, v in index.items():
+        fitsfile = os.path.join(os.path.dirname(indexfile), filename)
+        if os.path.exists(fitsfile) and not _is_indexed(fitsfile, v):
+            logger.warning(f"Template bundle is outdated for {filename}, not used")
+            continue
+        templates[fitsfile] = TemplateSpectrum(
+            wave=data[0],
+            flux=data[v["row"]],
+            wave_min=float(v["WAVE_MIN"]),
+            wave_max=float(v["WAVE_MAX"]),
+        )
+    return templates
+
+
+def build_template_bundle(
+    outfile: str = bundlefile, indexfile: str = bundleindex
+) -> list:
+    # bundle of the templates offered by the app, written when the app is
+    # installed or deployed as it is generated from the FITS files
+    infiles = [template_path(k) for k in templatefiles if template_path(k) is not None]
+    write_template_bundle(infiles, outfile=outfile, indexfile=indexfile)
+    logger.info(f"{len(infiles)} templates written to {outfile}")
+    return infiles
+
+
+_template_store = None
+_template_store_lock = threading.Lock()
+
+
+def load_templates() -> MappingProxyType:
+    # templates are read once per process and shared by all sessions
+    global _template_store
+    with _template_store_lock:
+        if _template_store is None:
+            bundle = read_template_bundle()
+            store = {}
+            for template in templatefiles.keys():
+                infile = template_path(template)
+                if infile is None:
+                    continue
+                if infile in bundle:
+                    store[infile] = bundle[infile]
+                else:
+                    store[infile] = TemplateSpectrum.from_file(infile)
+            _template_store = MappingProxyType(store)
+            logger.info(
+                f"{len(_template_store)} template spectra loaded "
+                f"({len([k for k in store if k in bundle])} from the bundle)"
+            )
+    return _template_store
+
+
+def get_template(infile: str) -> TemplateSpectrum:
+    template = load_templates().get(infile)
+    if template is None:
+        # not one of the bundled templates
+        template = TemplateSpectrum.from_file(infile)
+    return template
+
+
+def prepare_spectrum_arrays(
     infile: str,
-    outfile: str,
     redshift: float = 0.0,
     norm_wavelength: u.Quantity = 400.0 * u.nm,
     norm_mag: u.Quantity = 20.0 * u.ABmag,
     norm_bandwidth: u.Quantity = 10.0 * u.nm,
     wmin: float = 300.0,  # [nm]
     wmax: float = 1300.0,  # [nm]
-) -> None or bool:
+) -> tuple or None:
+    import synphot
+
     # define a tophat filter for flux normalization
     band = synphot.SpectralElement(
         synphot.models.Box1D,
@@ -29,15 +263,11 @@ def prepare_spectrum(
     )
 
     # load the template spectrum
-    sp_rest = synphot.SourceSpectrum.from_file(
-        infile,
-        wave_unit=u.AA,
-        # flux_unit=synphot.units.FLAM,
-        flux_unit=u.erg / u.s / u.cm**2 / u.AA,
-    )
+    template = get_template(infile)
+    sp_rest = template.source_spectrum()
     # min/max wavelenghth supported in the original template
-    wmin0 = getval(infile, "WAVE_MIN", 1)  # angstrom
-    wmax0 = getval(infile, "WAVE_MAX", 1)  # angstrom
+    wmin0 = template.wave_min  # angstrom
+    wmax0 = template.wave_max  # angstrom
     # print(sp_rest.waveset, sp_rest(sp_rest.waveset))
 
     # redshifting
@@ -49,7 +279,7 @@ def prepare_spectrum(
     if (wmin0 * (1 + redshift) > band.waverange.to(u.AA).value[0]) or (
         wmax0 * (1 + redshift) < band.waverange.to(u.AA).value[1]
     ):
-        return False
+        return None
 
     # normalization
     sp_norm = sp_z.normalize(norm_mag, band=band)
@@ -61,58 +291,237 @@ def prepare_spectrum(
     fout[~np.isfinite(fout)] = 99.9
     idx = np.logical_and(wout >= wmin, wout <= wmax)
 
+    return wout[idx], fout[idx]
+
+
+# Planck constant [erg s] and speed of light [angstrom/s]
+h_erg = 6.62607015e-27
+c_aa = 2.99792458e18
+# flux density of 0 ABmag [erg/s/cm^2/Hz]
+fnu_ab0 = 10 ** (-0.4 * 48.6)
+
+# np.trapz is renamed in numpy 2.0
+trapezoid = getattr(np, "trapezoid", None) or np.trapz
+
+
+def prepare_spectrum_arrays_numpy(
+    infile: str,
+    redshift: float = 0.0,
+    norm_wavelength: u.Quantity = 400.0 * u.nm,
+    norm_mag: u.Quantity = 20.0 * u.ABmag,
+    norm_bandwidth: u.Quantity = 10.0 * u.nm,
+    wmin: float = 300.0,  # [nm]
+    wmax: float = 1300.0,  # [nm]
+) -> tuple or None:
+    # Same as prepare_spectrum_arrays on plain arrays. The sampling of the tophat
+    # band and the trapezoidal integration in photon flux density follow synphot.
+    template = get_template(infile)
+
+    x0 = norm_wavelength.to_value(u.AA)
+    width = norm_bandwidth.to_value(u.AA)
+    w1, w2 = x0 - width / 2.0, x0 + width / 2.0
+    step = 0.01  # default sampling step of synphot.models.Box1D
+    wband = np.arange(w1 - step, w2 + step + step, step)
+
+    # check if wavelength range of the bandpass is included in the template spectrum
+    if (template.wave_min * (1 + redshift) > wband[0]) or (
+        template.wave_max * (1 + redshift) < wband[-1]
+    ):
+        return None
+
+    # photon flux density in the rest frame [photons/s/cm^2/angstrom]
+    photlam = template.flux * template.wave / (h_erg * c_aa)
+
+    # synphot maps wavelengths with the inverse of the inverse redshift model,
+    # which is reproduced here so that the wavelength grids agree to the last bit
+    z_inv = 1.0 / (1.0 + redshift) - 1.0
+    wave_z = template.wave * (1.0 + (1.0 / (1.0 + z_inv) - 1.0))
+
+    def photlam_z(w):
+        return np.clip(np.interp(w * (1.0 + z_inv), template.wave, photlam), 0, None)
+
+    # synphot refuses to normalize unless the band is covered by the spectrum
+    if (wave_z[0] > wband[0]) or (wave_z[-1] < wband[-1]):
+        return None
+
+    # integrate the redshifted spectrum and 0 ABmag within the band;
+    # the integrand is zero outside the band
+    wgrid = np.union1d(
+        wave_z[np.searchsorted(wave_z, wband[0]) : np.searchsorted(wave_z, wband[-1])],
+        wband,
+    )
+    fgrid = photlam_z(wgrid)
+    in_band = (wgrid >= w1) & (wgrid <= w2)
+    totflux = trapezoid(np.where(in_band, fgrid, 0.0), wgrid)
+    stdflux = trapezoid(
+        np.where((wband >= w1) & (wband <= w2), fnu_ab0 / (h_erg * wband), 0.0),
+        wband,
+    )
+    if not totflux > 0:
+        raise ValueError("Integrated flux of the template is not positive in the band.")
+
+    const = norm_mag.value + 2.5 * np.log10(totflux / stdflux)
+
+    # only the output wavelength range is evaluated
+    wout = (wave_z * u.AA).to_value(u.nm)
+    idx = np.logical_and(wout >= wmin, wout <= wmax)
+    wave_z = wave_z[idx]
+
+    with np.errstate(divide="ignore"):
+        fout = (
+            -2.5 * np.log10(photlam_z(wave_z) * (10 ** (-0.4 * const) * h_erg) * wave_z)
+            - 48.6
+        )
+    fout[~np.isfinite(fout)] = 99.9
+
+    return wout[idx], fout
+
+
+def write_mag_file(outfile: str, wave, mag):
+    # Text file of wavelength [nm] and AB mag read by the ETC as MAG_FILE.
+    # All lines are formatted at once with the same representation as
+    # f"{wave[i]}  {mag[i]}", which is the bottleneck for a large template.
+    values = np.empty(2 * len(wave))
+    values[0::2] = wave
+    values[1::2] = mag
     with open(outfile, "w") as f:
-        for i in range(len(wout[idx])):
-            f.write(f"{wout[idx][i]}  {fout[idx][i]}\n")
+        f.write(("%r  %r\n" * len(wave)) % tuple(values.tolist()))
+
+
+template_engines = {
+    "synphot": prepare_spectrum_arrays,
+    "numpy": prepare_spectrum_arrays_numpy,
+}
+
+
+def prepare_spectrum(
+    infile: str,
+    outfile: str,
+    redshift: float = 0.0,
+    norm_wavelength: u.Quantity = 400.0 * u.nm,
+    norm_mag: u.Quantity = 20.0 * u.ABmag,
+    norm_bandwidth: u.Quantity = 10.0 * u.nm,
+    wmin: float = 300.0,  # [nm]
+    wmax: float = 1300.0,  # [nm]
+    cache=None,
+    engine: str = "synphot",
+) -> None or bool:
+    prepare = template_engines[engine]
+    kwargs = dict(
+        redshift=redshift,
+        norm_wavelength=norm_wavelength,
+        norm_mag=norm_mag,
+        norm_bandwidth=norm_bandwidth,
+        wmin=wmin,
+        wmax=wmax,
+    )
+
+    if cache is None:
+        spec = prepare(infile, **kwargs)
+    else:
+        key = cache.key(infile, engine=engine, **kwargs)
+        spec = cache.get(key)
+        if spec is None:
+            spec = prepare(infile, **kwargs)
+            cache.put(key, spec)
+        logger.info(f"Spectrum cache: {cache.stats()}")
+
+    if spec is None or spec is False:
+        return False
+
+    wout, fout = spec
+
+    write_mag_file(outfile, wout, fout)
 
     return None
 
 
-def create_template_spectrum(target, tmpdir: str = "."):
-    pkgdir = os.path.dirname(os.path.abspath(__file__))
-    datadir = os.path.join("spectemplates", "output")
-    templatefiles = {
-        # "Star-forming galaxy": "galaxy_starforming.fits",
-        # "Quiescent galaxy": "galaxy_quiescent.fits",
-        "SSP (100 Myr, [M/H]=0, Chabrier IMF)": "galaxy_starforming.fits",
-        "SSP (1 Gyr, [M/H]=0, Chabrier IMF)": "galaxy_quiescent.fits",
-        "Elliptical 2 Gyr": "galaxy_swire_elliptical_2gyr.fits",
-        "Elliptical 5 Gyr": "galaxy_swire_elliptical_5gyr.fits",
-        "Elliptical 13 Gyr": "galaxy_swire_elliptical_13gyr.fits",
-        "S0": "galaxy_swire_spiral_s0.fits",
-        "Sa": "galaxy_swire_spiral_sa.fits",
-        "Sb": "galaxy_swire_spiral_sb.fits",
-        "Sc": "galaxy_swire_spiral_sc.fits",
-        "Sd": "galaxy_swire_spiral_sd.fits",
-        "Sdm": "galaxy_swire_spiral_sdm.fits",
-        "Quasar": "quasar.fits",
-        "B0V": "star_b0v.fits",
-        "A0V": "star_a0v.fits",
-        "F0V": "star_f0v.fits",
-        "G2V": "star_g2v.fits",
-        "K0V": "star_k0v.fits",
-        "M0V": "star_m0v.fits",
-        "K0III": "star_k0iii.fits",
-        "M0III": "star_m0iii.fits",
-        "Flat in frequency": None,
-    }
+# wavelength grid of the templates, same as resample_spec in generate_spectemplates.py
+grid_wmin = 900.0  # [angstrom]
+grid_wmax = 13000.0  # [angstrom]
+grid_dw = 0.5  # [angstrom]
+grid_wave = np.linspace(
+    grid_wmin, grid_wmax, int((grid_wmax - grid_wmin) / grid_dw) + 1
+)
 
-    if target.custom_input is not None:
-        print("Custom input spectrum detected!")
-        target.mag_file = os.path.join(tmpdir, "mag_file_template.txt")
-        df_custom = pd.read_csv(
-            BytesIO(target.custom_input),
-            encoding="utf8",
-            names=["wavelength", "flux"],
-            comment="#",
-        )
-        wout = (df_custom["wavelength"].to_numpy() * u.AA).to(u.nm)
-        fout = (df_custom["flux"].to_numpy() * (u.erg / u.s / u.cm**2 / u.AA)).to(
-            u.ABmag, equivalencies=u.spectral_density(wout)
+
+def read_custom_spectrum(infile, chunksize: int = 1_000_000) -> tuple:
+    # Parse a CSV of wavelength [angstrom] and flux [erg/s/cm^2/angstrom] by chunks
+    # and resample it linearly on the template grid, so that the memory usage does
+    # not depend on the size of the input. Returns wavelength [nm] and AB mag
+    # within the wavelength range covered by the input.
+    flux = np.zeros(grid_wave.size)
+    i_min, i_max = grid_wave.size, 0
+
+    n = 0
+    w_prev, f_prev = np.empty(0), np.empty(0)
+    for df in pd.read_csv(
+        infile, header=None, comment="#", encoding="utf8", chunksize=chunksize
+    ):
+        if df.shape[1] != 2:
+            raise ValueError(
+                f"Custom input spectrum must have exactly two columns, but {df.shape[1]} columns found."
+            )
+        try:
+            values = df.to_numpy(dtype=float)
+        except ValueError:
+            raise ValueError("Custom input spectrum contains non-numeric values.")
+        if not np.all(np.isfinite(values)):
+            raise ValueError("Custom input spectrum contains NaN or infinite values.")
+
+        # the last point of the previous chunk to interpolate across the boundary
+        w = np.concatenate([w_prev, values[:, 0]])
+        f = np.concatenate([f_prev, values[:, 1]])
+        n += values.shape[0]
+
+        if w[0] <= 0:
+            raise ValueError("Wavelength of custom input spectrum must be positive.")
+        if np.any(np.diff(w) <= 0):
+            raise ValueError(
+                "Wavelength of custom input spectrum must be in strictly increasing order."
+            )
+
+        i0 = np.searchsorted(grid_wave, w[0], side="left")
+        i1 = np.searchsorted(grid_wave, w[-1], side="right")
+        if i1 > i0:
+            flux[i0:i1] = np.interp(grid_wave[i0:i1], w, f)
+            i_min, i_max = min(i_min, i0), max(i_max, i1)
+
+        w_prev, f_prev = w[-1:], f[-1:]
+
+    if n < 2:
+        raise ValueError("Custom input spectrum must have at least two data points.")
+    if i_max <= i_min:
+        raise ValueError(
+            f"Custom input spectrum does not cover {grid_wmin:.0f}-{grid_wmax:.0f} Å."
         )
-        with open(target.mag_file, "w") as f:
-            for i in range(len(wout)):
-                f.write(f"{wout[i].value}  {fout[i].value}\n")
+
+    wave = grid_wave[i_min:i_max]
+    # flux density per frequency [erg/s/cm^2/Hz] and AB mag
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mag = -2.5 * np.log10(flux[i_min:i_max] * wave**2 / c_aa) - 48.6
+    mag[~np.isfinite(mag)] = 99.9
+
+    return (wave * u.AA).to_value(u.nm), mag
+
+
+def create_template_spectrum(
+    target,
+    tmpdir: str = ".",
+    cache=None,
+    engine: str = "synphot",
+    custom_store=None,
+):
+
+    if target.custom_input is not None:
+        logger.info("Custom input spectrum detected")
+        if custom_store is None:
+            target.mag_file = os.path.join(tmpdir, "mag_file_template.txt")
+            wout, fout = read_custom_spectrum(BytesIO(target.custom_input))
+            write_mag_file(target.mag_file, wout, fout)
+        else:
+            # prepared once for the same content
+            target.mag_file = custom_store.mag_file(target.custom_input)
         return target, None
 
     if target.template == "Flat in frequency":
@@ -121,11 +530,13 @@ def create_template_spectrum(target, tmpdir: str = "."):
     else:
         target.mag_file = os.path.join(tmpdir, "mag_file_template.txt")
         flag_good_lamnorm = prepare_spectrum(
-            os.path.join(pkgdir, datadir, templatefiles[target.template]),
+            template_path(target.template),
             target.mag_file,
             redshift=target.redshift,
             norm_wavelength=target.wavelength * u.nm,
             norm_mag=target.mag * u.ABmag,
+            cache=cache,
+            engine=engine,
         )
     # else:
     #     raise ValueError(f"Template {target.template} has not yet implemented")
@@ -1,103 +1,192 @@
 #!/usr/bin/env python3
 
 import glob
+import json
 import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
 import panel as pn
 from astropy import units as u
-from astropy.table import Column, QTable, Table
 from bokeh.layouts import column
 from bokeh.models import LinearAxis, Range1d
 from bokeh.palettes import Colorblind
 from bokeh.plotting import ColumnDataSource, figure
 from loguru import logger
 
+from .pfs_etc_params import default_parameters
+from .pfs_etc_sessions import get_simulation_index, shard_pattern, simulation_id_of
+
+# columns of ETC outputs
+simspec_columns = {
+    "wavelength": float,
+    "flux": float,
+    "error": float,
+    "mask": int,
+    "sky": float,
+    "arm": int,
+}
+snline_columns = {
+    "wavelength": float,
+    "fiber_aperture_factor": float,
+    "effective_collecting_area": float,
+    "snline_b": float,
+    "snline_r": float,
+    "snline_n": float,
+    "snline_tot": float,
+}
+sncont_columns = {
+    "arm": int,
+    "pixel": int,
+    "wavelength": float,
+    "sncont": float,
+    "signal_per_exp": float,
+    "noise_wo_obj_per_exp": float,
+    "noise_w_obj_per_exp": float,
+    "input_spec": float,
+    "convfac_flux2e": float,
+    "samplefac": float,
+    "sky": float,
+}
+
+
+# tables in the manifest of a session, in the order returned by PfsSpecSim.load()
+manifest_tables = {
+    "simspec": simspec_columns,
+    "snline": snline_columns,
+    "sncont": sncont_columns,
+}
+
+
+def load_ascii_table(infile: str, columns: dict) -> pd.DataFrame:
+    # numpy parses whitespace-separated numbers in C; the arrays are kept in
+    # the manifest of the session rather than next to the input
+    arr = np.loadtxt(infile, dtype=list(columns.items()), comments="#", ndmin=1)
+    return pd.DataFrame({k: arr[k] for k in columns.keys()})
+
 
 def load_simspec(infile: str) -> pd.DataFrame:
-    df = pd.read_table(
-        infile,
-        sep="\s+",
-        comment="#",
-        header=None,
-        # header=0,
-        names=["wavelength", "flux", "error", "mask", "sky", "arm"],
-        dtype={
-            "wavelength": float,
-            "flux": float,
-            "error": float,
-            "mask": int,
-            "sky": float,
-            "arm": int,
-        },
-    )
-    return df
+    return load_ascii_table(infile, simspec_columns)
 
 
 def load_snline(infile: str) -> pd.DataFrame:
-    df = pd.read_table(
-        infile,
-        sep="\s+",
-        comment="#",
-        header=None,
-        # header=0,
-        names=[
-            "wavelength",
-            "fiber_aperture_factor",
-            "effective_collecting_area",
-            "snline_b",
-            "snline_r",
-            "snline_n",
-            "snline_tot",
-        ],
-        dtype={
-            "wavelength": float,
-            "fiber_aperture_factor": float,
-            "effective_collecting_area": float,
-            "snline_b": float,
-            "snline_r": float,
-            "snline_n": float,
-            "snline_tot": float,
-        },
-    )
-    return df
+    return load_ascii_table(infile, snline_columns)
 
 
 def load_sncont(infile: str) -> pd.DataFrame:
-    df = pd.read_table(
-        infile,
-        sep="\s+",
-        comment="#",
-        header=None,
-        names=[
-            "arm",
-            "pixel",
-            "wavelength",
-            "sncont",
-            "signal_per_exp",
-            "noise_wo_obj_per_exp",
-            "noise_w_obj_per_exp",
-            "input_spec",
-            "convfac_flux2e",
-            "samplefac",
-            "sky",
-        ],
-        dtype={
-            "arm": int,
-            "pixel": int,
-            "wavelength": float,
-            "sncont": float,
-            "signal_per_exp": float,
-            "noise_wo_obj_per_exp": float,
-            "noise_w_obj_per_exp": float,
-            "input_spec": float,
-            "convfac_flux2e": float,
-            "samplefac": float,
-            "sky": float,
-        },
-    )
-    return df
+    return load_ascii_table(infile, sncont_columns)
+
+
+def write_manifest(outfile: str, params: dict, data: tuple):
+    # parameters and result tables of a session in a single binary file, which
+    # is read when the session is opened again
+    arrays = {
+        name: np.rec.fromarrays(
+            [df[k].to_numpy() for k in columns.keys()], names=list(columns.keys())
+        )
+        for (name, columns), df in zip(manifest_tables.items(), data)
+    }
+    fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(outfile)))
+    with os.fdopen(fd, "wb") as f:
+        np.savez(
+            f,
+            params=np.array(json.dumps(params, default=lambda v: v.item())),
+            **arrays,
+        )
+    os.chmod(tmpfile, 0o644)
+    os.replace(tmpfile, outfile)
+
+
+def read_manifest(infile: str, tables: bool = True) -> tuple or None:
+    # (params, (df_simspec, df_snline, df_sncont)), or None without a manifest
+    try:
+        with np.load(infile) as manifest:
+            params = json.loads(manifest["params"].item())
+            if not tables:
+                return params, None
+            data = []
+            for name, columns in manifest_tables.items():
+                arr = manifest[name]
+                data.append(pd.DataFrame({k: arr[k] for k in columns.keys()}))
+    except (OSError, KeyError, ValueError) as e:
+        if os.path.exists(infile):
+            logger.warning(f"Failed to read {infile}: {e}")
+        return None
+    return params, tuple(data)
+
+
+def backfill_manifest(basedir: str, sessiondir: str, dry_run: bool = False) -> bool:
+    # write the manifest of a session of an older version from its tables;
+    # True if written (or to be written)
+    outdir = os.path.join(basedir, sessiondir)
+    simulation_id = simulation_id_of(sessiondir)
+    outfile = os.path.join(outdir, default_parameters.outfile_manifest)
+    infiles = [
+        os.path.join(outdir, f"{default_parameters.outfile_simspec}.dat"),
+        os.path.join(outdir, default_parameters.outfile_sn_line),
+        os.path.join(outdir, default_parameters.outfile_sn_continuum),
+    ]
+    if os.path.exists(outfile) or not all(os.path.exists(f) for f in infiles):
+        return False
+
+    params_file = os.path.join(outdir, default_parameters.outfile_params)
+    if os.path.exists(params_file):
+        with open(params_file) as f:
+            params = json.load(f)
+    else:
+        entry = get_simulation_index(basedir).get(simulation_id)
+        params = None if entry is None else entry["params"]
+    if params is None:
+        params = params_from_ecsv(outdir, simulation_id)
+    if params is None:
+        logger.warning(f"No parameters of {sessiondir} found, skipped")
+        return False
+
+    if dry_run:
+        logger.info(f"Would write {outfile}")
+        return True
+
+    data = (load_simspec(infiles[0]), load_snline(infiles[1]), load_sncont(infiles[2]))
+    write_manifest(outfile, params, data)
+    logger.info(f"{outfile} written")
+    return True
+
+
+def backfill_manifests(
+    basedir: str, dry_run: bool = False, max_workers: int = 8
+) -> dict:
+    # manifests of all sessions in basedir, in the shards of a day and in the
+    # flat layout of older versions
+    sessiondirs = []
+    with os.scandir(basedir) as it:
+        for e in it:
+            if e.name.startswith(".") or not e.is_dir(follow_symlinks=False):
+                continue
+            if shard_pattern.match(e.name) is None:
+                sessiondirs.append(e.name)
+                continue
+            with os.scandir(e.path) as it_shard:
+                for e_shard in it_shard:
+                    if e_shard.is_dir(follow_symlinks=False):
+                        sessiondirs.append(os.path.join(e.name, e_shard.name))
+
+    def backfill(sessiondir):
+        try:
+            return backfill_manifest(basedir, sessiondir, dry_run=dry_run)
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Failed to write the manifest of {sessiondir}: {e}")
+            return False
+
+    # parsing the tables is mostly done in C outside the GIL
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        written = sum(executor.map(backfill, sessiondirs))
+
+    stats = {"sessions": len(sessiondirs), "written": written}
+    logger.info(f"Manifest backfill: {stats}")
+
+    return stats
 
 
 def create_dummy_plot(
@@ -117,6 +206,27 @@ def create_dummy_plot(
     return column(p)
 
 
+def prepare_simspec_plot_data(df: pd.DataFrame, df_sncont: pd.DataFrame):
+    input_spec = df_sncont["input_spec"].to_numpy(copy=True)
+    input_spec[np.isclose(input_spec, np.zeros_like(input_spec))] = np.nan
+    input_spec = (input_spec * u.ABmag).to(u.nJy).value
+
+    ymin, ymax = -np.nanmax(input_spec) * 0.2, np.nanmax(input_spec) * 2
+    ymin2, ymax2 = 0.0, np.nanmax(df_sncont["sncont"]) * 1.5
+
+    df["sncont"] = df_sncont["sncont"]
+    df["input_spec"] = input_spec
+
+    dict_df_arm = dict(
+        b=df.loc[df["arm"] == 0, :],
+        r=df.loc[df["arm"] == 1, :],
+        n=df.loc[df["arm"] == 2, :],
+        m=df.loc[df["arm"] == 3, :],
+    )
+
+    return dict_df_arm, (ymin, ymax), (ymin2, ymax2)
+
+
 def create_simspec_plot(
     df: pd.DataFrame,
     df_snline: pd.DataFrame,
@@ -141,22 +251,7 @@ def create_simspec_plot(
     )
     extra_y_axis_label = "S/N per pixel"
 
-    input_spec = df_sncont["input_spec"].to_numpy()
-    input_spec[np.isclose(input_spec, np.zeros_like(input_spec))] = np.nan
-    input_spec = (input_spec * u.ABmag).to(u.nJy).value
-
-    ymin, ymax = -np.nanmax(input_spec) * 0.2, np.nanmax(input_spec) * 2
-    ymin2, ymax2 = 0.0, np.nanmax(df_sncont["sncont"]) * 1.5
-
-    df["sncont"] = df_sncont["sncont"]
-    df["input_spec"] = input_spec
-
-    dict_df_arm = dict(
-        b=df.loc[df["arm"] == 0, :],
-        r=df.loc[df["arm"] == 1, :],
-        n=df.loc[df["arm"] == 2, :],
-        m=df.loc[df["arm"] == 3, :],
-    )
+    dict_df_arm, (ymin, ymax), (ymin2, ymax2) = prepare_simspec_plot_data(df, df_sncont)
 
     dict_source_arm = dict(
         b=ColumnDataSource(dict_df_arm["b"]),
@@ -287,15 +382,30 @@ def create_simspec_plot(
     )
 
 
-def create_simspec_files(
-    param_target,
-    param_env,
-    param_inst,
-    param_tel,
-    df_simspec: pd.DataFrame,
-    df_snline: pd.DataFrame,
+def update_simspec_plot(
+    p,
+    df: pd.DataFrame,
     df_sncont: pd.DataFrame,
 ):
+    # update a plot made by create_simspec_plot in place, so that only the data
+    # are sent to the browser
+    dict_df_arm, (ymin, ymax), (ymin2, ymax2) = prepare_simspec_plot_data(df, df_sncont)
+
+    for arm, p_arm in zip(["b", "r", "n", "m"], p.children[:4]):
+        source = p_arm.renderers[0].data_source
+        source.data = dict(ColumnDataSource.from_df(dict_df_arm[arm]))
+        p_arm.y_range.start, p_arm.y_range.end = ymin, ymax
+        p_arm.extra_y_ranges["sncont"].start = ymin2
+        p_arm.extra_y_ranges["sncont"].end = ymax2
+
+
+def update_snline_plot(p, df_snline: pd.DataFrame):
+    p.children[4].renderers[0].data_source.data = dict(
+        ColumnDataSource.from_df(df_snline)
+    )
+
+
+def template_info(param_target):
     if param_target.custom_input is None:
         template_type = param_target.template
         template_mag = param_target.mag
@@ -308,80 +418,21 @@ def create_simspec_files(
         # template_mag, template_wave, template_redshift = np.nan, np.nan, np.nan
         # logger.info(template_mag, template_wave, template_redshift)
 
-    # initialize output table
-    tb_out = QTable()
-    tb_out["wavelength"] = Column(
-        df_simspec["wavelength"].to_numpy(),
-        unit="nm",
-        description="Wavelength in vacuum (nm)",
-    )
-    tb_out["flux"] = Column(
-        df_simspec["flux"].to_numpy(), unit="nJy", description="Flux (nJy)"
-    )
-    tb_out["error"] = Column(
-        df_simspec["error"].to_numpy(), unit="nJy", description="Error (nJy)"
-    )
-    tb_out["sn"] = Column(
-        df_sncont["sncont"].to_numpy(),
-        dtype=float,
-        unit="pix^-1",
-        description="S/N per pixel",
-    )
-    tb_out["flux_input"] = Column(
-        (df_sncont["input_spec"].to_numpy() * u.ABmag).to(u.nJy),
-        dtype=float,
-        description="Input flux (nJy)",
-    )
-    tb_out["sky"] = Column(df_simspec["sky"], unit="nJy", description="Sky (nJy)")
-    tb_out["mask"] = Column(
-        df_simspec["mask"], dtype=bool, description="Masked if True"
-    )
-    tb_out["arm"] = Column(
-        df_simspec["arm"], dtype=int, description="Arm ID (0=blue, 1=red, 2=nir, 3=mr)"
-    )
-    tb_out["pixel"] = Column(
-        df_sncont["pixel"], dtype=int, description="Pixel ID in each arm"
-    )
+    return template_type, template_mag, template_wave, template_redshift
 
-    # add meta data
-    tb_out.meta["TMPLSPEC"] = (template_type, "Template type")
-    tb_out.meta["TMPL_MAG"] = (template_mag, "[mag] AB mag to normalize template")
-    tb_out.meta["TMPL_WAV"] = (
-        template_wave,
-        "[nm] Wavelength for normalizing template",
-    )
-    tb_out.meta["TMPL_Z"] = (template_redshift, "Reshift of the template")
-    tb_out.meta["R_EFF"] = (
-        param_target.r_eff,
-        "[arcsec] Effective radius of the target",
-    )
-    tb_out.meta["EXPTIME"] = (
-        param_inst.exp_time * param_inst.exp_num,
-        "[s] Total exposure time",
-    )
-    tb_out.meta["EXPTIME1"] = (param_inst.exp_time, "[s] Single exposure time")
-    tb_out.meta["EXPNUM"] = (param_inst.exp_num, "Number of exposures")
-    tb_out.meta["SEEING"] = (param_env.seeing, "[arcsec] Seeing FWHM")
-    tb_out.meta["ZANG"] = (param_tel.zenith_angle, "[degree] Zenith angle")
-    tb_out.meta["MOON-ZA"] = (param_env.moon_zenith_angle, "[degree] Moon zenith angle")
-    tb_out.meta["MOON-SEP"] = (
-        param_env.moon_target_angle,
-        "[degree] Moon-target separation",
-    )
-    tb_out.meta["MOON-PH"] = (
-        param_env.moon_phase,
-        "Moon phase (0=new, 0.25=quater, 1=new)",
-    )
-    tb_out.meta["FLDANG"] = (
-        param_inst.field_angle,
-        "[degree] PFS field angle (center=0, edge=0.675)",
-    )
-    tb_out.meta["DEGRADE"] = (param_env.degrade, "Throughput degradation factor")
-    tb_out.meta["GAL_EXT"] = (
-        param_target.galactic_extinction,
-        "[mag] E(B-V) of Galactive extinction",
+
+def create_snline_table(
+    param_target,
+    param_env,
+    param_inst,
+    param_tel,
+    df_snline: pd.DataFrame,
+):
+    template_type, template_mag, template_wave, template_redshift = template_info(
+        param_target
     )
-    tb_out.meta["MED_RES"] = (param_inst.mr_mode, "True if medium resolution mode")
+
+    from astropy.table import Column, QTable
 
     # initialize a table for emission line S/N
     tb_snline = QTable()
@@ -474,6 +525,106 @@ def create_simspec_files(
     )
     tb_snline.meta["MED_RES"] = (param_inst.mr_mode, "True if medium resolution mode")
 
+    return tb_snline
+
+
+def create_simspec_table(
+    param_target,
+    param_env,
+    param_inst,
+    param_tel,
+    df_simspec: pd.DataFrame,
+    df_sncont: pd.DataFrame,
+):
+    template_type, template_mag, template_wave, template_redshift = template_info(
+        param_target
+    )
+
+    from astropy.table import Column, QTable
+
+    # initialize output table
+    tb_out = QTable()
+    tb_out["wavelength"] = Column(
+        df_simspec["wavelength"].to_numpy(),
+        unit="nm",
+        description="Wavelength in vacuum (nm)",
+    )
+    tb_out["flux"] = Column(
+        df_simspec["flux"].to_numpy(), unit="nJy", description="Flux (nJy)"
+    )
+    tb_out["error"] = Column(
+        df_simspec["error"].to_numpy(), unit="nJy", description="Error (nJy)"
+    )
+    tb_out["sn"] = Column(
+        df_sncont["sncont"].to_numpy(),
+        dtype=float,
+        unit="pix^-1",
+        description="S/N per pixel",
+    )
+    tb_out["flux_input"] = Column(
+        (df_sncont["input_spec"].to_numpy() * u.ABmag).to(u.nJy),
+        dtype=float,
+        description="Input flux (nJy)",
+    )
+    tb_out["sky"] = Column(df_simspec["sky"], unit="nJy", description="Sky (nJy)")
+    tb_out["mask"] = Column(
+        df_simspec["mask"], dtype=bool, description="Masked if True"
+    )
+    tb_out["arm"] = Column(
+        df_simspec["arm"], dtype=int, description="Arm ID (0=blue, 1=red, 2=nir, 3=mr)"
+    )
+    tb_out["pixel"] = Column(
+        df_sncont["pixel"], dtype=int, description="Pixel ID in each arm"
+    )
+
+    # add meta data
+    tb_out.meta["TMPLSPEC"] = (template_type, "Template type")
+    tb_out.meta["TMPL_MAG"] = (template_mag, "[mag] AB mag to normalize template")
+    tb_out.meta["TMPL_WAV"] = (
+        template_wave,
+        "[nm] Wavelength for normalizing template",
+    )
+    tb_out.meta["TMPL_Z"] = (template_redshift, "Reshift of the template")
+    tb_out.meta["R_EFF"] = (
+        param_target.r_eff,
+        "[arcsec] Effective radius of the target",
+    )
+    tb_out.meta["EXPTIME"] = (
+        param_inst.exp_time * param_inst.exp_num,
+        "[s] Total exposure time",
+    )
+    tb_out.meta["EXPTIME1"] = (param_inst.exp_time, "[s] Single exposure time")
+    tb_out.meta["EXPNUM"] = (param_inst.exp_num, "Number of exposures")
+    tb_out.meta["SEEING"] = (param_env.seeing, "[arcsec] Seeing FWHM")
+    tb_out.meta["ZANG"] = (param_tel.zenith_angle, "[degree] Zenith angle")
+    tb_out.meta["MOON-ZA"] = (param_env.moon_zenith_angle, "[degree] Moon zenith angle")
+    tb_out.meta["MOON-SEP"] = (
+        param_env.moon_target_angle,
+        "[degree] Moon-target separation",
+    )
+    tb_out.meta["MOON-PH"] = (
+        param_env.moon_phase,
+        "Moon phase (0=new, 0.25=quater, 1=new)",
+    )
+    tb_out.meta["FLDANG"] = (
+        param_inst.field_angle,
+        "[degree] PFS field angle (center=0, edge=0.675)",
+    )
+    tb_out.meta["DEGRADE"] = (param_env.degrade, "Throughput degradation factor")
+    tb_out.meta["GAL_EXT"] = (
+        param_target.galactic_extinction,
+        "[mag] E(B-V) of Galactive extinction",
+    )
+    tb_out.meta["MED_RES"] = (param_inst.mr_mode, "True if medium resolution mode")
+
+    return tb_out
+
+
+def create_tj_text(param_target, param_env, param_inst, param_tel) -> str:
+    template_type, template_mag, template_wave, template_redshift = template_info(
+        param_target
+    )
+
     tj_text = f"""The following parameters are used with the PFS spectral simulator:
 [1] Template spectrum: {template_type};
 [2] AB mag: {template_mag};
@@ -492,9 +643,76 @@ def create_simspec_files(
 [15] Zenith angle: {param_tel.zenith_angle};
 """
 
+    return tj_text
+
+
+def create_simspec_files(
+    param_target,
+    param_env,
+    param_inst,
+    param_tel,
+    df_simspec: pd.DataFrame,
+    df_snline: pd.DataFrame,
+    df_sncont: pd.DataFrame,
+):
+    tb_out = create_simspec_table(
+        param_target, param_env, param_inst, param_tel, df_simspec, df_sncont
+    )
+    tb_snline = create_snline_table(
+        param_target, param_env, param_inst, param_tel, df_snline
+    )
+    tj_text = create_tj_text(param_target, param_env, param_inst, param_tel)
+
     return tb_out, tb_snline, tj_text
 
 
+def params_from_ecsv(outdir: str, simulation_id: str) -> dict or None:
+    # parameters of sessions of older versions, which are only in the headers
+    # of the ECSV outputs; None if they are missing
+    from astropy.table import QTable
+
+    try:
+        tb_cont = QTable.read(
+            os.path.join(outdir, f"pfs_etc_simspec-{simulation_id}.ecsv")
+        )
+        tb_line = QTable.read(
+            os.path.join(outdir, f"pfs_etc_snline-{simulation_id}.ecsv")
+        )
+    except FileNotFoundError:
+        return None
+
+    target = {}
+    custom_input = tb_cont.meta["TMPLSPEC"][0] == "Custom"
+    if not custom_input:
+        target["template"] = tb_cont.meta["TMPLSPEC"][0]
+        target["mag"] = tb_cont.meta["TMPL_MAG"][0]
+        target["wavelength"] = tb_cont.meta["TMPL_WAV"][0]
+        target["redshift"] = tb_cont.meta["TMPL_Z"][0]
+    target["galactic_extinction"] = tb_cont.meta["GAL_EXT"][0]
+    target["r_eff"] = tb_cont.meta["R_EFF"][0]
+    target["line_flux"] = tb_line.meta["EL_FLUX"][0]
+    target["line_width"] = tb_line.meta["EL_SIG"][0]
+
+    return {
+        "target": target,
+        "environment": {
+            "seeing": tb_line.meta["SEEING"][0],
+            "degrade": tb_line.meta["DEGRADE"][0],
+            "moon_zenith_angle": tb_line.meta["MOON-ZA"][0],
+            "moon_target_angle": tb_line.meta["MOON-SEP"][0],
+            "moon_phase": tb_line.meta["MOON-PH"][0],
+        },
+        "instrument": {
+            "exp_time": tb_line.meta["EXPTIME1"][0],
+            "exp_num": tb_line.meta["EXPNUM"][0],
+            "field_angle": tb_line.meta["FLDANG"][0],
+            "mr_mode": tb_line.meta["MED_RES"][0],
+        },
+        "telescope": {"zenith_angle": tb_line.meta["ZANG"][0]},
+        "custom_input": custom_input,
+    }
+
+
 def recover_simulation(
     simulation_id,
     conf_target,
@@ -506,56 +724,50 @@ def recover_simulation(
 ):
     dir = conf_output.basedir
 
-    # load the simulation results
-    filename_cont = f"pfs_etc_simspec-{simulation_id}.ecsv"
-    filename_line = f"pfs_etc_snline-{simulation_id}.ecsv"
-
-    try:
-        tb_cont = QTable.read(os.path.join(dir, simulation_id, filename_cont))
-        tb_line = QTable.read(os.path.join(dir, simulation_id, filename_line))
-
-        if tb_cont.meta["TMPLSPEC"][0] != "Custom":
-            conf_target.template = tb_cont.meta["TMPLSPEC"][0]
-            conf_target.mag = tb_cont.meta["TMPL_MAG"][0]
-            conf_target.wavelength = tb_cont.meta["TMPL_WAV"][0]
-            conf_target.redshift = tb_cont.meta["TMPL_Z"][0]
-            custom_input_file = None
-        else:
-            custom_input_file = os.path.join(dir, simulation_id, "custom_input.csv")
-            if os.path.exists(custom_input_file):
-                with open(custom_input_file, "rb") as f:
-                    conf_target.custom_input = f.read()
-                    logger.info("Custom input is used.")
-
-        conf_target.galactic_extinction = tb_cont.meta["GAL_EXT"][0]
-        conf_target.r_eff = tb_cont.meta["R_EFF"][0]
-        conf_target.line_flux = tb_line.meta["EL_FLUX"][0]
-        conf_target.line_width = tb_line.meta["EL_SIG"][0]
-
-        conf_environment.seeing = tb_line.meta["SEEING"][0]
-        conf_environment.degrade = tb_line.meta["DEGRADE"][0]
-        conf_environment.moon_zenith_angle = tb_line.meta["MOON-ZA"][0]
-        conf_environment.moon_target_angle = tb_line.meta["MOON-SEP"][0]
-        conf_environment.moon_phase = tb_line.meta["MOON-PH"][0]
-
-        conf_instrument.exp_time = tb_line.meta["EXPTIME1"][0]
-        conf_instrument.exp_num = tb_line.meta["EXPNUM"][0]
-        conf_instrument.field_angle = tb_line.meta["FLDANG"][0]
-        conf_instrument.mr_mode = tb_line.meta["MED_RES"][0]
-
-        conf_telescope.zenith_angle = tb_line.meta["ZANG"][0]
-
-        logger.info(f"Recovering Simulation ID {simulation_id}")
-
-        is_recovered = True
-
-    except FileNotFoundError:
+    # the directory is looked up in the index, also for the flat layout of
+    # older versions; the returned session directory is relative to basedir
+    index = get_simulation_index(dir)
+    sessiondir = index.resolve(simulation_id)
+    if sessiondir is None:
+        logger.error(f"Simulation ID {simulation_id} not found. No recovery is done.")
+        return None, False, None
+
+    # parameters written by the worker, from the manifest or the index; older
+    # sessions only have the tables
+    manifest = read_manifest(
+        os.path.join(dir, sessiondir, conf_output.manifest), tables=False
+    )
+    if manifest is not None:
+        params = manifest[0]
+    else:
+        entry = index.get(simulation_id)
+        params = None if entry is None else entry["params"]
+    params_file = os.path.join(dir, sessiondir, conf_output.params)
+    if params is None and os.path.exists(params_file):
+        with open(params_file) as f:
+            params = json.load(f)
+
+    if params is None:
+        params = params_from_ecsv(os.path.join(dir, sessiondir), simulation_id)
+    if params is None:
         logger.error(
-            f"File not found, {filename_cont}, {filename_line}. No recovery is done."
+            f"Outputs of Simulation ID {simulation_id} not found. No recovery is done."
         )
+        return None, False, None
+
+    conf_target.param.update(**params["target"])
+    conf_environment.param.update(**params["environment"])
+    conf_instrument.param.update(**params["instrument"])
+    conf_telescope.param.update(**params["telescope"])
+
+    custom_input_file = None
+    if params["custom_input"]:
+        custom_input_file = os.path.join(dir, sessiondir, "custom_input.csv")
+        if os.path.exists(custom_input_file):
+            with open(custom_input_file, "rb") as f:
+                conf_target.custom_input = f.read()
+                logger.info("Custom input is used.")
 
-        simulation_id = None
-        is_recovered = False
-        custom_input_file = None
+    logger.info(f"Recovering Simulation ID {simulation_id}")
 
-    return simulation_id, is_recovered, custom_input_file
+    return sessiondir, True, custom_input_file
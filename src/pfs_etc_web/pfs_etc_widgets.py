@@ -38,7 +38,27 @@ class ExecButtonWidgets:
         self.doc = pn.pane.Markdown(
             "<font size='3'><i class='fa-solid fa-circle-info fa-lg' style='color: #6A589D;'></i> <a href='doc/index.html' target='_blank'>User Guide</a></font>",
         )
-        self.pane = pn.Column(self.doc, pn.Row(self.reset, self.exec, height=50))
+        self.queue_status = pn.pane.Markdown("", visible=False)
+        self.pane = pn.Column(
+            self.doc,
+            pn.Row(self.reset, self.exec, height=50),
+            self.queue_status,
+        )
+
+    def update_queue_status(self, position: int = None, eta: float = None):
+        if position is None:
+            self.queue_status.visible = False
+            return
+
+        if position == 0:
+            text = "Running the simulation"
+        else:
+            text = f"Waiting in the queue (position: {position})"
+        if eta is not None:
+            text += f", ready in about {eta:.0f} s"
+
+        self.queue_status.object = f"<font size='3'><i>{text}</i></font>"
+        self.queue_status.visible = True
 
 
 class TargetWidgets(param.Parameterized):
@@ -120,7 +140,9 @@ class TargetWidgets(param.Parameterized):
             "Input spectrum must be in a CSV format with exactly two columns. "
             "The first column must be the wavelength in [Å] and "
             "the second column must be the flux in [$$\mathrm{erg}$$ $$\mathrm{s}^{-1}$$ $$\mathrm{cm}^{-2}$$ $$\mathrm{Å}^{\ \ \ -1}$$]. "
-            'No header line is needed and lines starting with "#" are regarded as commment. An [example CSV file](https://gist.github.com/monodera/be48be04f376b2db268d0b14ad9cb5e1) is available.',
+            'No header line is needed and lines starting with "#" are regarded as commment. '
+            "The wavelength must be in increasing order and the spectrum is resampled to 0.5 Å between 900 and 13000 Å. "
+            "An [example CSV file](https://gist.github.com/monodera/be48be04f376b2db268d0b14ad9cb5e1) is available.",
             # renderer="myst"
             # markdown-it', 'markdown', 'myst
         )
@@ -269,13 +291,39 @@ class BokehWidgets:
         self.plot_heading = pn.pane.Markdown(
             "<font size=4>**Simulated PFS Spectrum**</font>", visible=visible
         )
+        # simulation shown in the plot
+        self.specsim = None
+        # preview of the continuum for other magnitudes without running the ETC
+        self.mag_slider = pn.widgets.FloatSlider(
+            name="Preview with another magnitude (AB, downloads are not updated)",
+            start=10.0,
+            end=30.0,
+            step=0.1,
+            value=20.0,
+            format="0.0",
+            visible=False,
+            width=600,
+        )
         self.pane = pn.Column(
             self.plot_heading,
+            self.mag_slider,
             self.plot,
             min_width=700,
             width=1200,
         )
 
+    def reset_mag_slider(self, mag: float = None):
+        if mag is None:
+            self.mag_slider.visible = False
+            return
+
+        self.mag_slider.param.update(
+            start=np.floor(mag) - 5.0,
+            end=np.floor(mag) + 5.0,
+            value=mag,
+            visible=True,
+        )
+
 
 class DownloadWidgets:
     def __init__(self, visible: bool = True):
@@ -317,6 +365,15 @@ class DownloadWidgets:
             # button_style="outline",
             visible=visible,
         )
+        # buttons by the kind of output in PfsSpecSim.output_files()
+        self.buttons = {
+            "pfsobject": self.download_pfsobject_fits,
+            "simspec_fits": self.download_simspec_fits,
+            "simspec_ecsv": self.download_simspec_csv,
+            "snline_fits": self.download_snline_fits,
+            "snline_ecsv": self.download_snline_csv,
+            "tjtext": self.download_tjtext,
+        }
         # self.download_heading = pn.pane.Markdown("## Download Results", visible=visible)
         self.download_heading = pn.pane.Markdown(
             "<font size=4>**Download Results**</font>",
@@ -368,3 +425,47 @@ class DownloadWidgets:
         # )
 
         logger.info(f"Simulation ID: {simulation_id}")
+
+
+class BatchWidgets:
+    def __init__(self):
+        self.catalog = pn.widgets.FileInput(accept=".csv", multiple=False)
+        self.exec = pn.widgets.Button(
+            name="Run batch", button_style="outline", button_type="primary"
+        )
+        self.status = pn.pane.Markdown("", visible=False)
+        self.download = pn.widgets.FileDownload(
+            file=None,
+            label="Batch S/N table (.csv)",
+            button_type="default",
+            visible=False,
+        )
+        self.note = pn.pane.Markdown(
+            "Upload a CSV catalog with columns such as `template`, `mag`, `wavelength`, "
+            "`redshift`, `r_eff`, `line_flux`, `line_width`, and `line_wavelength`. "
+            "Missing columns take the default values. "
+            "Rows sharing the observing condition are simulated together.",
+        )
+        self.pane = pn.Column(
+            self.note,
+            self.catalog,
+            self.exec,
+            self.status,
+            self.download,
+        )
+
+    def disabled(self, disabled=True):
+        self.catalog.disabled = disabled
+        self.exec.disabled = disabled
+        self.exec.name = "Running" if disabled else "Run batch"
+
+    def update_status(self, n_done: int = None, n_total: int = None, text: str = None):
+        if n_done is None and text is None:
+            self.status.visible = False
+            return
+
+        if text is None:
+            text = f"{n_done} / {n_total} groups finished"
+
+        self.status.object = f"<font size='3'><i>{text}</i></font>"
+        self.status.visible = True
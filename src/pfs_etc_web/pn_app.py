@@ -1,28 +1,48 @@
 #!/usr/bin/env python3
 
+import asyncio
 import datetime
+import io
 import os
 import secrets
-import threading
-import time
+from functools import partial
 
 import panel as pn
 import param
 from bokeh.resources import INLINE
 from dotenv import dotenv_values
 from loguru import logger
-from panel.io.state import set_curdoc
 
+from .pfs_etc_batch import batch_jobs, read_catalog, write_results
+from .pfs_etc_cache import get_download_counter, get_result_cache, simulation_key
+from .pfs_etc_dataset import has_pyarrow
+from .pfs_etc_executor import (
+    QueueFullError,
+    cancel_session_jobs,
+    get_job_queue,
+    get_writer_pool,
+    submit_simulation,
+)
+from .pfs_etc_noisemodel import rescaled_dataframes, rescaled_snline_dataframe
 from .pfs_etc_params import (
     EnvironmentConf,
     InstrumentConf,
     OutputConf,
     TargetConf,
     TelescopeConf,
+    conf_values,
+)
+from .pfs_etc_retention import parse_size, start_retention, touch_session
+from .pfs_etc_sessions import new_simulation_id, session_path, simulation_id_of
+from .pfs_etc_spectemplates import load_templates, template_engines
+from .pfs_etc_utils import (
+    create_dummy_plot,
+    recover_simulation,
+    update_simspec_plot,
+    update_snline_plot,
 )
-from .pfs_etc_specsim import PfsSpecSim
-from .pfs_etc_utils import create_dummy_plot, recover_simulation
 from .pfs_etc_widgets import (
+    BatchWidgets,
     BokehWidgets,
     DownloadWidgets,
     EnvironmentWidgets,
@@ -38,20 +58,62 @@ class SimulationId(param.Parameterized):
     simulation_id = param.String(default=None)
 
 
-def show_main_panel(panel_plots, panel_downloads, specsim, simulation_id, write=True):
+async def download_output(specsim, kind, outfile, download_counter=None):
+    # called when a download button is clicked; outfile is the one of the run
+    # shown with the button, taken before a later run may start
+    if download_counter is not None:
+        download_counter.count(kind, generated=not os.path.exists(outfile))
+    # written in the writer pool not to block other sessions
+    await asyncio.wrap_future(get_writer_pool().submit(specsim.write_output, kind))
+    return outfile
+
+
+def write_downloads_in_background(panel_downloads, specsim):
+    # each button is enabled when its file is written
+    doc = pn.state.curdoc
+
+    def on_written(button, kind, future):
+        if future.exception() is not None:
+            # the file is written again when the button is clicked
+            logger.error(f"Failed to write {kind}: {future.exception()}")
+        button.disabled = False
+
+    for kind, button in panel_downloads.buttons.items():
+        button.disabled = True
+        future = get_writer_pool().submit(specsim.write_output, kind)
+        future.add_done_callback(
+            lambda f, button=button, kind=kind: doc.add_next_tick_callback(
+                partial(on_written, button, kind, f)
+            )
+        )
+
+
+def show_main_panel(
+    panel_plots,
+    panel_downloads,
+    specsim,
+    simulation_id,
+    write=True,
+    data=None,
+    download_counter=None,
+    background=False,
+):
     panel_plots.pane.visible = False
-    panel_plots.plot.object = specsim.show(write=write)
+    panel_plots.plot.object = specsim.show(write=write, data=data)
 
     logger.info("Set download buttons")
 
-    panel_downloads.download_pfsobject_fits.file = f"{specsim.outfile_pfsobject}"
-    panel_downloads.download_simspec_fits.file = (
-        f"{specsim.outfile_simspec_prefix}.fits"
-    )
-    panel_downloads.download_simspec_csv.file = f"{specsim.outfile_simspec_prefix}.ecsv"
-    panel_downloads.download_snline_fits.file = f"{specsim.outfile_snline_prefix}.fits"
-    panel_downloads.download_snline_csv.file = f"{specsim.outfile_snline_prefix}.ecsv"
-    panel_downloads.download_tjtext.file = f"{specsim.outfile_tjtext}"
+    # files are written when they are downloaded for the first time unless
+    # they are written in the background after the plot is shown
+    for kind, outfile in specsim.output_files().items():
+        panel_downloads.buttons[kind].param.update(
+            file=None,
+            filename=os.path.basename(outfile),
+            callback=partial(download_output, specsim, kind, outfile, download_counter),
+            disabled=False,
+        )
+    if background:
+        write_downloads_in_background(panel_downloads, specsim)
 
     panel_downloads.update_simulation_id(simulation_id)
 
@@ -65,6 +127,12 @@ def show_main_panel(panel_plots, panel_downloads, specsim, simulation_id, write=
     panel_downloads.download_snline_csv.visible = True
     panel_downloads.download_tjtext.visible = True
 
+    # the magnitude cannot be changed for a custom input spectrum
+    panel_plots.specsim = specsim
+    panel_plots.reset_mag_slider(
+        specsim.target.mag if specsim.target.custom_input is None else None
+    )
+
     panel_plots.plot_heading.visible = True
     panel_plots.pane.visible = True
 
@@ -99,6 +167,84 @@ def pfs_etc_app():
 
     logger.info(f"Output directory: {basedir}")
 
+    # template spectra are read only for the first session
+    load_templates()
+
+    if "RESULT_CACHE_SIZE" in config.keys():
+        result_cache_size = int(config["RESULT_CACHE_SIZE"])
+    else:
+        result_cache_size = 1000
+
+    result_cache = get_result_cache(basedir=basedir, maxsize=result_cache_size)
+    download_counter = get_download_counter(basedir=basedir)
+
+    if "NOISE_CACHE_SIZE" in config.keys():
+        noise_cache_size = int(config["NOISE_CACHE_SIZE"])
+    else:
+        noise_cache_size = 1000
+
+    if "SPECTRUM_CACHE_SIZE" in config.keys():
+        spectrum_cache_size = int(config["SPECTRUM_CACHE_SIZE"])
+    else:
+        spectrum_cache_size = 256
+
+    if "SPECTRUM_DISK_CACHE_SIZE" in config.keys():
+        spectrum_disk_cache_size = int(config["SPECTRUM_DISK_CACHE_SIZE"])
+    else:
+        spectrum_disk_cache_size = 10000
+
+    if "CUSTOM_INPUT_CACHE_SIZE" in config.keys():
+        custom_input_cache_size = int(config["CUSTOM_INPUT_CACHE_SIZE"])
+    else:
+        custom_input_cache_size = 100
+
+    if "TEMPLATE_ENGINE" in config.keys():
+        template_engine = config["TEMPLATE_ENGINE"]
+    else:
+        template_engine = "synphot"
+
+    if template_engine not in template_engines.keys():
+        raise ValueError(f"Unknown TEMPLATE_ENGINE: {template_engine}")
+
+    if "MAX_WORKERS" in config.keys():
+        max_workers = int(config["MAX_WORKERS"])
+    else:
+        max_workers = None
+
+    if "DOWNLOAD_FILES" in config.keys():
+        download_files = config["DOWNLOAD_FILES"]
+    else:
+        download_files = "on_demand"
+
+    if download_files not in ["on_demand", "background"]:
+        raise ValueError(f"Unknown DOWNLOAD_FILES: {download_files}")
+
+    if "MAX_QUEUED_JOBS" in config.keys():
+        max_queued_jobs = int(config["MAX_QUEUED_JOBS"])
+    else:
+        max_queued_jobs = 20
+
+    if "RESULT_DATASET" in config.keys():
+        result_dataset = config["RESULT_DATASET"]
+    else:
+        result_dataset = None
+
+    if result_dataset is not None and not has_pyarrow():
+        raise ValueError("RESULT_DATASET requires pyarrow")
+
+    if "OUTPUT_CLEAN_INTERVAL" in config.keys():
+        output_clean_interval = float(config["OUTPUT_CLEAN_INTERVAL"])
+    else:
+        output_clean_interval = 3600.0
+
+    # old outputs are removed in the background only when a quota is given
+    if "OUTPUT_QUOTA" in config.keys():
+        start_retention(
+            basedir=basedir,
+            quota=parse_size(config["OUTPUT_QUOTA"]),
+            interval=output_clean_interval,
+        )
+
     # set simulation_id class
     simulation_id = SimulationId()
 
@@ -120,6 +266,7 @@ def pfs_etc_app():
     panel_environment = EnvironmentWidgets(conf_environment)
     panel_instrument = InstrumentWidgets(conf_instrument)
     panel_telescope = TelescopeWidgets(conf_telescope)
+    panel_batch = BatchWidgets()
 
     # Use a tab layout for input parameters
     tab_inputs = pn.Tabs(
@@ -127,6 +274,7 @@ def pfs_etc_app():
         ("Condition ", panel_environment.panel),
         ("Instrument", panel_instrument.panel),
         ("Telescope ", panel_telescope.panel),
+        ("Batch     ", panel_batch.pane),
     )
 
     # Create button to start computation
@@ -142,7 +290,7 @@ def pfs_etc_app():
     is_recovered = False
 
     if simulation_id.simulation_id not in [None, "null", ""]:
-        recovered_simulation_id, is_recovered, custom_input_file = recover_simulation(
+        recovered_sessiondir, is_recovered, custom_input_file = recover_simulation(
             simulation_id.simulation_id,
             conf_target,
             conf_environment,
@@ -152,7 +300,12 @@ def pfs_etc_app():
             logger,
         )
         if is_recovered:
-            conf_output.sessiondir = recovered_simulation_id
+            # the simulator and its dependencies are imported at the first use
+            # to keep the startup of the server fast
+            from .pfs_etc_specsim import PfsSpecSim
+
+            conf_output.sessiondir = recovered_sessiondir
+            touch_session(basedir, recovered_sessiondir)
             specsim = PfsSpecSim(
                 target=conf_target,
                 environment=conf_environment,
@@ -165,9 +318,16 @@ def pfs_etc_app():
                 panel_plots,
                 panel_downloads,
                 specsim,
-                recovered_simulation_id,
+                simulation_id_of(recovered_sessiondir),
                 write=False,
+                download_counter=download_counter,
+                background=download_files == "background",
             )
+            # sessions of older versions are opened faster the next time
+            if not os.path.exists(
+                os.path.join(basedir, recovered_sessiondir, conf_output.manifest)
+            ):
+                get_writer_pool().submit(specsim.write_manifest)
 
     # Float panel to display some messages
     # panel_initnote = InitNoteWidgets()
@@ -183,15 +343,10 @@ def pfs_etc_app():
     )
     template.main.append(main_column)
 
-    # setup threading
-    c_exec = threading.Condition()
-    c_reset = threading.Condition()
-
-    queue_exec = []
-    queue_reset = []
-
-    # https://github.com/holoviz/panel/issues/5488
-    curdoc = pn.state.curdoc
+    # simulations run in a process pool shared by all sessions
+    session_key = secrets.token_hex(8)
+    # batch jobs are queued separately so that they can be cancelled on their own
+    batch_key = f"{session_key}-batch"
 
     # with set_curdoc(curdoc):
     #     if is_recovered:
@@ -205,187 +360,313 @@ def pfs_etc_app():
     #             duration=0,
     #         )
 
-    def callback_exec():
-        while True:
-            c_exec.acquire()
-            for _ in queue_exec:
-                with set_curdoc(curdoc):
-                    logger.info("callback function is called")
-
-                    session_id = (
-                        datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-                        + "-"
-                        # + "_"
-                        + secrets.token_hex(8)
-                    )
-
-                    simulation_id.simulation_id = session_id
-
-                    logger.info(f"Session ID: {session_id}")
-
-                    conf_output.sessiondir = session_id
-
-                    panel_buttons.exec.disabled = True
-                    panel_buttons.exec.name = "Running"
-
-                    panel_buttons.reset.disabled = True
-
-                    panel_target.disabled(disabled=True)
-                    panel_environment.disabled(disabled=True)
-                    panel_instrument.disabled(disabled=True)
-                    panel_telescope.disabled(disabled=True)
-
-                    panel_plots.plot.object = create_dummy_plot()
-                    panel_plots.plot_heading.visible = False
-
-                    panel_downloads.download_heading.visible = False
-                    panel_downloads.download_pfsobject_fits.visible = False
-                    panel_downloads.download_simspec_fits.visible = False
-                    panel_downloads.download_simspec_csv.visible = False
-                    panel_downloads.download_snline_fits.visible = False
-                    panel_downloads.download_snline_csv.visible = False
-                    panel_downloads.download_tjtext.visible = False
-
-                    specsim = PfsSpecSim(
-                        target=conf_target,
-                        environment=conf_environment,
-                        instrument=conf_instrument,
-                        telescope=conf_telescope,
-                        output=conf_output,
-                    )
-
-                    try:
-                        with pn.param.set_values(panel_plots.pane, loading=True):
-                            logger.info("Running PFS Spectrum Simulator")
-                            specsim.exec(skip=False)
-
-                        logger.info("Plotting simulated spectrum")
-                        show_main_panel(
-                            panel_plots,
-                            panel_downloads,
-                            specsim,
-                            session_id,
-                            write=True,
-                        )
-
-                        # panel_plots.pane.visible = False
-                        # panel_plots.plot.object = specsim.show()
-
-                        # logger.info("Set download buttons")
-                        # panel_downloads.download_pfsobject_fits.file = (
-                        #     f"{specsim.outfile_pfsobject}"
-                        # )
-                        # panel_downloads.download_simspec_fits.file = (
-                        #     f"{specsim.outfile_simspec_prefix}.fits"
-                        # )
-                        # panel_downloads.download_simspec_csv.file = (
-                        #     f"{specsim.outfile_simspec_prefix}.ecsv"
-                        # )
-                        # panel_downloads.download_snline_fits.file = (
-                        #     f"{specsim.outfile_snline_prefix}.fits"
-                        # )
-                        # panel_downloads.download_snline_csv.file = (
-                        #     f"{specsim.outfile_snline_prefix}.ecsv"
-                        # )
-                        # panel_downloads.download_tjtext.file = (
-                        #     f"{specsim.outfile_tjtext}"
-                        # )
-
-                        # panel_downloads.download_heading.visible = True
-                        # panel_downloads.download_pfsobject_fits.visible = True
-                        # panel_downloads.download_simspec_fits.visible = True
-                        # panel_downloads.download_simspec_csv.visible = True
-                        # panel_downloads.download_snline_fits.visible = True
-                        # panel_downloads.download_snline_csv.visible = True
-                        # panel_downloads.download_tjtext.visible = True
-
-                        # panel_plots.plot_heading.visible = True
-                        # panel_plots.pane.visible = True
-
-                        logger.info("Enable the run button")
-                        panel_buttons.exec.name = "Run"
-                        panel_buttons.exec.disabled = False
-                        panel_buttons.reset.disabled = False
-                        panel_target.disabled(disabled=False)
-                        panel_environment.disabled(disabled=False)
-                        panel_instrument.disabled(disabled=False)
-                        panel_telescope.disabled(disabled=False)
-
-                        # panel_plots.pane.save(
-                        #     specsim.outfile_plot,
-                        #     resources=INLINE,
-                        #     title="Simulated PFS Spectrum",
-                        # )
-
-                    except ValueError as e:
-                        # pass
-                        # this does not work for panel 1.2.2
-                        # https://github.com/holoviz/panel/issues/5090
-                        pn.state.notifications.error(f"{str(e)}", duration=0)
-
-                        logger.info("Enable the run button")
-                        panel_buttons.exec.name = "Run"
-                        panel_buttons.exec.disabled = False
-                        panel_buttons.reset.disabled = False
-                        panel_target.disabled(disabled=False)
-                        panel_environment.disabled(disabled=False)
-                        panel_instrument.disabled(disabled=False)
-                        panel_telescope.disabled(disabled=False)
-
-                        simulation_id.simulation_id = None
-
-            queue_exec.clear()
-            c_exec.release()
-            time.sleep(1)
+    def enable_inputs(enabled=True):
+        panel_buttons.exec.name = "Run" if enabled else "Running"
+        panel_buttons.exec.disabled = not enabled
+        panel_buttons.reset.disabled = not enabled
+        panel_target.disabled(disabled=not enabled)
+        panel_environment.disabled(disabled=not enabled)
+        panel_instrument.disabled(disabled=not enabled)
+        panel_telescope.disabled(disabled=not enabled)
+
+    async def callback_exec():
+        logger.info("callback function is called")
+
+        session_id = new_simulation_id()
+
+        simulation_id.simulation_id = session_id
+
+        logger.info(f"Session ID: {session_id}")
+
+        # outputs are stored in a directory per day
+        conf_output.sessiondir = session_path(session_id)
+
+        enable_inputs(False)
+
+        panel_plots.plot.object = create_dummy_plot()
+        panel_plots.plot_heading.visible = False
+        panel_plots.specsim = None
+        panel_plots.reset_mag_slider(None)
+
+        panel_downloads.download_heading.visible = False
+        panel_downloads.download_pfsobject_fits.visible = False
+        panel_downloads.download_simspec_fits.visible = False
+        panel_downloads.download_simspec_csv.visible = False
+        panel_downloads.download_snline_fits.visible = False
+        panel_downloads.download_snline_csv.visible = False
+        panel_downloads.download_tjtext.visible = False
+
+        cache_key = simulation_key(
+            conf_target, conf_environment, conf_instrument, conf_telescope
+        )
+        cached_sessiondir = result_cache.get(cache_key, conf_output)
+
+        if cached_sessiondir is not None:
+            session_id = simulation_id_of(cached_sessiondir)
+            logger.info(f"Reuse results of Session ID {session_id}")
+            simulation_id.simulation_id = session_id
+            conf_output.sessiondir = cached_sessiondir
+            touch_session(basedir, cached_sessiondir)
+
+        try:
+            # arrays of the results passed from the worker process
+            data = None
+            if cached_sessiondir is None:
+                job = submit_simulation(
+                    session_key,
+                    conf_target,
+                    conf_environment,
+                    conf_instrument,
+                    conf_telescope,
+                    conf_output,
+                    noise_cache_size=noise_cache_size,
+                    spectrum_cache_size=spectrum_cache_size,
+                    spectrum_disk_cache_size=spectrum_disk_cache_size,
+                    template_engine=template_engine,
+                    custom_input_cache_size=custom_input_cache_size,
+                    max_workers=max_workers,
+                    max_queued=max_queued_jobs,
+                    result_dataset=result_dataset,
+                )
+                future = asyncio.wrap_future(job.future)
+                try:
+                    with pn.param.set_values(panel_plots.pane, loading=True):
+                        while not future.done():
+                            panel_buttons.update_queue_status(
+                                **get_job_queue().status(job)
+                            )
+                            await asyncio.wait([future], timeout=1.0)
+                finally:
+                    panel_buttons.update_queue_status(None)
+                data = future.result()["data"]
+
+            from .pfs_etc_specsim import PfsSpecSim
+
+            specsim = PfsSpecSim(
+                target=conf_target,
+                environment=conf_environment,
+                instrument=conf_instrument,
+                telescope=conf_telescope,
+                output=conf_output,
+            )
+
+            logger.info("Plotting simulated spectrum")
+            # files for download are written on request
+            show_main_panel(
+                panel_plots,
+                panel_downloads,
+                specsim,
+                session_id,
+                write=False,
+                data=data,
+                download_counter=download_counter,
+                background=download_files == "background",
+            )
+
+            if cached_sessiondir is None:
+                result_cache.put(cache_key, conf_output.sessiondir)
+
+            # panel_plots.pane.save(
+            #     specsim.outfile_plot,
+            #     resources=INLINE,
+            #     title="Simulated PFS Spectrum",
+            # )
+
+        except QueueFullError as e:
+            pn.state.notifications.warning(f"{str(e)}", duration=10000)
+
+            simulation_id.simulation_id = None
+
+        except ValueError as e:
+            # pass
+            # this does not work for panel 1.2.2
+            # https://github.com/holoviz/panel/issues/5090
+            pn.state.notifications.error(f"{str(e)}", duration=0)
+
+            simulation_id.simulation_id = None
+
+        finally:
+            logger.info("Enable the run button")
+            enable_inputs(True)
+
+    def on_change_mag(event):
+        specsim = panel_plots.specsim
+        if specsim is None or not panel_plots.mag_slider.visible:
+            return
+        df_simspec, df_sncont = rescaled_dataframes(
+            specsim.df_simspec,
+            specsim.df_sncont,
+            specsim.params["target"]["mag"],
+            event.new,
+        )
+        update_simspec_plot(panel_plots.plot.object, df_simspec, df_sncont)
+
+    def on_change_line(event):
+        specsim = panel_plots.specsim
+        if specsim is None:
+            return
+
+        # only the emission line properties may differ from the plotted simulation
+        line_keys = ["line_flux", "line_width"]
+        params = {
+            "target": conf_values(conf_target),
+            "environment": conf_values(conf_environment),
+            "instrument": conf_values(conf_instrument),
+            "telescope": conf_values(conf_telescope),
+        }
+        for k in line_keys:
+            params["target"][k] = specsim.params["target"][k]
+        if params != specsim.params:
+            return
+
+        df_snline = rescaled_snline_dataframe(
+            specsim.df_snline,
+            specsim.params["target"]["line_flux"],
+            specsim.params["target"]["line_width"],
+            conf_target.line_flux,
+            conf_target.line_width,
+            exp_time=conf_instrument.exp_time,
+            exp_num=conf_instrument.exp_num,
+            resolving_power=conf_instrument.resolving_power(),
+        )
+        update_snline_plot(panel_plots.plot.object, df_snline)
+        pn.state.notifications.info(
+            "Emission line S/N is re-evaluated without running the simulator. "
+            "Press Run to update the downloads.",
+            duration=5000,
+        )
+
+    async def callback_batch():
+        if panel_batch.catalog.value is None:
+            pn.state.notifications.warning(
+                "Please upload a catalog first.", duration=5000
+            )
+            return
+
+        try:
+            df = read_catalog(io.BytesIO(panel_batch.catalog.value))
+        except ValueError as e:
+            pn.state.notifications.error(f"{str(e)}", duration=0)
+            return
+
+        batch_id = (
+            datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+            + "-batch-"
+            + secrets.token_hex(8)
+        )
+        logger.info(f"Batch ID: {batch_id} ({len(df)} targets)")
+
+        job_queue = get_job_queue(max_workers=max_workers, max_queued=max_queued_jobs)
+
+        panel_batch.disabled(True)
+        panel_batch.download.visible = False
+
+        running = set()
+        try:
+            jobs = batch_jobs(
+                df,
+                basedir=basedir,
+                batch_id=batch_id,
+                noise_cache_size=noise_cache_size,
+                template_engine=template_engine,
+            )
+
+            # groups are submitted as workers become free so that a batch
+            # neither fills the queue nor holds back interactive runs
+            pending = iter(jobs)
+
+            def submit_next():
+                for fn, args, kwargs in pending:
+                    job = job_queue.submit(batch_key, fn, *args, **kwargs)
+                    running.add(asyncio.wrap_future(job.future))
+                    return
+
+            for _ in range(job_queue.max_running):
+                submit_next()
+
+            results = []
+            panel_batch.update_status(0, len(jobs))
+            while len(running) > 0:
+                done, _ = await asyncio.wait(
+                    running, return_when=asyncio.FIRST_COMPLETED
+                )
+                for future in done:
+                    running.discard(future)
+                    results.append(future.result())
+                    submit_next()
+                panel_batch.update_status(len(results), len(jobs))
+
+            outfile = os.path.join(basedir, batch_id, f"pfs_etc_batch-{batch_id}.csv")
+            n = write_results(results, outfile, df_catalog=df)
+            logger.info(f"S/N of {n} targets written in {outfile}")
+
+            panel_batch.update_status(text=f"S/N computed for {n} targets")
+            panel_batch.download.file = outfile
+            panel_batch.download.visible = True
+
+        except QueueFullError as e:
+            panel_batch.update_status(None)
+            pn.state.notifications.warning(f"{str(e)}", duration=10000)
+
+        except ValueError as e:
+            panel_batch.update_status(None)
+            pn.state.notifications.error(f"{str(e)}", duration=0)
+
+        except Exception as e:
+            logger.exception(f"Batch {batch_id} failed: {e}")
+            panel_batch.update_status(None)
+            pn.state.notifications.error(f"Batch failed: {str(e)}", duration=0)
+
+        finally:
+            # groups of a failed batch that have not started are dropped
+            for future in running:
+                future.cancel()
+            cancel_session_jobs(batch_key)
+            panel_batch.disabled(False)
 
     def callback_reset():
-        while True:
-            c_reset.acquire()
-            for _ in queue_reset:
-                logger.info("Reset parameters")
-                conf_target.reset()
-                conf_environment.reset()
-                conf_instrument.reset()
-                conf_telescope.reset()
-
-                simulation_id.simulation_id = None
-
-                panel_plots.plot.object = None
-                panel_plots.plot_heading.visible = False
-
-                panel_downloads.download_heading.visible = False
-                panel_downloads.download_pfsobject_fits.file = None
-                panel_downloads.download_pfsobject_fits.visible = False
-                panel_downloads.download_simspec_fits.file = None
-                panel_downloads.download_simspec_fits.visible = False
-                panel_downloads.download_simspec_csv.file = None
-                panel_downloads.download_simspec_csv.visible = False
-                panel_downloads.download_snline_fits.file = None
-                panel_downloads.download_snline_fits.visible = False
-                panel_downloads.download_snline_csv.file = None
-                panel_downloads.download_snline_csv.visible = False
-                panel_downloads.download_tjtext.file = None
-                panel_downloads.download_tjtext.visible = False
-            queue_reset.clear()
-            c_reset.release()
-            time.sleep(1)
-
-    thread_exec = threading.Thread(target=callback_exec, daemon=True)
-    thread_exec.start()
-
-    thread_reset = threading.Thread(target=callback_reset, daemon=True)
-    thread_reset.start()
-
-    def on_click_exec(event):
+        logger.info("Reset parameters")
+        panel_plots.specsim = None
+        conf_target.reset()
+        conf_environment.reset()
+        conf_instrument.reset()
+        conf_telescope.reset()
+
+        simulation_id.simulation_id = None
+
+        panel_plots.plot.object = None
+        panel_plots.plot_heading.visible = False
+        panel_plots.reset_mag_slider(None)
+
+        panel_downloads.download_heading.visible = False
+        for button in panel_downloads.buttons.values():
+            button.param.update(file=None, callback=None, visible=False)
+
+    async def on_click_exec(event):
         pn.state.location.unsync(simulation_id, {"simulation_id": "id"})
-        queue_exec.append(event)
+        await callback_exec()
 
     def on_click_reset(event):
         pn.state.location.unsync(simulation_id, {"simulation_id": "id"})
-        queue_reset.append(event)
+        callback_reset()
+
+    async def on_click_batch(event):
+        await callback_batch()
+
+    def on_session_destroyed(session_context):
+        # jobs still waiting in the queue are no longer needed
+        cancel_session_jobs(session_key)
+        cancel_session_jobs(batch_key)
+        # access times of cache hits are otherwise written at intervals
+        result_cache.flush()
 
     # Define an action on click
     panel_buttons.exec.on_click(on_click_exec)
     panel_buttons.reset.on_click(on_click_reset)
+    panel_batch.exec.on_click(on_click_batch)
+    panel_plots.mag_slider.param.watch(on_change_mag, "value")
+    conf_target.param.watch(on_change_line, ["line_flux", "line_width"])
+
+    pn.state.on_session_destroyed(on_session_destroyed)
 
     return template.servable()
@@ -1,6 +1,11 @@
 #!/usr/bin/env python3
 
+import argparse
+import json
 import os
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import numpy as np
 import synphot
@@ -12,6 +17,16 @@ from specutils import Spectrum1D
 from specutils.io.registers import custom_writer
 from specutils.manipulation import FluxConservingResampler, LinearInterpolatedResampler
 
+from pfs_etc_web.pfs_etc_spectemplates import (
+    build_template_bundle,
+    file_checksum,
+    template_path,
+    templatefiles,
+)
+
+# grid of the output templates; changing it invalidates all outputs in the manifest
+resample_params = {"wmin": 900.0, "wmax": 13000.0, "dw": 0.5}
+
 
 @custom_writer("fits-table-writer")
 def generic_fits_table(spectrum, file_name, **kwargs):
@@ -87,7 +102,12 @@ def read_stsci(file_dict):
 #     return
 
 
-def resample_spec(input_spec, wmin=900 * u.AA, wmax=13000 * u.AA, dw=0.5 * u.AA):
+def resample_spec(
+    input_spec,
+    wmin=resample_params["wmin"] * u.AA,
+    wmax=resample_params["wmax"] * u.AA,
+    dw=resample_params["dw"] * u.AA,
+):
     new_disp_grid = np.linspace(wmin, wmax, int((wmax - wmin) / dw) + 1)
     # resampler = FluxConservingResampler()
     resampler = LinearInterpolatedResampler(extrapolation_treatment="zero_fill")
@@ -117,8 +137,70 @@ def main(k, v):
 
     # print(wave_new, flux_new)
 
+    return v["outfile"], manifest_entry(v)
+
+
+def manifest_entry(v):
+    # everything an output depends on
+    return {
+        "infile": os.path.basename(v["infile"]),
+        "sha256": file_checksum(v["infile"]),
+        "library": v["library"],
+        "resample": resample_params,
+    }
+
+
+def read_manifest(manifest_file):
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def write_manifest(manifest, manifest_file):
+    fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(manifest_file)))
+    with os.fdopen(fd, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.chmod(tmpfile, 0o644)
+    os.replace(tmpfile, manifest_file)
+
+
+def is_up_to_date(v, manifest):
+    return os.path.exists(v["outfile"]) and manifest.get(
+        os.path.basename(v["outfile"])
+    ) == manifest_entry(v)
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        description="Resample input spectra to the template grid used by the ETC"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Regenerate all templates even if their inputs are unchanged.",
+    )
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="Also regenerate the stellar, MILES and quasar templates (infile_dict).",
+    )
+    parser.add_argument(
+        "--max-workers",
+        dest="max_workers",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: CPU count).",
+    )
+
+    args = parser.parse_args()
+
+    return args
+
 
 if __name__ == "__main__":
+    args = get_arguments()
+
     indir = "input"
     outdir = "output"
 
@@ -282,10 +364,43 @@ if __name__ == "__main__":
         },
     }
 
-    # for k, v in infile_dict.items():
-    #     print(k, v)
-    #     main(k, v)
+    # SWIRE templates are made from the original SED rather than infile_stsci_swire;
+    # the other templates are kept as they are unless --all is given
+    infile_all = dict(infile_swire_original)
+    if args.all:
+        infile_all = {**infile_dict, **infile_swire_original}
+
+    manifest_file = os.path.join(outdir, "manifest.json")
+    manifest = read_manifest(manifest_file)
+
+    todo = {}
+    for k, v in infile_all.items():
+        if not os.path.exists(v["infile"]):
+            print(f"WARNING: {k}: input {v['infile']} not found, skipped")
+        elif not args.force and is_up_to_date(v, manifest):
+            print(f"{k}: {v['outfile']} is up to date")
+        else:
+            todo[k] = v
+
+    with ProcessPoolExecutor(max_workers=args.max_workers) as executor:
+        futures = {executor.submit(main, k, v): k for k, v in todo.items()}
+        for future in as_completed(futures):
+            outfile, entry = future.result()
+            print(f"{futures[future]}: {outfile} written")
+            manifest[os.path.basename(outfile)] = entry
+            # saved as soon as possible so that finished outputs are not redone
+            write_manifest(manifest, manifest_file)
+
+    # the bundle must have all templates of the app
+    missing = [
+        k
+        for k in templatefiles.keys()
+        if template_path(k) is not None and not os.path.exists(template_path(k))
+    ]
+    if len(missing) > 0:
+        sys.exit(
+            f"ERROR: templates of {', '.join(missing)} not found, no bundle written"
+        )
 
-    for k, v in infile_swire_original.items():
-        print(k, v)
-        main(k, v)
+    # pack the templates of the app into a single file memory-mapped by the app
+    build_template_bundle()
@@ -1,17 +1,49 @@
 #!/usr/bin/env python
 
+import argparse
+import json
 import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
 import matplotlib.pyplot as plt
 import seaborn as sns
 import synphot
 from astropy import units as u
-from astropy.io.fits import getval
+
+from pfs_etc_web.pfs_etc_spectemplates import file_checksum
 
 # plt.style.use("seaborn-v0_8-colorblind")
 # plt.style.use("tableau-colorblind10")
 
 
+def normalize_spectrum(
+    infile,
+    norm_wavelength: u.Quantity = 550.0 * u.nm,
+    norm_mag: u.Quantity = 20.0 * u.ABmag,
+    norm_bandwidth: u.Quantity = 10.0 * u.nm,
+):
+    band = synphot.SpectralElement(
+        synphot.models.Box1D,
+        amplitude=1.0,
+        x_0=norm_wavelength,
+        width=norm_bandwidth,
+    )
+
+    sp_rest = synphot.SourceSpectrum.from_file(
+        infile,
+        # wave_unit=u.AA,
+        # flux_unit=u.erg / u.s / u.cm**2 / u.AA,
+    )
+
+    sp_norm = sp_rest.normalize(norm_mag, band=band)
+
+    wout = sp_norm.waveset.to(u.nm).value
+    fout = sp_norm(sp_norm.waveset, flux_unit=u.ABmag).value
+
+    return wout, fout
+
+
 def plot_spectra(
     spec,
     ax=None,
@@ -24,30 +56,20 @@ def plot_spectra(
     sample=1,
     ncol_legend=1,
     pltkwargs={},
+    spectra=None,
 ):
-
-    band = synphot.SpectralElement(
-        synphot.models.Box1D,
-        amplitude=1.0,
-        x_0=norm_wavelength,
-        width=norm_bandwidth,
-    )
+    # spectra: normalized spectra by file name to avoid reading them again
 
     for k, v in spec.items():
-        infile = os.path.join(specdir, v)
-        sp_rest = synphot.SourceSpectrum.from_file(
-            infile,
-            # wave_unit=u.AA,
-            # flux_unit=u.erg / u.s / u.cm**2 / u.AA,
-        )
-        # min/max wavelenghth supported in the original template
-        wmin0 = getval(infile, "WAVE_MIN", 1)  # angstrom
-        wmax0 = getval(infile, "WAVE_MAX", 1)  # angstrom
-
-        sp_norm = sp_rest.normalize(norm_mag, band=band)
-
-        wout = sp_norm.waveset.to(u.nm).value
-        fout = sp_norm(sp_norm.waveset, flux_unit=u.ABmag).value
+        if spectra is not None and v in spectra:
+            wout, fout = spectra[v]
+        else:
+            wout, fout = normalize_spectrum(
+                os.path.join(specdir, v),
+                norm_wavelength=norm_wavelength,
+                norm_mag=norm_mag,
+                norm_bandwidth=norm_bandwidth,
+            )
 
         ax.plot(wout[::sample], fout[::sample], label=k, **pltkwargs)
 
@@ -61,7 +83,86 @@ def plot_spectra(
     # fig.legend(loc="outside upper right")
 
 
+def render_figure(name, layout, panels, spectra, plotdir="."):
+    # layout: (nrows, ncols, figsize, {panel name: (row, column)})
+    nrows, ncols, figsize, positions = layout
+
+    sns.set_style("whitegrid")
+    sns.set_context("notebook")
+    # sns.set_palette(sns.color_palette("flare", len(spec.keys())))
+    fig, ax = plt.subplots(
+        ncols=ncols,
+        nrows=nrows,
+        figsize=figsize,
+        gridspec_kw={"hspace": 0.2, "wspace": 0.15},
+        squeeze=False,
+    )
+
+    for prefix, (i, j) in positions.items():
+        spec, kwargs = panels[prefix]
+        plot_spectra(
+            spec,
+            ax=ax[i, j],
+            plot_prefix=prefix,
+            plotdir=plotdir,
+            spectra=spectra,
+            **kwargs,
+        )
+
+    plt.savefig(os.path.join(plotdir, f"{name}.pdf"), bbox_inches="tight")
+    plt.savefig(os.path.join(plotdir, f"{name}.png"), dpi=300, bbox_inches="tight")
+    plt.close(fig)
+
+    return name
+
+
+def figure_entry(layout, panels, specdir="."):
+    # everything a figure depends on; the script itself covers style changes
+    files = sorted({v for k in layout[3] for v in panels[k][0].values()})
+    return {
+        "inputs": {f: file_checksum(os.path.join(specdir, f)) for f in files},
+        "script": file_checksum(os.path.abspath(__file__)),
+    }
+
+
+def read_manifest(manifest_file):
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def write_manifest(manifest, manifest_file):
+    fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(manifest_file)))
+    with os.fdopen(fd, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.chmod(tmpfile, 0o644)
+    os.replace(tmpfile, manifest_file)
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="Plot spectral templates")
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Render all figures even if their inputs are unchanged.",
+    )
+    parser.add_argument(
+        "--max-workers",
+        dest="max_workers",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: CPU count).",
+    )
+
+    args = parser.parse_args()
+
+    return args
+
+
 if __name__ == "__main__":
+    args = get_arguments()
+
     specdir = "output"
     plotdir = "figures"
     spec_stars = {
@@ -96,60 +197,80 @@ if __name__ == "__main__":
         "Quasar": "quasar.fits",
     }
 
-    sns.set_style("whitegrid")
-    sns.set_context("notebook")
-    # sns.set_palette(sns.color_palette("flare", len(spec.keys())))
-    fig, ax = plt.subplots(
-        ncols=2,
-        nrows=2,
-        figsize=(16, 9),
-        gridspec_kw={"hspace": 0.2, "wspace": 0.15},
-    )
+    panels = {
+        "stars": (
+            spec_stars,
+            {"sample": 25, "ncol_legend": 2, "pltkwargs": {"lw": 1, "alpha": 0.8}},
+        ),
+        "galaxy_ssp": (
+            spec_ssp,
+            {"ncol_legend": 1, "pltkwargs": {"lw": 1, "alpha": 0.8}},
+        ),
+        "galaxy_swire": (
+            spec_swire,
+            {"ncol_legend": 2, "pltkwargs": {"lw": 1, "alpha": 0.8}},
+        ),
+        "quasar": (
+            spec_quasar,
+            {"pltkwargs": {"lw": 1, "alpha": 0.8}},
+        ),
+    }
 
-    plot_spectra(
-        spec_stars,
-        ax=ax[1, 1],
-        plot_prefix="stars",
-        specdir=specdir,
-        plotdir=plotdir,
-        sample=25,
-        ncol_legend=2,
-        pltkwargs={"lw": 1, "alpha": 0.8},
+    # a figure for each library and one with all of them
+    layouts = {k: (1, 1, (7, 4), {k: (0, 0)}) for k in panels.keys()}
+    layouts["template_spectra"] = (
+        2,
+        2,
+        (16, 9),
+        {
+            "galaxy_ssp": (0, 0),
+            "galaxy_swire": (0, 1),
+            "quasar": (1, 0),
+            "stars": (1, 1),
+        },
     )
 
-    plot_spectra(
-        spec_ssp,
-        ax=ax[0, 0],
-        plot_prefix="galaxy_ssp",
-        specdir=specdir,
-        plotdir=plotdir,
-        # sample=25,
-        ncol_legend=1,
-        pltkwargs={"lw": 1, "alpha": 0.8},
-    )
+    manifest_file = os.path.join(plotdir, "manifest.json")
+    manifest = read_manifest(manifest_file)
 
-    plot_spectra(
-        spec_swire,
-        ax=ax[0, 1],
-        plot_prefix="galaxy_swire",
-        specdir=specdir,
-        plotdir=plotdir,
-        # sample=25,
-        ncol_legend=2,
-        pltkwargs={"lw": 1, "alpha": 0.8},
-    )
+    entries = {k: figure_entry(v, panels, specdir=specdir) for k, v in layouts.items()}
 
-    plot_spectra(
-        spec_quasar,
-        ax=ax[1, 0],
-        plot_prefix="quasar",
-        specdir=specdir,
-        plotdir=plotdir,
-        # sample=25,
-        # ncol_legend=2,
-        pltkwargs={"lw": 1, "alpha": 0.8},
-    )
-    plt.savefig(os.path.join(plotdir, "template_spectra.pdf"), bbox_inches="tight")
-    plt.savefig(
-        os.path.join(plotdir, "template_spectra.png"), dpi=300, bbox_inches="tight"
-    )
+    todo = []
+    for k in layouts.keys():
+        exists = all(
+            os.path.exists(os.path.join(plotdir, f"{k}.{ext}"))
+            for ext in ["pdf", "png"]
+        )
+        if not args.force and exists and manifest.get(k) == entries[k]:
+            print(f"{k}: up to date")
+        else:
+            todo.append(k)
+
+    with ProcessPoolExecutor(max_workers=args.max_workers) as executor:
+        # each template is read and normalized once for all figures
+        files = sorted({f for k in todo for f in entries[k]["inputs"].keys()})
+        spectra = dict(
+            zip(
+                files,
+                executor.map(
+                    normalize_spectrum, [os.path.join(specdir, f) for f in files]
+                ),
+            )
+        )
+
+        futures = {
+            k: executor.submit(
+                render_figure,
+                k,
+                layouts[k],
+                panels,
+                {f: spectra[f] for f in entries[k]["inputs"].keys()},
+                plotdir=plotdir,
+            )
+            for k in todo
+        }
+        for k, future in futures.items():
+            future.result()
+            print(f"{k}: rendered")
+            manifest[k] = entries[k]
+            write_manifest(manifest, manifest_file)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+import json
+import os
+
+import pytest
+
+from pfs_etc_web.pfs_etc_cache import CustomInputStore, ResultCache, session_artifacts
+from pfs_etc_web.pfs_etc_params import OutputConf
+
+
+def make_session(basedir, sessiondir, output):
+    os.makedirs(os.path.join(basedir, sessiondir))
+    for f in session_artifacts(basedir, sessiondir, output):
+        open(f, "w").close()
+
+
+def read_index(cache):
+    with open(cache.index_file) as f:
+        return [k for k, _ in json.load(f)]
+
+
+def test_hits_are_written_at_intervals(tmp_path):
+    basedir = str(tmp_path)
+    output = OutputConf(basedir=basedir)
+    for k in ["a", "b"]:
+        make_session(basedir, f"20240101/20240101-000000-{k}", output)
+
+    cache = ResultCache(basedir=basedir, flush_interval=3600.0)
+    cache.put("a", "20240101/20240101-000000-a")
+    cache.put("b", "20240101/20240101-000000-b")
+    mtime = os.stat(cache.index_file).st_mtime_ns
+
+    for _ in range(10):
+        assert cache.get("a", output) == "20240101/20240101-000000-a"
+
+    # the order is updated in memory only until the cache is flushed
+    assert os.stat(cache.index_file).st_mtime_ns == mtime
+    assert read_index(cache) == ["a", "b"]
+
+    cache.flush()
+    assert read_index(cache) == ["b", "a"]
+    assert ResultCache(basedir=basedir).get("b", output) is not None
+
+
+def test_incomplete_entries_are_removed(tmp_path):
+    basedir = str(tmp_path)
+    output = OutputConf(basedir=basedir)
+    make_session(basedir, "20240101/20240101-000000-a", output)
+
+    cache = ResultCache(basedir=basedir)
+    cache.put("a", "20240101/20240101-000000-a")
+    os.remove(session_artifacts(basedir, "20240101/20240101-000000-a", output)[0])
+
+    assert cache.get("a", output) is None
+    assert read_index(cache) == []
+
+
+custom_input = b"4000,1e-17\n5000,2e-17\n6000,1e-17\n"
+
+
+def test_custom_input_without_raw_file_is_stored_again(tmp_path):
+    store = CustomInputStore(basedir=str(tmp_path))
+    key = store.put(custom_input)
+    os.remove(store.raw_file(key))
+
+    assert store.put(custom_input) == key
+    with open(store.raw_file(key), "rb") as f:
+        assert f.read() == custom_input
+
+    # and stored again when linked into a session
+    os.remove(store.raw_file(key))
+    outfile = tmp_path / "custom_input.csv"
+    store.link_raw_file(custom_input, str(outfile))
+    assert outfile.read_bytes() == custom_input
+
+
+def test_invalid_custom_input_is_not_stored(tmp_path):
+    store = CustomInputStore(basedir=str(tmp_path))
+
+    with pytest.raises(ValueError):
+        store.put(b"4000,abc\n5000,1e-17\n")
+
+    assert os.listdir(store.storedir) == []
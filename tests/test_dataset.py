@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pfs_etc_web.pfs_etc_dataset import append_result, compact_results, query_results
+from pfs_etc_web.pfs_etc_params import (
+    EnvironmentConf,
+    InstrumentConf,
+    TargetConf,
+    TelescopeConf,
+    conf_values,
+)
+from pfs_etc_web.pfs_etc_utils import manifest_tables
+
+pytest.importorskip("pyarrow")
+
+
+def add_results(root, simulation_id, seeing):
+    params = {
+        "target": conf_values(TargetConf()),
+        "environment": conf_values(EnvironmentConf(seeing=seeing)),
+        "instrument": conf_values(InstrumentConf()),
+        "telescope": conf_values(TelescopeConf()),
+        "custom_input": False,
+    }
+    data = tuple(
+        pd.DataFrame({k: np.arange(4, dtype=v) for k, v in columns.items()})
+        for columns in manifest_tables.values()
+    )
+    append_result(root, simulation_id, params, data)
+
+
+def test_compact_results(tmp_path):
+    root = str(tmp_path)
+    for i, seeing in enumerate([0.5, 0.6, 0.7, 0.8, 0.9]):
+        add_results(root, f"20240101-00000{i}-ab", seeing)
+    # a day not finished yet is left as it is
+    add_results(root, "20990101-000000-ab", 0.8)
+
+    def query(**kwargs):
+        return (
+            query_results(root, "sncont", **kwargs)
+            .sort_values(["simulation_id", "pixel"])
+            .reset_index(drop=True)
+        )
+
+    before = query()
+
+    stats = compact_results(root)
+
+    assert stats == {"partitions": 3, "files": 15}
+    for table in manifest_tables.keys():
+        assert len(os.listdir(tmp_path / table / "date=20240101")) == 1
+        assert len(os.listdir(tmp_path / table / "date=20990101")) == 1
+    assert query().equals(before)
+    assert len(query(filters=[("environment.seeing", "==", 0.8)])) == 8
+
+    # new files of a compacted day are merged with the compacted one
+    add_results(root, "20240101-000005-ab", 1.0)
+    assert compact_results(root)["files"] == 6
+    assert len(query()) == len(before) + 4
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from pfs_etc_web.pfs_etc_executor import JobQueue, QueueFullError
+
+
+@pytest.fixture
+def gate():
+    # jobs wait for the gate
+    return threading.Event()
+
+
+@pytest.fixture
+def executor(gate):
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        yield executor
+        # opened at the end of a failed test too, before the pool is shut down
+        gate.set()
+
+
+def test_sessions_are_served_in_turn(executor, gate):
+    queue = JobQueue(executor, max_running=1, max_queued=10)
+    order = []
+
+    def run(name):
+        gate.wait()
+        order.append(name)
+
+    jobs = [queue.submit("a", run, f"a{i}") for i in range(3)]
+    jobs += [queue.submit("b", run, "b0"), queue.submit("c", run, "c0")]
+
+    # a0 is running, and the sessions without a running job go first
+    assert queue.status(jobs[0])["position"] == 0
+    assert [queue.status(job)["position"] for job in jobs[1:]] == [3, 4, 1, 2]
+
+    gate.set()
+    for job in jobs:
+        job.future.result(timeout=10)
+    assert order == ["a0", "b0", "c0", "a1", "a2"]
+
+
+def test_queue_full(executor, gate):
+    queue = JobQueue(executor, max_running=1, max_queued=2)
+
+    running = queue.submit("a", gate.wait)
+    waiting = [queue.submit("a", gate.wait), queue.submit("b", gate.wait)]
+    with pytest.raises(QueueFullError):
+        queue.submit("c", gate.wait)
+    assert queue.stats()["waiting"] == 2
+
+    # cancelled jobs leave room for others
+    queue.cancel_session("a")
+    assert waiting[0].future.cancelled()
+    job = queue.submit("c", gate.wait)
+
+    gate.set()
+    for j in [running, waiting[1], job]:
+        j.future.result(timeout=10)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import json
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("panel")
+
+from pfs_etc_web.pfs_etc_params import default_parameters  # noqa: E402
+from pfs_etc_web.pfs_etc_utils import (  # noqa: E402
+    backfill_manifests,
+    manifest_tables,
+    read_manifest,
+)
+
+params = {
+    "target": {"mag": 22.0},
+    "environment": {"seeing": 0.8},
+    "instrument": {"exp_time": 900},
+    "telescope": {"zenith_angle": 45.0},
+    "custom_input": False,
+}
+
+
+def make_session(basedir, sessiondir, with_params=True):
+    # ETC outputs of an older version without a manifest
+    outdir = os.path.join(basedir, sessiondir)
+    os.makedirs(outdir)
+    outfiles = [
+        f"{default_parameters.outfile_simspec}.dat",
+        default_parameters.outfile_sn_line,
+        default_parameters.outfile_sn_continuum,
+    ]
+    for outfile, columns in zip(outfiles, manifest_tables.values()):
+        np.savetxt(
+            os.path.join(outdir, outfile),
+            np.arange(3 * len(columns)).reshape(3, len(columns)),
+            fmt="%d",
+            header=" ".join(columns.keys()),
+        )
+    if with_params:
+        with open(os.path.join(outdir, default_parameters.outfile_params), "w") as f:
+            json.dump(params, f)
+    return outdir
+
+
+def test_backfill_manifests(tmp_path):
+    outdirs = [
+        make_session(str(tmp_path), os.path.join("20240101", "20240101-000000-aa")),
+        make_session(str(tmp_path), "abcdef"),
+        # neither parameters nor ECSV outputs
+        make_session(str(tmp_path), "ghijkl", with_params=False),
+    ]
+    os.makedirs(tmp_path / "empty")
+
+    stats = backfill_manifests(str(tmp_path), dry_run=True)
+    assert stats == {"sessions": 4, "written": 2}
+    assert not any(
+        os.path.exists(os.path.join(d, default_parameters.outfile_manifest))
+        for d in outdirs
+    )
+
+    stats = backfill_manifests(str(tmp_path))
+    assert stats == {"sessions": 4, "written": 2}
+    for outdir in outdirs[:2]:
+        p, data = read_manifest(
+            os.path.join(outdir, default_parameters.outfile_manifest)
+        )
+        assert p == params
+        assert [len(df) for df in data] == [3, 3, 3]
+        assert list(data[2].columns) == list(manifest_tables["sncont"].keys())
+
+    # existing manifests are kept
+    assert backfill_manifests(str(tmp_path))["written"] == 0
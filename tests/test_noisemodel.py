@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pfs_etc_web.pfs_etc_noisemodel import (
+    NoiseModel,
+    rescale_magnitude,
+    rescale_snline,
+    sn_curve,
+    solve_exptime,
+)
+
+exp_time = 900.0
+exp_num = 4
+mag0 = 22.0
+
+
+@pytest.fixture
+def df_sncont():
+    # ten pixels per arm with object, sky and read noise variances of an
+    # exposure of exp_time
+    rng = np.random.default_rng(0)
+    n = 10
+    signal = rng.uniform(10.0, 100.0, 3 * n)
+    var_sky = rng.uniform(50.0, 200.0, 3 * n)
+    var_const = rng.uniform(10.0, 30.0, 3 * n)
+    var_wo_obj = var_sky + var_const
+    var_w_obj = var_wo_obj + signal
+    return pd.DataFrame(
+        {
+            "arm": np.repeat([0, 1, 2], n),
+            "pixel": np.tile(np.arange(n), 3),
+            "wavelength": np.concatenate(
+                [
+                    np.linspace(400, 600, n),
+                    np.linspace(650, 950, n),
+                    np.linspace(1000, 1250, n),
+                ]
+            ),
+            "sncont": np.sqrt(exp_num) * signal / np.sqrt(var_w_obj),
+            "signal_per_exp": signal,
+            "noise_wo_obj_per_exp": np.sqrt(var_wo_obj),
+            "noise_w_obj_per_exp": np.sqrt(var_w_obj),
+            "sky": var_sky,
+            # zero where there is no input spectrum
+            "input_spec": np.where(np.arange(3 * n) % 7 == 0, 0.0, mag0),
+        }
+    )
+
+
+@pytest.fixture
+def df_simspec(df_sncont):
+    # expected flux plus noise, the error of the ETC being noise / signal x flux
+    rng = np.random.default_rng(1)
+    error = rng.uniform(0.1, 1.0, len(df_sncont))
+    flux = df_sncont["sncont"].to_numpy() * error + rng.normal(0.0, error)
+    return pd.DataFrame(
+        {"wavelength": df_sncont["wavelength"], "flux": flux, "error": error}
+    )
+
+
+def test_sn_curve_reproduces_the_etc(df_sncont):
+    model = NoiseModel.from_sncont(df_sncont, exp_time, exp_num)
+
+    sn = sn_curve(model, exp_time, exp_num)
+
+    assert np.allclose(sn, df_sncont["sncont"])
+
+
+def test_sn_curve_broadcasts(df_sncont):
+    model = NoiseModel.from_sncont(df_sncont, exp_time, exp_num)
+
+    sn = sn_curve(model, [[450.0], [900.0]], [1, 2, 4])
+
+    assert sn.shape == (2, 3, len(df_sncont))
+    assert np.allclose(sn[1, 2], df_sncont["sncont"])
+    # S/N increases with the exposure time and the number of exposures
+    assert np.all(np.diff(sn, axis=0) > 0)
+    assert np.all(np.diff(sn, axis=1) > 0)
+
+
+@pytest.mark.parametrize("sn", [1.0, 5.0, 20.0])
+def test_solve_exptime_at_a_wavelength(df_sncont, sn):
+    model = NoiseModel.from_sncont(df_sncont, exp_time, exp_num)
+    mask = model.select(wavelength=800.0)
+
+    t = solve_exptime(model, sn, wavelength=800.0, exp_num=2)
+
+    assert sn_curve(model, t, 2, mask=mask)[0] == pytest.approx(sn)
+
+
+@pytest.mark.parametrize("arm", ["b", "r", "n"])
+def test_solve_exptime_for_an_arm(df_sncont, arm):
+    model = NoiseModel.from_sncont(df_sncont, exp_time, exp_num)
+    mask = model.select(arm=arm)
+
+    t = solve_exptime(model, 10.0, arm=arm, exp_num=2, rtol=1e-8)
+
+    assert np.median(sn_curve(model, t, 2, mask=mask)) == pytest.approx(10.0)
+
+
+def test_solve_exptime_unreachable(df_sncont):
+    model = NoiseModel.from_sncont(df_sncont, exp_time, exp_num)
+
+    assert solve_exptime(model, 1e6, wavelength=800.0, tmax=3600.0) == np.inf
+    assert solve_exptime(model, 1e6, arm="r", tmax=3600.0) == np.inf
+
+
+def test_rescale_magnitude_identity(df_simspec, df_sncont):
+    res = rescale_magnitude(df_simspec, df_sncont, mag0, [mag0])
+
+    assert np.allclose(res["sncont"][0], df_sncont["sncont"])
+    assert np.allclose(res["flux"][0], df_simspec["flux"])
+    assert np.allclose(res["error"][0], df_simspec["error"])
+    assert np.array_equal(res["input_spec"][0], df_sncont["input_spec"])
+
+
+@pytest.mark.parametrize("mag", [20.0, 23.5])
+def test_rescale_magnitude_round_trip(df_simspec, df_sncont, mag):
+    res = rescale_magnitude(df_simspec, df_sncont, mag0, [mag0 - 1.0, mag, mag0 + 1.0])
+    # brighter objects have higher S/N
+    assert np.all(res["sncont"][0] > res["sncont"][2])
+
+    # tables of a run at mag, the object noise scaled as the error
+    i = 1
+    df_simspec_mag = df_simspec.assign(flux=res["flux"][i], error=res["error"][i])
+    df_sncont_mag = df_sncont.assign(
+        sncont=res["sncont"][i],
+        input_spec=res["input_spec"][i],
+        noise_w_obj_per_exp=df_sncont["noise_w_obj_per_exp"]
+        * res["error"][i]
+        / df_simspec["error"],
+    )
+    back = rescale_magnitude(df_simspec_mag, df_sncont_mag, mag, [mag0])
+
+    assert np.allclose(back["sncont"][0], df_sncont["sncont"])
+    assert np.allclose(back["flux"][0], df_simspec["flux"])
+    assert np.allclose(back["error"][0], df_simspec["error"])
+    assert np.allclose(back["input_spec"][0], df_sncont["input_spec"])
+
+
+@pytest.fixture
+def df_snline():
+    rng = np.random.default_rng(2)
+    n = 20
+    sn = rng.uniform(0.0, 10.0, (3, n))
+    return pd.DataFrame(
+        {
+            "wavelength": np.linspace(400, 1250, n),
+            "snline_b": sn[0],
+            "snline_r": sn[1],
+            "snline_n": sn[2],
+            "snline_tot": np.sqrt(np.sum(sn**2, axis=0)),
+            "effective_collecting_area": rng.uniform(1.0, 3.0, n),
+            "fiber_aperture_factor": rng.uniform(0.5, 0.8, n),
+        }
+    )
+
+
+def test_rescale_snline_identity(df_snline):
+    res = rescale_snline(df_snline, 1e-17, 70.0, [1e-17], exp_time=exp_time)
+
+    for c in ["snline_b", "snline_r", "snline_n", "snline_tot"]:
+        assert np.allclose(res[c][0], df_snline[c])
+
+
+def test_rescale_snline_flux_and_width(df_snline):
+    res = rescale_snline(
+        df_snline,
+        1e-17,
+        70.0,
+        [0.5e-17, 1e-17, 2e-17, 1e-17],
+        [70.0, 70.0, 70.0, 300.0],
+    )
+    sn = res["snline_tot"]
+
+    # S/N increases with the line flux, up to linearly for faint lines
+    assert np.all(sn[0] <= sn[1]) and np.all(sn[1] <= sn[2])
+    assert np.all(sn[2] <= 2.0 * sn[1] + 1e-12)
+    # and more background is summed for broader lines
+    assert np.all(sn[3] <= sn[1])
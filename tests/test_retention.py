@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import time
+
+import pytest
+
+from pfs_etc_web.pfs_etc_retention import (
+    clean_outputs,
+    parse_size,
+    running_session,
+    touch_session,
+)
+from pfs_etc_web.pfs_etc_sessions import SimulationIndex, session_size
+
+# a day ago, older than min_age
+mtime = time.time() - 86400.0
+
+
+def make_session(basedir, sessiondir, t):
+    outdir = os.path.join(basedir, sessiondir)
+    os.makedirs(outdir)
+    with open(os.path.join(outdir, "output.dat"), "wb") as f:
+        f.write(b"0" * 100_000)
+    os.utime(outdir, (t, t))
+    SimulationIndex(basedir).add(os.path.basename(sessiondir), sessiondir)
+    return outdir
+
+
+@pytest.fixture
+def sessions(tmp_path):
+    # four sessions of the same day, the first one the least recently modified
+    return {
+        k: make_session(
+            str(tmp_path), os.path.join("20240101", f"20240101-00000{i}-{k}"), mtime + i
+        )
+        for i, k in enumerate(["aa", "bb", "cc", "dd"])
+    }
+
+
+def test_parse_size():
+    assert parse_size("500M") == 500 * 1024**2
+    assert parse_size("20GB") == 20 * 1024**3
+    assert parse_size(1000) == 1000
+
+
+def test_expired_sessions_are_removed(tmp_path, sessions):
+    stats = clean_outputs(str(tmp_path), quota=0, min_age=3600.0)
+
+    assert stats["removed"] == 4
+    assert not any(os.path.exists(v) for v in sessions.values())
+    # the directory of the day is removed with its last session
+    assert not os.path.exists(tmp_path / "20240101")
+
+
+def test_least_recently_used_first(tmp_path, sessions):
+    basedir = str(tmp_path)
+    # just over the quota, so that a single session is removed
+    quota = sum(session_size(v) for v in sessions.values()) - 1
+
+    clean_outputs(basedir, quota=quota, min_age=3600.0)
+    assert not os.path.exists(sessions["aa"])
+
+    # opened again, but earlier than min_age
+    t = time.time() - 7200.0
+    touch_session(basedir, os.path.relpath(sessions["bb"], basedir))
+    os.utime(
+        tmp_path / ".cache" / "accessed" / os.path.basename(sessions["bb"]), (t, t)
+    )
+    quota = sum(session_size(v) for v in sessions.values() if os.path.exists(v)) - 1
+
+    clean_outputs(basedir, quota=quota, min_age=3600.0)
+    assert os.path.exists(sessions["bb"])
+    assert not os.path.exists(sessions["cc"])
+    assert os.path.exists(sessions["dd"])
+
+
+def test_running_accessed_and_cached_sessions_are_kept(tmp_path, sessions):
+    basedir = str(tmp_path)
+    touch_session(basedir, os.path.relpath(sessions["bb"], basedir))
+    with open(tmp_path / ".cache" / "result_cache.json", "w") as f:
+        json.dump(
+            [
+                [
+                    "key",
+                    {
+                        "sessiondir": os.path.relpath(sessions["cc"], basedir),
+                        "created": mtime,
+                        "accessed": mtime,
+                    },
+                ]
+            ],
+            f,
+        )
+
+    with running_session(basedir, os.path.relpath(sessions["aa"], basedir)):
+        clean_outputs(basedir, quota=0, min_age=3600.0)
+
+    assert all(os.path.exists(sessions[k]) for k in ["aa", "bb", "cc"])
+    assert not os.path.exists(sessions["dd"])
+
+
+def test_nothing_removed_with_corrupt_cache_index(tmp_path, sessions):
+    os.makedirs(tmp_path / ".cache", exist_ok=True)
+    with open(tmp_path / ".cache" / "result_cache.json", "w") as f:
+        f.write("{")
+
+    stats = clean_outputs(str(tmp_path), quota=0, min_age=3600.0)
+
+    assert stats["removed"] == 0
+    assert all(os.path.exists(v) for v in sessions.values())
+
+
+def test_dry_run(tmp_path, sessions):
+    stats = clean_outputs(str(tmp_path), quota=0, min_age=3600.0, dry_run=True)
+
+    assert stats["removed"] == 4
+    assert all(os.path.exists(v) for v in sessions.values())
+
+
+def test_index_rows_are_removed_with_directories(tmp_path, sessions):
+    index = SimulationIndex(str(tmp_path))
+    assert all(index.get(os.path.basename(v)) is not None for v in sessions.values())
+
+    clean_outputs(str(tmp_path), quota=0, min_age=3600.0)
+
+    assert all(index.get(os.path.basename(v)) is None for v in sessions.values())
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+import os
+
+import pytest
+
+from pfs_etc_web.pfs_etc_sessions import (
+    SimulationIndex,
+    new_simulation_id,
+    session_name,
+    session_path,
+)
+
+
+def test_session_path():
+    simulation_id = new_simulation_id()
+
+    assert session_path(simulation_id) == os.path.join(simulation_id[:8], simulation_id)
+    # IDs of older versions are directly in basedir
+    assert session_path("abcdef") == "abcdef"
+    assert session_name(session_path(simulation_id)) == simulation_id
+
+
+@pytest.mark.parametrize(
+    "simulation_id",
+    ["", "..", "../x", "a/b", "/tmp", ".cache", "-a", "a b", "20240101", "99999999"],
+)
+def test_resolve_rejects_invalid_ids(tmp_path, simulation_id):
+    # a directory of the day exists, but is not a simulation
+    os.makedirs(tmp_path / "20240101" / "20240101-000000-aa")
+    os.makedirs(tmp_path / "99999999")
+
+    assert SimulationIndex(str(tmp_path)).resolve(simulation_id) is None
+
+
+def test_resolve_sharded_and_flat_ids(tmp_path):
+    index = SimulationIndex(str(tmp_path))
+    simulation_id = new_simulation_id()
+    os.makedirs(tmp_path / session_path(simulation_id))
+    os.makedirs(tmp_path / "abcdef")
+
+    # not in the index yet, and added when found
+    assert index.get(simulation_id) is None
+    assert index.resolve(simulation_id) == session_path(simulation_id)
+    assert index.get(simulation_id)["path"] == session_path(simulation_id)
+    assert index.resolve("abcdef") == "abcdef"
+    assert index.resolve("20240101-000000-ff") is None
+
+
+def test_resolve_removes_stale_rows(tmp_path):
+    index = SimulationIndex(str(tmp_path))
+    index.add("20240101-000000-aa", os.path.join("20240101", "20240101-000000-aa"))
+
+    assert index.resolve("20240101-000000-aa") is None
+    assert index.get("20240101-000000-aa") is None
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pfs_etc_web.pfs_etc_params import (
+    EnvironmentConf,
+    InstrumentConf,
+    OutputConf,
+    TargetConf,
+    TelescopeConf,
+)
+from pfs_etc_web.pfs_etc_sessions import new_simulation_id, session_path
+from pfs_etc_web.pfs_etc_utils import manifest_tables, read_manifest
+
+pytest.importorskip("pfsspecsim")
+
+from pfs_etc_web.pfs_etc_specsim import PfsSpecSim  # noqa: E402
+
+
+def new_specsim(conf_output):
+    return PfsSpecSim(
+        target=TargetConf(),
+        environment=EnvironmentConf(),
+        instrument=InstrumentConf(),
+        telescope=TelescopeConf(),
+        output=conf_output,
+    )
+
+
+def test_outputs_are_written_in_the_directory_of_their_run(tmp_path):
+    data = tuple(
+        pd.DataFrame({k: np.zeros(3, dtype=v) for k, v in columns.items()})
+        for columns in manifest_tables.values()
+    )
+
+    # a single conf shared by the runs of a session as in the app
+    conf_output = OutputConf(basedir=str(tmp_path))
+
+    conf_output.sessiondir = session_path(new_simulation_id())
+    sessiondir_a = conf_output.sessiondir
+    os.makedirs(os.path.join(tmp_path, sessiondir_a))
+    specsim_a = new_specsim(conf_output)
+    files_a = specsim_a.output_files()
+
+    # the outputs of the first run are written after the next run started
+    started = threading.Event()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pool.submit(started.wait)
+        future = pool.submit(specsim_a.write_manifest, data)
+
+        conf_output.sessiondir = session_path(new_simulation_id())
+        os.makedirs(os.path.join(tmp_path, conf_output.sessiondir))
+        specsim_b = new_specsim(conf_output)
+
+        started.set()
+        outfile = future.result()
+
+    assert os.path.dirname(outfile) == os.path.join(tmp_path, sessiondir_a)
+    assert read_manifest(outfile) is not None
+    assert specsim_a.output_files() == files_a
+    assert specsim_b.output_files() != files_a
+    assert os.listdir(os.path.join(tmp_path, conf_output.sessiondir)) == []
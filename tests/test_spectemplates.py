@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+
+import pytest
+
+from pfs_etc_web import pfs_etc_spectemplates
+from pfs_etc_web.pfs_etc_spectemplates import (
+    read_template_bundle,
+    template_path,
+    write_template_bundle,
+)
+
+pytest.importorskip("synphot")
+
+
+@pytest.fixture
+def bundle(tmp_path):
+    infiles = []
+    for template in ["Sc", "Quasar"]:
+        infile = template_path(template)
+        if not os.path.exists(infile):
+            pytest.skip(f"{infile} not found")
+        infiles.append(shutil.copy(infile, tmp_path))
+    outfile, indexfile = tmp_path / "templates.npy", tmp_path / "templates.json"
+    write_template_bundle(infiles, outfile=outfile, indexfile=indexfile)
+    return infiles, outfile, indexfile
+
+
+def test_unchanged_templates_are_not_read(bundle, monkeypatch):
+    infiles, outfile, indexfile = bundle
+
+    def file_checksum(filename):
+        raise AssertionError(f"{filename} read")
+
+    monkeypatch.setattr(pfs_etc_spectemplates, "file_checksum", file_checksum)
+
+    assert sorted(read_template_bundle(outfile, indexfile)) == sorted(infiles)
+
+
+def test_changed_templates_are_skipped(bundle):
+    infiles, outfile, indexfile = bundle
+    # only touched, and changed
+    os.utime(infiles[0], (0, 0))
+    with open(infiles[1], "ab") as f:
+        f.write(b"\0")
+
+    assert list(read_template_bundle(outfile, indexfile)) == [infiles[0]]
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+rootdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# imported when a simulation is run rather than when a session starts, see
+# benchmarks/check_startup.py
+deferred_modules = ["synphot", "pfsspecsim", "astropy.table"]
+
+
+@pytest.mark.parametrize("module", deferred_modules)
+def test_app_import_defers_simulator(module):
+    pytest.importorskip("panel")
+
+    # a fresh interpreter as other tests may have imported the module already
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys; import pfs_etc_web.pn_app; "
+            f"print({module!r} in sys.modules)",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    assert result.stdout.strip() == "False"
+
+
+def test_startup_within_budget(tmp_path):
+    pytest.importorskip("panel")
+
+    # cold start of `panel serve` and the first session render, with the
+    # budgets of benchmarks/check_startup.py
+    result = subprocess.run(
+        [
+            sys.executable,
+            os.path.join(rootdir, "benchmarks", "check_startup.py"),
+            "--log",
+            str(tmp_path / "startup_importtime.log"),
+        ],
+        capture_output=True,
+        text=True,
+    )
+
+    assert result.returncode == 0, result.stdout + result.stderr
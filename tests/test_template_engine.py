@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+import os
+import warnings
+
+import pytest
+from astropy import units as u
+
+from pfs_etc_web.cli.validate_template_engine import compare
+from pfs_etc_web.pfs_etc_spectemplates import template_path
+
+pytest.importorskip("synphot")
+
+# a galaxy, a quasar, a hot and a cool star; validate_template_engine covers
+# all templates on a finer grid
+templates = ["SSP (100 Myr, [M/H]=0, Chabrier IMF)", "Sc", "Quasar", "B0V", "M0III"]
+
+
+@pytest.mark.parametrize("template", templates)
+@pytest.mark.parametrize("redshift", [0.0, 1.0, 3.0])
+@pytest.mark.parametrize("wavelength", [400.0, 800.0, 1200.0])
+def test_numpy_engine_matches_synphot(template, redshift, wavelength):
+    infile = template_path(template)
+    if not os.path.exists(infile):
+        pytest.skip(f"{infile} not found")
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        status, dmag, _, _ = compare(
+            infile,
+            redshift=redshift,
+            norm_wavelength=wavelength * u.nm,
+            norm_mag=20.0 * u.ABmag,
+        )
+
+    assert status == "ok"
+    assert dmag <= 1e-6